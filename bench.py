@@ -0,0 +1,614 @@
+# Micro-benchmarks for the bot's hot paths. Run with: python bench.py [name ...]
+# The load benchmark compares against bench_baseline.json; pass --save-baseline to replace it.
+import os
+import sys
+import json
+import math
+import logging
+import time
+import random
+import sqlite3
+import asyncio
+import tempfile
+import aiohttp
+from types import SimpleNamespace
+from statistics import quantiles
+
+# bot.py validates its configuration on import; benchmarks never talk to Telegram
+for var_name, default in (("API_TOKEN", "0:bench"), ("ADMIN_ID", "1"), ("PHONE_NUMBER", "+998000000000"),
+                          ("SUPPORT_USERNAME", "@bench"), ("CARD_NUMBER", "0000"), ("METRICS_PORT", "0"),
+                          # Telegram's per-chat limit would dominate every step; set these to
+                          # 30/1/3 to measure with production flood control
+                          ("GLOBAL_SEND_RATE", "100000"), ("CHAT_SEND_RATE", "100000"), ("CHAT_SEND_BURST", "100000"),
+                          # Every virtual user picks the next slot at once; without this all
+                          # but the first SLOT_CAPACITY would be sent back to choose again
+                          ("SLOT_CAPACITY", "100000")):
+    os.environ.setdefault(var_name, default)
+
+import bot
+
+USERS = 2000
+HANDLERS = 400
+WRITE_ROWS = 20000
+
+def percentiles(samples, points=(50, 99)):
+    cuts = quantiles(samples, n=100)
+    return [cuts[point - 1] * 1000 for point in points]
+
+def report(name, samples):
+    p50, p99 = percentiles(samples)
+    print(f"{name:<32} p50 {p50:8.2f} ms   p99 {p99:8.2f} ms   n={len(samples)}")
+
+def make_db(path):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE users (user_id INTEGER PRIMARY KEY, name TEXT, phone TEXT, language TEXT, coins REAL DEFAULT 0)")
+    conn.execute("CREATE TABLE orders (order_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, products TEXT)")
+    conn.executemany("INSERT INTO users (user_id, name, phone, language) VALUES (?, ?, ?, ?)",
+                     [(i, f"user{i}", "+998000000000", "en") for i in range(USERS)])
+    conn.commit()
+    conn.close()
+
+# One update handler: the per-click language lookup every handler starts with
+async def handler_connect_per_call(path, user_id):
+    conn = sqlite3.connect(path)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
+        c.fetchone()
+    finally:
+        conn.close()
+
+async def handler_pooled(database, user_id):
+    await database.fetchone("SELECT language FROM users WHERE user_id = ?", (user_id,))
+
+# The slow write that used to stall everyone: a large order commit
+def slow_write(c):
+    c.executemany("INSERT INTO orders (user_id, products) VALUES (?, ?)",
+                  [(i % USERS, "Cola x2 (14000.000 UZS)") for i in range(WRITE_ROWS)])
+
+async def slow_write_connect_per_call(path):
+    conn = sqlite3.connect(path)
+    try:
+        slow_write(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+
+# Updates arrive on a fixed schedule; latency is measured from arrival, so time
+# spent waiting for a blocked event loop counts against the handler
+async def drive(handler, writer, interval=0.0005):
+    latencies = []
+
+    async def timed(arrival, user_id):
+        await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+        await handler(user_id)
+        latencies.append(time.perf_counter() - arrival)
+
+    started = time.perf_counter()
+    tasks = []
+    for i in range(HANDLERS):
+        arrival = started + i * interval
+        if i % 100 == 0:
+            tasks.append(asyncio.create_task(writer()))
+        tasks.append(asyncio.create_task(timed(arrival, random.randrange(USERS))))
+    await asyncio.gather(*tasks)
+    return latencies
+
+async def bench_db_layer():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        make_db(path)
+        samples = await drive(lambda uid: handler_connect_per_call(path, uid),
+                              lambda: slow_write_connect_per_call(path))
+        report("connect-per-call", samples)
+        database = bot.Database(path, bot.DB_POOL_SIZE)
+        try:
+            samples = await drive(lambda uid: handler_pooled(database, uid),
+                                  lambda: database.run(slow_write))
+            report("pooled executor", samples)
+        finally:
+            database.close()
+
+# Stand-in for the Bot API: every call costs one simulated round trip
+class FakeBot:
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.calls = 0
+        self.next_message_id = 1
+
+    async def call(self):
+        self.calls += 1
+        await asyncio.sleep(self.rtt)
+        self.next_message_id += 1
+        return SimpleNamespace(message_id=self.next_message_id)
+
+    async def delete_message(self, **kwargs):
+        await self.call()
+
+    async def delete_messages(self, **kwargs):
+        await self.call()
+
+    # Edits keep the message id, the way the Bot API does
+    async def edit(self, message_id):
+        self.calls += 1
+        await asyncio.sleep(self.rtt)
+        return SimpleNamespace(message_id=message_id)
+
+    async def edit_message_text(self, *args, message_id=None, **kwargs):
+        return await self.edit(message_id)
+
+    async def edit_message_caption(self, *args, message_id=None, **kwargs):
+        return await self.edit(message_id)
+
+    async def edit_message_media(self, *args, message_id=None, **kwargs):
+        return await self.edit(message_id)
+
+    async def edit_message_reply_markup(self, *args, message_id=None, **kwargs):
+        return await self.edit(message_id)
+
+class FakeMessage:
+    chat_id = 1
+
+    def __init__(self, fake_bot):
+        self.bot = fake_bot
+
+    async def reply_text(self, *args, **kwargs):
+        return await self.bot.call()
+
+    async def reply_photo(self, *args, **kwargs):
+        return await self.bot.call()
+
+    async def reply_media_group(self, media, **kwargs):
+        await self.bot.call()
+        return [SimpleNamespace(message_id=self.bot.next_message_id + i) for i in range(len(media))]
+
+PAGES = 20
+API_RTT = 0.04
+
+# Page after page of a category, as "load more" walks it, so every render shows
+# new products instead of repeating an unchanged screen
+def product_page(page):
+    first = page * bot.ITEMS_PER_BATCH
+    return [bot.Product(i, f"Product {i}", "Description", f"file-{i}", 15000.0, "cream", 1)
+            for i in range(first, first + bot.ITEMS_PER_BATCH)]
+
+async def bench_product_pages():
+    nav_rows = [[bot.InlineKeyboardButton("Load more", callback_data="load_more_products_5")],
+                [bot.InlineKeyboardButton("Back", callback_data="category_cream")]]
+    for mode in ("cards", "list", "gallery"):
+        bot.PRODUCT_LIST_MODE = mode
+        fake_bot = FakeBot(API_RTT)
+        session = bot.Session()
+        session.last_message_id, session.message_type = 1, "button"
+        context = SimpleNamespace(bot=fake_bot, user_data=session)
+        samples = []
+        for page in range(PAGES):
+            started = time.perf_counter()
+            await bot.send_product_page(FakeMessage(fake_bot), context, "en", product_page(page), nav_rows)
+            samples.append(time.perf_counter() - started)
+        report(f"{mode} ({fake_bot.calls / PAGES:.0f} calls/page)", samples)
+
+# Recorded update shapes: a text message and a button press
+def recorded_update(update_id):
+    user = {"id": 1000 + update_id % 50, "is_bot": False, "first_name": "Bench"}
+    chat = {"id": user["id"], "type": "private"}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": "Cola"}
+    if update_id % 2:
+        return {"update_id": update_id, "message": message}
+    return {"update_id": update_id, "callback_query": {"id": str(update_id), "from": user, "chat_instance": "1",
+                                                       "data": "category_cream", "message": message}}
+
+UPDATES = 500
+UPDATE_INTERVAL = 0.002
+BENCH_PORT = 18443
+BENCH_SECRET = "bench-secret"
+
+# Stand-in for Application: WebhookServer and the poller only need the queue
+def fake_application():
+    return SimpleNamespace(bot=None, update_queue=asyncio.Queue(), running=True)
+
+async def consume(application, arrivals, latencies):
+    while len(latencies) < UPDATES:
+        update = await application.update_queue.get()
+        latencies.append(time.perf_counter() - arrivals[update.update_id])
+
+# Telegram delivers each update with one POST, which pays one network hop
+async def webhook_delivery():
+    application = fake_application()
+    server = bot.WebhookServer(application, path="/telegram", secret=BENCH_SECRET)
+    await server.start("127.0.0.1", BENCH_PORT)
+    arrivals, latencies = {}, []
+    consumer = asyncio.create_task(consume(application, arrivals, latencies))
+    try:
+        async with aiohttp.ClientSession() as session:
+            async def post(update_id):
+                await asyncio.sleep(max(0.0, arrivals[update_id] - time.perf_counter()) + API_RTT / 2)
+                async with session.post(f"http://127.0.0.1:{BENCH_PORT}/telegram", json=recorded_update(update_id),
+                                        headers={bot.SECRET_TOKEN_HEADER: BENCH_SECRET}) as response:
+                    assert response.status == 200
+            started = time.perf_counter()
+            for update_id in range(UPDATES):
+                arrivals[update_id] = started + update_id * UPDATE_INTERVAL
+            await asyncio.gather(*(post(update_id) for update_id in range(UPDATES)))
+            await consumer
+            async with session.get(f"http://127.0.0.1:{BENCH_PORT}/health") as response:
+                health = await response.json()
+                assert health["updates_received"] == UPDATES
+    finally:
+        await server.stop()
+    return latencies
+
+# Local getUpdates stand-in: long polls until updates past the offset exist;
+# requests and responses each pay one network hop
+async def polling_delivery():
+    application = fake_application()
+    pending, arrivals, latencies = [], {}, []
+    available = asyncio.Event()
+
+    async def get_updates(request):
+        params = await request.json()
+        while not [u for u in pending if u["update_id"] >= params.get("offset", 0)]:
+            available.clear()
+            await available.wait()
+        result = [u for u in pending if u["update_id"] >= params.get("offset", 0)]
+        await asyncio.sleep(API_RTT / 2)
+        return bot.web.json_response({"ok": True, "result": result})
+
+    app = bot.web.Application()
+    app.router.add_post("/getUpdates", get_updates)
+    runner = bot.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await bot.web.TCPSite(runner, "127.0.0.1", BENCH_PORT).start()
+    consumer = asyncio.create_task(consume(application, arrivals, latencies))
+
+    async def poller(session):
+        offset = 0
+        while offset < UPDATES:
+            await asyncio.sleep(API_RTT / 2)
+            async with session.post(f"http://127.0.0.1:{BENCH_PORT}/getUpdates", json={"offset": offset}) as response:
+                result = (await response.json())["result"]
+            for data in result:
+                application.update_queue.put_nowait(bot.Update.de_json(data, None))
+                offset = data["update_id"] + 1
+
+    async def produce():
+        started = time.perf_counter()
+        for update_id in range(UPDATES):
+            arrivals[update_id] = started + update_id * UPDATE_INTERVAL
+            await asyncio.sleep(max(0.0, arrivals[update_id] - time.perf_counter()))
+            pending.append(recorded_update(update_id))
+            available.set()
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(produce(), poller(session), consumer)
+    finally:
+        await runner.cleanup()
+    return latencies
+
+async def bench_update_delivery():
+    report("polling (getUpdates)", await polling_delivery())
+    report("webhook", await webhook_delivery())
+
+# Old per-click path: every store row from SQL, then haversine in Python
+def haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371 * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+async def nearest_per_click(database, lat, lon):
+    stores = await database.fetchall("SELECT id, name, latitude, longitude FROM stores")
+    return sorted((haversine(lat, lon, s_lat, s_lon), store_id, name) for store_id, name, s_lat, s_lon in stores)[:bot.NEAREST_STORES]
+
+STORES = 500
+LOOKUPS = 2000
+
+async def bench_nearest_store():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "stores.db")
+        bot.init_db(path)
+        conn = sqlite3.connect(path)
+        conn.executemany("INSERT OR REPLACE INTO stores (id, name, latitude, longitude) VALUES (?, ?, ?, ?)",
+                         [(i, f"Branch {i}", 41.2 + random.random() * 0.2, 69.1 + random.random() * 0.3) for i in range(1, STORES + 1)])
+        conn.commit()
+        conn.close()
+        previous_db, bot.db = bot.db, bot.Database(path, bot.DB_POOL_SIZE)
+        try:
+            points = [(41.2 + random.random() * 0.2, 69.1 + random.random() * 0.3) for _ in range(LOOKUPS)]
+            samples = []
+            for lat, lon in points:
+                started = time.perf_counter()
+                await nearest_per_click(bot.db, lat, lon)
+                samples.append(time.perf_counter() - started)
+            report(f"SQL + haversine ({STORES} stores)", samples)
+            index = bot.StoreIndex()
+            await index.ensure_loaded()
+            samples = []
+            for lat, lon in points:
+                started = time.perf_counter()
+                await index.nearest(lat, lon)
+                samples.append(time.perf_counter() - started)
+            report(f"StoreIndex ({STORES} stores)", samples)
+        finally:
+            bot.db.close()
+            bot.db = previous_db
+
+ZONES = 200
+
+# A city-wide zone with overlapping district polygons inside it: brute force
+# tests every polygon per address, the grid answers most points from one cell.
+def random_polygon(lat, lon, radius, points=24):
+    return [(lat + radius * (0.7 + 0.3 * random.random()) * math.sin(2 * math.pi * i / points),
+             lon + radius * (0.7 + 0.3 * random.random()) * math.cos(2 * math.pi * i / points)) for i in range(points)]
+
+def zone_brute_force(zones, store_id, lat, lon):
+    matches = [zone for zone in zones if zone.store_id in (None, store_id) and bot.point_in_polygon(zone.polygon, lat, lon)]
+    return min(matches, key=lambda zone: zone.area) if matches else None
+
+async def bench_delivery_zones():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "zones.db")
+        bot.init_db(path)
+        conn = sqlite3.connect(path)
+        conn.execute("INSERT INTO delivery_zones (store_id, name, fee, min_order, eta_minutes, polygon) VALUES (NULL, 'City', 15000, 50000, 60, ?)",
+                     (json.dumps(random_polygon(41.3, 69.25, 0.2, 64)),))
+        conn.executemany("INSERT INTO delivery_zones (store_id, name, fee, min_order, eta_minutes, polygon) VALUES (?, ?, 8000, 30000, 30, ?)",
+                         [(random.randint(1, 5), f"District {i}", json.dumps(random_polygon(41.2 + random.random() * 0.2, 69.15 + random.random() * 0.2, 0.03)))
+                          for i in range(ZONES)])
+        conn.commit()
+        conn.close()
+        previous_db, bot.db = bot.db, bot.Database(path, bot.DB_POOL_SIZE)
+        try:
+            index = bot.DeliveryZoneIndex()
+            started = time.perf_counter()
+            await index.ensure_loaded()
+            print(f"Grid build ({ZONES + 1} zones, {len(index._grid)} cells): {(time.perf_counter() - started) * 1000:.1f} ms")
+            points = [(random.randint(1, 5), 41.1 + random.random() * 0.4, 69.05 + random.random() * 0.4) for _ in range(LOOKUPS)]
+            for name, lookup in (("Brute-force point-in-polygon", lambda *point: zone_brute_force(index._zones, *point)),
+                                 ("DeliveryZoneIndex grid", index.lookup)):
+                samples = []
+                for point in points:
+                    started = time.perf_counter()
+                    lookup(*point)
+                    samples.append(time.perf_counter() - started)
+                report(f"{name} ({ZONES + 1} zones)", samples)
+            assert all((index.lookup(*point) or None) == zone_brute_force(index._zones, *point) for point in points)
+        finally:
+            bot.db.close()
+            bot.db = previous_db
+
+# Local Bot API stand-in for the real Application: getUpdates long polls a
+# shared update list, and every send* call is delivered to the virtual user
+# owning the chat. Each call pays one simulated network round trip.
+class FakeBotAPI:
+    def __init__(self, rtt):
+        self.rtt = rtt
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.available = asyncio.Event()
+        self.inboxes = {}
+        self.calls = 0
+        self._runner = None
+
+    def push_update(self, payload):
+        payload["update_id"] = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append(payload)
+        self.available.set()
+
+    def message(self, chat_id, data):
+        self.next_message_id += 1
+        return {"message_id": self.next_message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "bench"}, "text": data.get("text") or data.get("caption") or ""}
+
+    async def get_updates(self, data):
+        offset = int(data.get("offset") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self.available.clear()
+            try:
+                await asyncio.wait_for(self.available.wait(), float(data.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        if method == "getUpdates":
+            result = await self.get_updates(data)
+        else:
+            self.calls += 1
+            await asyncio.sleep(self.rtt)
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot",
+                          "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+            elif method in ("sendMessage", "sendPhoto"):
+                chat_id = int(data["chat_id"])
+                result = self.message(chat_id, data)
+                if chat_id in self.inboxes:
+                    self.inboxes[chat_id].put_nowait(data)
+            elif method in ("editMessageText", "editMessageCaption", "editMessageMedia", "editMessageReplyMarkup"):
+                chat_id = int(data["chat_id"])
+                result = {**self.message(chat_id, data), "message_id": int(data["message_id"])}
+                if chat_id in self.inboxes:
+                    self.inboxes[chat_id].put_nowait(data)
+            elif method == "sendMediaGroup":
+                chat_id = int(data["chat_id"])
+                result = [self.message(chat_id, {}) for _ in json.loads(data["media"])]
+            else:
+                result = True
+        return bot.web.json_response({"ok": True, "result": result})
+
+    async def start(self, port):
+        app = bot.web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = bot.web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await bot.web.TCPSite(self._runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+# Counts "database is locked" errors and everything else logged at ERROR
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.locked = 0
+        self.errors = 0
+
+    def emit(self, record):
+        if "database is locked" in record.getMessage() or (
+                record.exc_info and "database is locked" in str(record.exc_info[1])):
+            self.locked += 1
+        else:
+            self.errors += 1
+
+def callback_buttons(data):
+    markup = json.loads(data.get("reply_markup") or "{}")
+    return [button.get("callback_data") for row in markup.get("inline_keyboard", []) for button in row]
+
+def has_button(prefix):
+    return lambda data: any(button and button.startswith(prefix) for button in callback_buttons(data))
+
+def has_text(text):
+    return lambda data: data.get("text") == text
+
+LOAD_USERS = int(os.getenv("LOAD_USERS", 50))
+STEP_TIMEOUT = 30.0
+LOAD_PORT = 18081
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+SAVE_BASELINE = False
+
+# One shopper walking /start -> registration -> checkout. Each step sends one
+# update and ends when the bot sends the message that completes it.
+async def virtual_user(api, index, step_latencies):
+    chat_id = 500000 + index
+    user = {"id": chat_id, "is_bot": False, "first_name": f"Shopper{index}"}
+    chat = {"id": chat_id, "type": "private"}
+    inbox = api.inboxes[chat_id] = asyncio.Queue()
+    last = {"text": ""}
+    en = bot.LANGUAGES["en"]
+
+    def message(**fields):
+        return {"message": {"message_id": api.next_message_id, "date": int(time.time()), "chat": chat, "from": user, **fields}}
+
+    def click(callback_data):
+        return {"callback_query": {"id": str(api.next_update_id), "from": user, "chat_instance": str(chat_id),
+                                   "data": callback_data, "message": api.message(chat_id, last)}}
+
+    async def step(name, payload, done):
+        while not inbox.empty():
+            inbox.get_nowait()
+        started = time.perf_counter()
+        api.push_update(payload)
+        while True:
+            data = await asyncio.wait_for(inbox.get(), STEP_TIMEOUT)
+            if done(data):
+                break
+        step_latencies.setdefault(name, []).append(time.perf_counter() - started)
+        last.update(data)
+        return data
+
+    await step("start", message(text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}]),
+               has_button("lang_en"))
+    await step("language", click("lang_en"), has_text(en["enter_name"]))
+    await step("name", message(text=f"Shopper {index}"), has_text(en["enter_phone"]))
+    await step("phone", message(text=f"+99890{index:07d}"), has_button("start_ordering"))
+    # Coins for the payment step; a real shopper would buy them through an admin
+    await bot.db.execute("UPDATE users SET coins = 1000000 WHERE user_id = ?", (chat_id,))
+    bot.user_cache.invalidate(chat_id)
+    await step("start_ordering", click("start_ordering"), has_text(en["send_location"]))
+    data = await step("location", message(location={"latitude": 41.3111, "longitude": 69.2797}), has_button("store_"))
+    data = await step("store", click(callback_buttons(data)[0]), has_button("category_"))
+    data = await step("category", click(callback_buttons(data)[0]), has_button("add_to_cart_"))
+    add_to_cart = next(button for button in callback_buttons(data) if button.startswith("add_to_cart_"))
+    await step("add_to_cart", click(add_to_cart), has_button("see_cart"))
+    await step("see_cart", click("see_cart"), has_button("finish_order"))
+    await step("finish_order", click("finish_order"), has_text(en["enter_promo"]))
+    await step("promo", message(text="skip"), has_button("choose_delivery_next"))
+    await step("delivery", click("choose_delivery_next"), has_button("payment_coins"))
+    await step("payment_coins", click("payment_coins"), has_text(en["order_submitted"]))
+
+async def bench_load():
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    logging.getLogger().setLevel(logging.WARNING)
+    api = FakeBotAPI(API_RTT)
+    await api.start(LOAD_PORT)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "load.db")
+        bot.db = bot.Database(path, bot.DB_POOL_SIZE)
+        bot.init_db(path)
+        application = bot.build_application(base_url=f"http://127.0.0.1:{LOAD_PORT}/bot")
+        await application.initialize()
+        await application.post_init(application)
+        await application.updater.start_polling(poll_interval=0.0, timeout=10)
+        await application.start()
+        step_latencies = {}
+        started = time.perf_counter()
+        outcomes = await asyncio.gather(*(virtual_user(api, i, step_latencies) for i in range(LOAD_USERS)),
+                                        return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        await application.updater.stop()
+        await application.stop()
+        await application.post_shutdown(application)
+        await application.shutdown()
+        bot.db.close()
+    await api.stop()
+    logging.getLogger().removeHandler(errors)
+
+    completed = sum(1 for outcome in outcomes if outcome is None)
+    steps = sum(len(samples) for samples in step_latencies.values())
+    results = {
+        "users": LOAD_USERS,
+        "completed": completed,
+        "steps_per_s": steps / elapsed,
+        "checkouts_per_s": completed / elapsed,
+        "api_calls_per_step": api.calls / max(steps, 1),
+        "sqlite_locked": errors.locked,
+        "errors": errors.errors,
+        "steps": {},
+    }
+    print(f"{LOAD_USERS} users, {completed} checkouts in {elapsed:.1f}s: {results['steps_per_s']:.1f} steps/s, "
+          f"{results['checkouts_per_s']:.2f} checkouts/s, {results['api_calls_per_step']:.2f} Bot API calls/step, "
+          f"sqlite locked={errors.locked}, other errors={errors.errors}")
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+    for name, samples in step_latencies.items():
+        p50, p95, p99 = percentiles(samples, (50, 95, 99)) if len(samples) > 1 else [samples[0] * 1000] * 3
+        results["steps"][name] = {"p50_ms": p50, "p95_ms": p95, "p99_ms": p99}
+        previous = baseline.get("steps", {}).get(name)
+        change = f"   p95 {(p95 / previous['p95_ms'] - 1) * 100:+6.1f}% vs baseline" if previous else ""
+        print(f"  {name:<16} p50 {p50:8.2f} ms   p95 {p95:8.2f} ms   p99 {p99:8.2f} ms{change}")
+    if baseline:
+        print(f"  throughput {(results['steps_per_s'] / baseline['steps_per_s'] - 1) * 100:+.1f}% vs baseline")
+        if "api_calls_per_step" in baseline:
+            print(f"  Bot API calls/step {(results['api_calls_per_step'] / baseline['api_calls_per_step'] - 1) * 100:+.1f}% vs baseline")
+    if SAVE_BASELINE:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline saved to {BASELINE_PATH}")
+
+BENCHMARKS = {
+    "db": bench_db_layer,
+    "pages": bench_product_pages,
+    "updates": bench_update_delivery,
+    "load": bench_load,
+    "stores": bench_nearest_store,
+    "zones": bench_delivery_zones,
+}
+
+def main(args):
+    global SAVE_BASELINE
+    SAVE_BASELINE = "--save-baseline" in args
+    names = [arg for arg in args if not arg.startswith("--")]
+    for name in names or BENCHMARKS:
+        print(f"== {name}")
+        asyncio.run(BENCHMARKS[name]())
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
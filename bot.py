@@ -3,10 +3,25 @@ import sqlite3
 import pytz
 import re
 import logging
+import unicodedata
 import asyncio
+import hashlib
+import heapq
+import hmac
+import itertools
+import json
+import queue
+import signal
+import sys
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from math import radians, sin, cos, sqrt, atan2
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+from math import radians, sin, cos, sqrt, asin, floor
+from array import array
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup, InputMediaPhoto
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -14,9 +29,15 @@ from telegram.ext import (
     MessageHandler,
     filters,
     ContextTypes,
+    TypeHandler,
+    BaseUpdateProcessor,
+    BaseRateLimiter,
+    BasePersistence,
+    PersistenceInput,
 )
-from telegram.error import TelegramError
+from telegram.error import TelegramError, RetryAfter, BadRequest
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from aiohttp import web
 
 # Setup logging
 logging.basicConfig(
@@ -33,11 +54,59 @@ RESTRICTED_CATEGORIES = os.getenv("RESTRICTED_CATEGORIES", "").split(",") if os.
 SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME")
 UZBEKISTAN_TZ = pytz.timezone("Asia/Tashkent")
 MIN_DELIVERY_TIME = int(os.getenv("MIN_DELIVERY_TIME", 40))
+# Delivery slot length and the default number of orders a store takes per slot
+SLOT_MINUTES = int(os.getenv("SLOT_MINUTES", 30))
+SLOT_CAPACITY = int(os.getenv("SLOT_CAPACITY", 10))
 CARD_NUMBER = os.getenv("CARD_NUMBER")
 ADMIN_RESPONSE_TIMEOUT = int(os.getenv("ADMIN_RESPONSE_TIMEOUT", 30))
+# Seconds before an unanswered prompt (coin amount, receipt, admin forms...) is
+# abandoned; registration never times out
+STATE_TTL = int(os.getenv("STATE_TTL", 900))
+FEEDBACK_TTL = int(os.getenv("FEEDBACK_TTL", 86400))
+# Seconds a checkout quote (items, discount, delivery fee, total) stays valid
+QUOTE_TTL = int(os.getenv("QUOTE_TTL", 900))
 ITEMS_PER_BATCH = int(os.getenv("ITEMS_PER_BATCH", 5))
 DELIVERY_FEE_PER_KM = float(os.getenv("DELIVERY_FEE_PER_KM", 5.0))
 MAX_DELIVERY_FEE = float(os.getenv("MAX_DELIVERY_FEE", 40.0))
+DB_PATH = os.getenv("DB_PATH", "store_bot.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", 8))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+# How many of the nearest open stores handle_location offers
+NEAREST_STORES = int(os.getenv("NEAREST_STORES", 3))
+# Grid cell size in degrees for the delivery zone lookup cache (~500 m)
+ZONE_GRID_CELL = float(os.getenv("ZONE_GRID_CELL", 0.005))
+# How a page of products is sent: "list" (one message with a button per product,
+# edited in place: one call per page), "gallery" (photos as a media group plus an
+# index message, three calls per page with the delete of the previous page) or
+# "cards" (one message per product)
+PRODUCT_LIST_MODE = os.getenv("PRODUCT_LIST_MODE", "list")
+# Outbound Bot API limits: messages per second overall and per chat
+GLOBAL_SEND_RATE = float(os.getenv("GLOBAL_SEND_RATE", 30))
+CHAT_SEND_RATE = float(os.getenv("CHAT_SEND_RATE", 1))
+CHAT_SEND_BURST = int(os.getenv("CHAT_SEND_BURST", 3))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 3))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 10))
+# Seconds between write-behind flushes of changed sessions (cart, state, navigation)
+SESSION_FLUSH_INTERVAL = float(os.getenv("SESSION_FLUSH_INTERVAL", 30))
+# Sessions idle this many seconds leave memory; with SESSION_SPILL they are kept
+# in the sessions table and restored on the user's next update, without it they
+# are dropped
+SESSION_IDLE_TTL = float(os.getenv("SESSION_IDLE_TTL", 3600))
+SESSION_SPILL = os.getenv("SESSION_SPILL", "1") != "0"
+# Prometheus text-format metrics on METRICS_LISTEN:METRICS_PORT/metrics; port 0 disables
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9100))
+# "polling" (getUpdates long polling) or "webhook" (embedded HTTP server; WEBHOOK_URL is
+# the public HTTPS base URL Telegram posts to, usually via a reverse proxy)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
 
 # Validate required environment variables
 required_env_vars = {
@@ -47,6 +116,11 @@ required_env_vars = {
     "SUPPORT_USERNAME": SUPPORT_USERNAME,
     "CARD_NUMBER": CARD_NUMBER,
 }
+if BOT_MODE == "webhook":
+    required_env_vars["WEBHOOK_URL"] = WEBHOOK_URL
+    required_env_vars["WEBHOOK_SECRET"] = WEBHOOK_SECRET
+elif BOT_MODE != "polling":
+    raise ValueError(f"BOT_MODE must be 'polling' or 'webhook', got {BOT_MODE!r}")
 for var_name, var_value in required_env_vars.items():
     if not var_value:
         logger.error(f"Missing required environment variable: {var_name}")
@@ -67,6 +141,11 @@ LANGUAGES = {
         "main_menu": "🏠 *Asosiy menyu*",
         "send_location": "📍 Joylashuvingizni yuboring:",
         "choose_store": "🏬 Do'konni tanlang:",
+        "store_option": "🏬 {name} — {distance} km, yetkazish {fee} UZS",
+        "no_open_stores": "😔 Hozir yaqin atrofda ochiq do'kon yo'q. Keyinroq urinib ko'ring.",
+        "outside_delivery_zone": "🚫 Kechirasiz, bu do'kondan sizning manzilingizga yetkazib berilmaydi.",
+        "below_min_order": "❗ {zone} uchun minimal buyurtma {min_order} UZS.",
+        "delivery_zone_info": "📍 {zone}: ~{eta} daqiqada yetkaziladi",
         "choose_category": "📋 Kategoriyani tanlang:",
         "add_to_cart": "➕ Savatga qo'shish",
         "see_cart": "🛒 Savatni ko'rish",
@@ -84,6 +163,8 @@ LANGUAGES = {
         "enter_delivery_time": "⏰ Yetkazib berish vaqtini kiriting (masalan, 'bugun 13:00' yoki 'ertaga 14:00'):",
         "invalid_delivery_time": "❌ Noto'g'ri vaqt formati. Iltimos, 'bugun HH:MM' yoki 'ertaga HH:MM' formatida kiriting.",
         "delivery_time_too_soon": f"❌ Vaqt {MIN_DELIVERY_TIME} daqiqadan kam bo'lmasligi kerak.",
+        "slot_full": "⏰ Bu vaqt hozirgina band bo'ldi. Iltimos, boshqa vaqtni tanlang.",
+        "slot_taken": "⏰ Bu vaqtga buyurtmalar to'lgan. Eng yaqin bo'sh vaqt: {time}",
         "cancel": "🚫 Bekor qilish",
         "choose_payment": "💳 To'lov turini tanlang:",
         "coins": "💰 Coinlar",
@@ -122,6 +203,7 @@ LANGUAGES = {
         "order_details": "📦 *Buyurtma*: {order_id}\n👤 Foydalanuvchi: {user_name}\n📞 Telefon: {phone}\n🏬 Do'kon: {store}\n🛍️ Mahsulotlar: {products}\n💳 To'lov: {payment}\n⏰ Yetkazib berish: {delivery}\n💵 Jami: {total} UZS (Yetkazib berish: {delivery_fee} UZS)",
         "confirm_order": "✅ Buyurtmani tasdiqlash",
         "no_products": "⚠️ Mahsulotlar topilmadi.",
+        "product_unavailable": "⚠️ Bu mahsulot endi mavjud emas.",
         "cart_empty": "🛒 Savat bo'sh.",
         "invalid_coin_amount": "❌ Iltimos, to'g'ri coin miqdorini kiriting (musbat raqam, masalan, 20.000 yoki 20000.000).",
         "error": "❌ Xatolik yuz berdi. Iltimos, qayta urinib ko'ring yoki admin bilan bog'laning: {support}",
@@ -151,6 +233,11 @@ LANGUAGES = {
         "main_menu": "🏠 *Main Menu*",
         "send_location": "📍 Send your location:",
         "choose_store": "🏬 Choose a Store:",
+        "store_option": "🏬 {name} — {distance} km, delivery {fee} UZS",
+        "no_open_stores": "😔 No stores are open near you right now. Please try again later.",
+        "outside_delivery_zone": "🚫 Sorry, we don't deliver to your location from this store.",
+        "below_min_order": "❗ The minimum order for {zone} is {min_order} UZS.",
+        "delivery_zone_info": "📍 {zone}: delivery in ~{eta} min",
         "choose_category": "📋 Choose a Category:",
         "add_to_cart": "➕ Add to Cart",
         "see_cart": "🛒 See Cart",
@@ -168,6 +255,8 @@ LANGUAGES = {
         "enter_delivery_time": "⏰ Enter delivery time (e.g., 'today 13:00' or 'tomorrow 14:00'):",
         "invalid_delivery_time": "❌ Invalid time format. Please enter 'today HH:MM' or 'tomorrow HH:MM'.",
         "delivery_time_too_soon": f"❌ Time must be at least {MIN_DELIVERY_TIME} minutes from now.",
+        "slot_full": "⏰ That delivery slot has just filled up. Please choose another time.",
+        "slot_taken": "⏰ That time is fully booked. The next free slot is {time}.",
         "cancel": "🚫 Cancel",
         "choose_payment": "💳 Choose Payment Method:",
         "coins": "💰 Coins",
@@ -206,6 +295,7 @@ LANGUAGES = {
         "order_details": "📦 *Order*: {order_id}\n👤 User: {user_name}\n📞 Phone: {phone}\n🏬 Store: {store}\n🛍️ Products: {products}\n💳 Payment: {payment}\n⏰ Delivery: {delivery}\n💵 Total: {total} UZS (Delivery: {delivery_fee} UZS)",
         "confirm_order": "✅ Confirm Order",
         "no_products": "⚠️ No products found.",
+        "product_unavailable": "⚠️ This product is no longer available.",
         "cart_empty": "🛒 Cart is empty.",
         "invalid_coin_amount": "❌ Please enter a valid coin amount (positive number, e.g., 20.000 or 20000.000).",
         "error": "❌ An error occurred. Please try again or contact admin: {support}",
@@ -235,6 +325,11 @@ LANGUAGES = {
         "main_menu": "🏠 *Главное меню*",
         "send_location": "📍 Отправьте ваше местоположение:",
         "choose_store": "🏬 Выберите магазин:",
+        "store_option": "🏬 {name} — {distance} км, доставка {fee} UZS",
+        "no_open_stores": "😔 Сейчас поблизости нет открытых магазинов. Попробуйте позже.",
+        "outside_delivery_zone": "🚫 К сожалению, из этого магазина нет доставки по вашему адресу.",
+        "below_min_order": "❗ Минимальная сумма заказа для зоны {zone}: {min_order} UZS.",
+        "delivery_zone_info": "📍 {zone}: доставка ~{eta} мин",
         "choose_category": "📋 Выберите категорию:",
         "add_to_cart": "➕ Добавить в корзину",
         "see_cart": "🛒 Посмотреть корзину",
@@ -252,6 +347,8 @@ LANGUAGES = {
         "enter_delivery_time": "⏰ Введите время доставки (например, 'сегодня 13:00' или 'завтра 14:00'):",
         "invalid_delivery_time": "❌ Неверный формат времени. Пожалуйста, введите 'сегодня HH:MM' или 'завтра HH:MM'.",
         "delivery_time_too_soon": f"❌ Время должно быть не менее {MIN_DELIVERY_TIME} минут от текущего.",
+        "slot_full": "⏰ Этот слот доставки только что заполнился. Пожалуйста, выберите другое время.",
+        "slot_taken": "⏰ На это время всё занято. Ближайший свободный слот: {time}.",
         "cancel": "🚫 Отмена",
         "choose_payment": "💳 Выберите способ оплаты:",
         "coins": "💰 Коины",
@@ -290,6 +387,7 @@ LANGUAGES = {
         "order_details": "📦 *Заказ*: {order_id}\n👤 Пользователь: {user_name}\n📞 Телефон: {phone}\n🏬 Магазин: {store}\n🛍️ Продукты: {products}\n💳 Оплата: {payment}\n⏰ Доставка: {delivery}\n💵 Итого: {total} UZS (Доставка: {delivery_fee} UZS)",
         "confirm_order": "✅ Подтвердить заказ",
         "no_products": "⚠️ Продукты не найдены.",
+        "product_unavailable": "⚠️ Этот товар больше недоступен.",
         "cart_empty": "🛒 Корзина пуста.",
         "invalid_coin_amount": "❌ Пожалуйста, введите действительное количество коинов (положительное число, например, 20.000 или 20000.000).",
         "error": "❌ Произошла ошибка. Пожалуйста, попробуйте снова или свяжитесь с администратором: {support}",
@@ -308,6 +406,776 @@ LANGUAGES = {
     }
 }
 
+# Search text normalization shared by the FTS index writes and search queries:
+# case-folds, drops Uzbek apostrophes (o‘, g‘, tutuq belgisi) and transliterates
+# Uzbek/Russian Cyrillic to Uzbek Latin, so "ўрик", "o'rik" and "ORIK" all match
+CYRILLIC_TO_LATIN = str.maketrans({
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ё": "yo", "ж": "j",
+    "з": "z", "и": "i", "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o",
+    "п": "p", "р": "r", "с": "s", "т": "t", "у": "u", "ф": "f", "х": "x", "ц": "ts",
+    "ч": "ch", "ш": "sh", "щ": "sh", "ъ": "", "ы": "i", "ь": "", "э": "e", "ю": "yu",
+    "я": "ya", "ў": "o", "қ": "q", "ғ": "g", "ҳ": "h",
+})
+APOSTROPHES_RE = re.compile(r"['`‘’ʻʼ]")
+SEARCH_TOKEN_RE = re.compile(r"\w+")
+
+def normalize_search_text(text):
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return APOSTROPHES_RE.sub("", text).translate(CYRILLIC_TO_LATIN)
+
+# Build an FTS5 MATCH expression: every token must match, as a prefix
+def build_search_query(text):
+    tokens = SEARCH_TOKEN_RE.findall(normalize_search_text(text))
+    return " ".join(f'"{token}"*' for token in tokens)
+
+# (Re)write a product's search index row. The bot calls this wherever it writes
+# a product; the triggers on products only remove rows, so they need no
+# application-defined function and any SQLite client can write products.
+def index_product_search(c, product_id, name, description, category):
+    c.execute("DELETE FROM products_fts WHERE rowid = ?", (product_id,))
+    c.execute("INSERT INTO products_fts (rowid, name, description, category) VALUES (?, ?, ?, ?)",
+              (product_id, normalize_search_text(name), normalize_search_text(description),
+               normalize_search_text(category)))
+
+# Index products that were added or changed outside the bot (admin scripts,
+# restores) and so have no search index row; returns how many were indexed
+def sync_search_index(c):
+    c.execute("SELECT id, name, description, category FROM products "
+              "WHERE id NOT IN (SELECT rowid FROM products_fts)")
+    rows = c.fetchall()
+    for row in rows:
+        index_product_search(c, *row)
+    return len(rows)
+
+# In-process metrics rendered in the Prometheus text format. Each metric has a
+# single label; observing is a dict lookup, a bisect over the bucket bounds
+# and two increments, always on the event loop thread. Gauges are computed
+# when the endpoint is scraped.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Histogram:
+    def __init__(self, name, documentation, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self.buckets = buckets
+        self._series = {}  # label value -> [count per bucket..., count above the last bucket, sum]
+
+    def observe(self, label_value, seconds):
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, seconds)] += 1
+        series[-1] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self._series.items()):
+            label = f'{self.label}="{escape_label(label_value)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            cumulative += series[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {series[-1]}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+class Counter:
+    def __init__(self, name, documentation, label):
+        self.name = name
+        self.documentation = documentation
+        self.label = label
+        self._values = {}
+
+    def inc(self, label_value, amount=1):
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for label_value, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{{{self.label}="{escape_label(label_value)}"}} {value}')
+        return lines
+
+# fn(application) returns the current value, sync or async
+class Gauge:
+    def __init__(self, name, documentation, fn):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+
+    async def value(self, application):
+        value = self.fn(application)
+        return await value if asyncio.iscoroutine(value) else value
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+        self._gauges = []
+        self._runner = None
+
+    def histogram(self, name, documentation, label):
+        metric = Histogram(name, documentation, label)
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label):
+        metric = Counter(name, documentation, label)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, fn):
+        self._gauges.append(Gauge(name, documentation, fn))
+
+    async def render(self, application):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for gauge in self._gauges:
+            try:
+                value = await gauge.value(application)
+            except Exception as e:
+                logger.error(f"Failed to compute gauge {gauge.name}: {e}")
+                continue
+            lines.extend([f"# HELP {gauge.name} {gauge.documentation}", f"# TYPE {gauge.name} gauge",
+                          f"{gauge.name} {value}"])
+        return "\n".join(lines) + "\n"
+
+    async def start(self, application, listen=METRICS_LISTEN, port=METRICS_PORT):
+        async def handle_metrics(request):
+            return web.Response(text=await self.render(application), content_type="text/plain",
+                                headers={"X-Content-Type-Options": "nosniff"})
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, listen, port).start()
+        logger.info(f"Metrics available on http://{listen}:{port}/metrics")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+metrics = MetricsRegistry()
+update_latency = metrics.histogram("bot_update_duration_seconds", "Time spent handling an update, by update type.", "type")
+callback_latency = metrics.histogram("bot_callback_duration_seconds", "Time spent in a callback route handler.", "route")
+message_states = metrics.counter("bot_message_state_total", "Text messages handled, by conversation state.", "state")
+sql_latency = metrics.histogram("bot_sql_duration_seconds", "Database call latency including pool wait, by statement.", "statement")
+api_latency = metrics.histogram("bot_api_request_duration_seconds", "Bot API request latency, by method.", "method")
+api_errors = metrics.counter("bot_api_errors_total", "Failed Bot API requests, by method.", "method")
+screen_renders = metrics.counter("bot_screen_renders_total", "Navigation screens rendered, by how they reached the chat.", "outcome")
+
+# "select products" style labels for ad-hoc statements; cached per SQL string
+SQL_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+(\w+)", re.IGNORECASE)
+_sql_labels = {}
+
+def sql_label(sql):
+    label = _sql_labels.get(sql)
+    if label is None:
+        table = SQL_TABLE_RE.search(sql)
+        label = _sql_labels[sql] = f"{sql.split(None, 1)[0].lower()} {table.group(1) if table else ''}".strip()
+    return label
+
+def update_type(update):
+    if not isinstance(update, Update):
+        return "other"
+    if update.callback_query:
+        return "callback_query"
+    message = update.message
+    if message is None:
+        return "other"
+    if message.location:
+        return "location"
+    if message.photo:
+        return "photo"
+    if message.text:
+        return "command" if message.text.startswith("/") else "text"
+    return "other"
+
+# Database access layer: a small pool of long-lived connections driven from a
+# dedicated executor, so handlers await queries instead of blocking the event loop
+class Database:
+    def __init__(self, path, pool_size):
+        self.path = path
+        self.pool_size = pool_size
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="db")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.create_function("normalize_search_text", 1, normalize_search_text, deterministic=True)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                return self._connect()
+        return self._pool.get()
+
+    def run_sync(self, fn, *args):
+        conn = self._acquire()
+        try:
+            with conn:
+                return fn(conn.cursor(), *args)
+        finally:
+            self._pool.put(conn)
+
+    # Run fn(cursor, *args) in one transaction on a pooled connection; timed
+    # under label, or the function's name
+    async def run(self, fn, *args, label=None):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, self.run_sync, fn, *args)
+        finally:
+            sql_latency.observe(label or fn.__name__, time.perf_counter() - started)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda c: c.execute(sql, params).fetchone(), label=sql_label(sql))
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda c: c.execute(sql, params).fetchall(), label=sql_label(sql))
+
+    # Execute a single write statement and return the cursor's lastrowid
+    async def execute(self, sql, params=()):
+        return await self.run(lambda c: c.execute(sql, params).lastrowid, label=sql_label(sql))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+        self._created = 0
+
+db = Database(DB_PATH, DB_POOL_SIZE)
+
+# Bounded LRU cache of user profiles (language, name, phone, coins) so the click
+# path doesn't hit the database for the language lookup. Unregistered users are
+# cached as None; every write to a user's row must invalidate the entry.
+class UserProfileCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._profiles = OrderedDict()
+        self._invalidations = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, user_id):
+        if user_id in self._profiles:
+            self.hits += 1
+            self._profiles.move_to_end(user_id)
+            return self._profiles[user_id]
+        self.misses += 1
+        invalidations = self._invalidations
+        row = await db.fetchone("SELECT language, name, phone, coins FROM users WHERE user_id = ?", (user_id,))
+        profile = {"language": row[0], "name": row[1], "phone": row[2], "coins": row[3]} if row else None
+        # Don't cache a row that may have been invalidated while it was being read
+        if invalidations != self._invalidations:
+            return profile
+        self._profiles[user_id] = profile
+        if len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+        return profile
+
+    def invalidate(self, user_id):
+        self._invalidations += 1
+        self._profiles.pop(user_id, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._profiles),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+user_cache = UserProfileCache(USER_CACHE_SIZE)
+
+Product = namedtuple("Product", "id name description image price category store_id")
+
+# In-memory catalog index: store -> category -> products ordered by id, plus a
+# by-ID map. Loaded once and rebuilt lazily whenever the catalog version is
+# bumped by an admin adding or deleting a product, so browsing costs no SQL.
+# Pages are keyset-paginated: a page starts after a cursor (last category name
+# or product id seen) located by binary search, never by skipping an offset.
+class CatalogIndex:
+    def __init__(self):
+        self.version = 0
+        self._loaded_version = None
+        self._lock = asyncio.Lock()
+        self._by_store = {}
+        self._category_names = {}
+        self._by_id = {}
+
+    def invalidate(self):
+        self.version += 1
+
+    async def ensure_loaded(self):
+        if self._loaded_version == self.version:
+            return
+        async with self._lock:
+            if self._loaded_version == self.version:
+                return
+            version = self.version
+            rows = await db.fetchall(SQL_LOAD_CATALOG)
+            by_store = {}
+            by_id = {}
+            for row in rows:
+                product = Product(*row)
+                by_id[product.id] = product
+                by_store.setdefault(product.store_id, {}).setdefault(product.category, []).append(product)
+            self._by_store = by_store
+            self._category_names = {store_id: sorted(categories) for store_id, categories in by_store.items()}
+            self._by_id = by_id
+            self._loaded_version = version
+            logger.info(f"Catalog index v{version} loaded: {len(by_id)} products")
+
+    # Up to limit + 1 category names sorted after the cursor; the extra one tells
+    # the caller whether another page exists
+    async def categories_page(self, store_id, after=None, limit=ITEMS_PER_BATCH):
+        await self.ensure_loaded()
+        names = self._category_names.get(store_id, [])
+        start = bisect_right(names, after) if after is not None else 0
+        return names[start:start + limit + 1]
+
+    # Up to limit + 1 products of a category with an id greater than the cursor
+    async def products_page(self, store_id, category, after_id=None, limit=ITEMS_PER_BATCH):
+        await self.ensure_loaded()
+        products = self._by_store.get(store_id, {}).get(category, [])
+        start = bisect_right(products, after_id, key=lambda p: p.id) if after_id is not None else 0
+        return products[start:start + limit + 1]
+
+    async def products(self, store_id, category=None):
+        await self.ensure_loaded()
+        categories = self._by_store.get(store_id, {})
+        if category is not None:
+            return categories.get(category, [])
+        return sorted((p for products in categories.values() for p in products), key=lambda p: p.id)
+
+    async def get(self, product_id):
+        await self.ensure_loaded()
+        return self._by_id.get(int(product_id))
+
+    # Products for the given IDs in id order, skipping ones that no longer exist
+    async def lookup(self, product_ids):
+        await self.ensure_loaded()
+        products = (self._by_id.get(int(pid)) for pid in product_ids)
+        return sorted((p for p in products if p), key=lambda p: p.id)
+
+catalog = CatalogIndex()
+
+# Money is handled in integer minor units, thousandths of a sum (the precision
+# prices are shown with), so totals add up exactly. Prices and coins stay REAL
+# in the database and are converted at the edges.
+MONEY_SCALE = 1000
+
+def to_minor(amount):
+    return round(float(amount) * MONEY_SCALE)
+
+def format_money(minor):
+    return '{:.3f}'.format(minor / MONEY_SCALE)
+
+# A subtotal less a percentage discount, rounded to a whole minor unit
+def apply_discount(subtotal, percent):
+    return subtotal - round(subtotal * float(percent) / 100)
+
+CartLine = namedtuple("CartLine", "product_id name quantity unit_price")
+
+# A user's cart: line items with the price each product had in the catalog
+# (unit_price in minor units) and a subtotal kept up to date on add and remove,
+# so reading totals costs nothing. The price snapshot belongs to the catalog
+# version it was taken at; once an admin changes the catalog, refresh()
+# reprices the lines and drops products that are gone. Only quantities are
+# persisted, in the {product id: quantity} shape carts have always had, and a
+# restored cart is repriced on first use.
+class Cart:
+    __slots__ = ("lines", "subtotal", "version", "revision")
+    # Revisions are unique across carts, so a quote never matches a new cart
+    _revisions = itertools.count(1)
+
+    def __init__(self, quantities=None):
+        self.lines = {}
+        self.subtotal = 0
+        self.version = None
+        self.revision = next(Cart._revisions)
+        for product_id, quantity in (quantities or {}).items():
+            self.lines[int(product_id)] = CartLine(int(product_id), None, quantity, 0)
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __contains__(self, product_id):
+        return product_id in self.lines
+
+    def __eq__(self, other):
+        return isinstance(other, Cart) and self.to_dict() == other.to_dict()
+
+    def to_dict(self):
+        return {str(product_id): line.quantity for product_id, line in self.lines.items()}
+
+    async def refresh(self):
+        if self.version == catalog.version:
+            return
+        version = catalog.version
+        products = {p.id: p for p in await catalog.lookup(self.lines)}
+        lines = {}
+        for product_id, line in self.lines.items():
+            product = products.get(product_id)
+            if product:
+                lines[product_id] = CartLine(product_id, product.name, line.quantity, to_minor(product.price))
+        self.lines = lines
+        self.subtotal = sum(line.quantity * line.unit_price for line in lines.values())
+        self.version = version
+        self.revision = next(Cart._revisions)
+
+    # Returns False when the product no longer exists
+    async def add(self, product_id, quantity=1):
+        await self.refresh()
+        line = self.lines.get(product_id)
+        if line is None:
+            product = await catalog.get(product_id)
+            if product is None:
+                return False
+            line = CartLine(product.id, product.name, 0, to_minor(product.price))
+        self.lines[product_id] = line._replace(quantity=line.quantity + quantity)
+        self.subtotal += quantity * line.unit_price
+        self.revision = next(Cart._revisions)
+        return True
+
+    def remove(self, product_id):
+        line = self.lines.pop(product_id, None)
+        if line:
+            self.subtotal -= line.quantity * line.unit_price
+            self.revision = next(Cart._revisions)
+        return line is not None
+
+    # Current lines, repriced first if the catalog changed
+    async def items(self):
+        await self.refresh()
+        return list(self.lines.values())
+
+CheckoutQuote = namedtuple("CheckoutQuote",
+                           "items subtotal promo_code discount delivery_fee total catalog_version cart_revision expires_at")
+
+# Checkout pricing. A quote is built once, when the customer enters a promo
+# code, and is immutable: choosing the delivery time, the payment and placing
+# the order reuse it while the catalog version, cart revision, promo code and
+# delivery fee still match and it has not expired, instead of reading the promo
+# and recomputing the total at every step. The promo use itself is reserved in
+# the order's transaction (see submit_order).
+class CheckoutQuotes:
+    def __init__(self):
+        self.built = 0
+        self.reused = 0
+        self.rejected = 0
+
+    @staticmethod
+    def promo_code(session):
+        code = session.promo_code
+        return code.upper() if code and code.lower() != "skip" else None
+
+    # None when the promo code is unknown or used up
+    async def build(self, session):
+        cart = session.cart
+        await cart.refresh()
+        code = self.promo_code(session)
+        discount = 0
+        if code:
+            promo = await db.fetchone("SELECT discount, usage_count, max_uses FROM promo_codes WHERE code = ?", (code,))
+            if not promo or promo[1] >= promo[2]:
+                self.rejected += 1
+                return None
+            discount = promo[0]
+        self.built += 1
+        return CheckoutQuote(tuple(cart.lines.values()), cart.subtotal, code, discount, session.delivery_fee,
+                             apply_discount(cart.subtotal, discount) + session.delivery_fee,
+                             cart.version, cart.revision, time.time() + QUOTE_TTL)
+
+    # The session's quote if it still holds, otherwise a new one stored in its place
+    async def current(self, session):
+        quote = session.quote
+        if (quote and quote.expires_at > time.time() and quote.catalog_version == catalog.version
+                and quote.cart_revision == session.cart.revision and quote.delivery_fee == session.delivery_fee
+                and quote.promo_code == self.promo_code(session)):
+            self.reused += 1
+            return quote
+        session.quote = await self.build(session)
+        return session.quote
+
+    def stats(self):
+        return {"built": self.built, "reused": self.reused, "rejected": self.rejected}
+
+checkout_quotes = CheckoutQuotes()
+
+# Store locations from the stores table, cached as parallel arrays with the
+# trigonometry precomputed, so ranking a location against every branch is one
+# pass over the arrays with no SQL per click. open_time/close_time are "HH:MM"
+# (NULL means always open; close before open wraps past midnight).
+class StoreIndex:
+    EARTH_RADIUS_KM = 6371
+
+    def __init__(self):
+        self.version = 0
+        self._loaded_version = None
+        self._lock = asyncio.Lock()
+        self._ids = array("q")
+        self._lat = array("d")
+        self._lon = array("d")
+        self._cos_lat = array("d")
+        self._names = []
+        self._hours = []
+        self._position = {}
+
+    def invalidate(self):
+        self.version += 1
+
+    async def ensure_loaded(self):
+        if self._loaded_version == self.version:
+            return
+        async with self._lock:
+            if self._loaded_version == self.version:
+                return
+            version = self.version
+            rows = await db.fetchall("SELECT id, name, latitude, longitude, open_time, close_time FROM stores ORDER BY id")
+            self._ids = array("q", (row[0] for row in rows))
+            self._lat = array("d", (radians(row[2]) for row in rows))
+            self._lon = array("d", (radians(row[3]) for row in rows))
+            self._cos_lat = array("d", (cos(lat) for lat in self._lat))
+            self._names = [row[1] for row in rows]
+            self._hours = [(parse_store_time(row[4]), parse_store_time(row[5])) for row in rows]
+            self._position = {store_id: i for i, store_id in enumerate(self._ids)}
+            self._loaded_version = version
+            logger.info(f"Store index v{version} loaded: {len(rows)} stores")
+
+    def _is_open(self, i, minute_of_day):
+        opens, closes = self._hours[i]
+        if opens is None or closes is None:
+            return True
+        if opens <= closes:
+            return opens <= minute_of_day < closes
+        return minute_of_day >= opens or minute_of_day < closes
+
+    # Up to limit open stores nearest to the location as (id, name, distance_km)
+    async def nearest(self, latitude, longitude, limit=NEAREST_STORES):
+        await self.ensure_loaded()
+        lat, lon = radians(latitude), radians(longitude)
+        cos_lat = cos(lat)
+        distances = [
+            2 * self.EARTH_RADIUS_KM * asin(sqrt(min(1.0, sin((s_lat - lat) / 2) ** 2 + cos_lat * s_cos * sin((s_lon - lon) / 2) ** 2)))
+            for s_lat, s_lon, s_cos in zip(self._lat, self._lon, self._cos_lat)
+        ]
+        now = datetime.now(UZBEKISTAN_TZ)
+        minute_of_day = now.hour * 60 + now.minute
+        open_stores = (i for i in range(len(distances)) if self._is_open(i, minute_of_day))
+        return [(self._ids[i], self._names[i], distances[i])
+                for i in heapq.nsmallest(limit, open_stores, key=distances.__getitem__)]
+
+    # Distance from the location to one store, or None for an unknown store
+    async def distance_km(self, store_id, latitude, longitude):
+        await self.ensure_loaded()
+        i = self._position.get(store_id)
+        if i is None:
+            return None
+        lat, lon = radians(latitude), radians(longitude)
+        a = sin((self._lat[i] - lat) / 2) ** 2 + cos(lat) * self._cos_lat[i] * sin((self._lon[i] - lon) / 2) ** 2
+        return 2 * self.EARTH_RADIUS_KM * asin(sqrt(min(1.0, a)))
+
+def parse_store_time(value):
+    if not value:
+        return None
+    hours, minutes = map(int, value.split(":"))
+    return hours * 60 + minutes
+
+stores_index = StoreIndex()
+
+# Delivery zones: admin-defined polygons with a flat fee, minimum order and ETA,
+# optionally tied to one store. Where a store has zones, an address outside all
+# of them gets no delivery; a store without zones keeps distance-based pricing.
+# Overlapping zones resolve to the smallest one, so district rates can sit
+# inside a city-wide zone. Lookups go through a grid of ZONE_GRID_CELL cells
+# built once per zone change: cells an edge passes through keep their candidate
+# zones for an exact point-in-polygon test, interior cells answer directly.
+DeliveryZone = namedtuple("DeliveryZone", "id store_id name fee min_order eta_minutes polygon area")
+
+def point_in_polygon(polygon, lat, lon):
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        lat_i, lon_i = polygon[i]
+        lat_j, lon_j = polygon[j]
+        if (lat_i > lat) != (lat_j > lat) and lon < (lon_j - lon_i) * (lat - lat_i) / (lat_j - lat_i) + lon_i:
+            inside = not inside
+        j = i
+    return inside
+
+def polygon_area(polygon):
+    return abs(sum(polygon[i - 1][1] * polygon[i][0] - polygon[i][1] * polygon[i - 1][0] for i in range(len(polygon)))) / 2
+
+# Liang-Barsky clip: does the segment touch the rectangle?
+def segment_hits_rect(lat1, lon1, lat2, lon2, min_lat, min_lon, max_lat, max_lon):
+    t0, t1 = 0.0, 1.0
+    d_lat, d_lon = lat2 - lat1, lon2 - lon1
+    for p, q in ((-d_lon, lon1 - min_lon), (d_lon, max_lon - lon1), (-d_lat, lat1 - min_lat), (d_lat, max_lat - lat1)):
+        if p == 0:
+            if q < 0:
+                return False
+        else:
+            t = q / p
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+            if t0 > t1:
+                return False
+    return True
+
+def parse_zone_polygon(text):
+    polygon = []
+    for point in text.split(";"):
+        lat, lon = (float(value) for value in point.split(","))
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError(f"Coordinate out of range: {point}")
+        polygon.append((lat, lon))
+    if len(polygon) < 3:
+        raise ValueError("A zone needs at least three points")
+    return polygon
+
+def build_zone_grid(zones, cell):
+    cells = {}
+    for zone in zones:
+        polygon = zone.polygon
+        edges = [(polygon[i - 1], polygon[i]) for i in range(len(polygon))]
+        boundary = set()
+        for (lat1, lon1), (lat2, lon2) in edges:
+            for row in range(floor(min(lat1, lat2) / cell), floor(max(lat1, lat2) / cell) + 1):
+                for col in range(floor(min(lon1, lon2) / cell), floor(max(lon1, lon2) / cell) + 1):
+                    if segment_hits_rect(lat1, lon1, lat2, lon2, row * cell, col * cell, (row + 1) * cell, (col + 1) * cell):
+                        boundary.add((row, col))
+        for key in boundary:
+            cells.setdefault(key, []).append((zone.area, zone, True))
+        # Scanline fill at each row's centre latitude for cells no edge touches
+        lats = [point[0] for point in polygon]
+        for row in range(floor(min(lats) / cell), floor(max(lats) / cell) + 1):
+            y = (row + 0.5) * cell
+            crossings = sorted(
+                lon1 + (y - lat1) * (lon2 - lon1) / (lat2 - lat1)
+                for (lat1, lon1), (lat2, lon2) in edges if (lat1 > y) != (lat2 > y)
+            )
+            for start, end in zip(crossings[::2], crossings[1::2]):
+                for col in range(floor(start / cell), floor(end / cell) + 1):
+                    centre = (col + 0.5) * cell
+                    if start <= centre <= end and (row, col) not in boundary:
+                        cells.setdefault((row, col), []).append((zone.area, zone, False))
+    for entries in cells.values():
+        entries.sort(key=lambda entry: entry[0])
+    return cells
+
+class DeliveryZoneIndex:
+    def __init__(self, cell=ZONE_GRID_CELL):
+        self.cell = cell
+        self.version = 0
+        self._loaded_version = None
+        self._lock = asyncio.Lock()
+        self._zones = []
+        self._grid = {}
+        self._zoned_stores = set()
+        self._global_zones = False
+
+    def invalidate(self):
+        self.version += 1
+
+    async def ensure_loaded(self):
+        if self._loaded_version == self.version:
+            return
+        async with self._lock:
+            if self._loaded_version == self.version:
+                return
+            version = self.version
+            rows = await db.fetchall("SELECT id, store_id, name, fee, min_order, eta_minutes, polygon FROM delivery_zones ORDER BY id")
+            zones = []
+            for zone_id, store_id, name, fee, min_order, eta_minutes, polygon in rows:
+                points = [tuple(point) for point in json.loads(polygon)]
+                zones.append(DeliveryZone(zone_id, store_id, name, fee, min_order, eta_minutes, points, polygon_area(points)))
+            grid = await asyncio.get_running_loop().run_in_executor(None, build_zone_grid, zones, self.cell)
+            self._zones = zones
+            self._grid = grid
+            self._zoned_stores = {zone.store_id for zone in zones if zone.store_id is not None}
+            self._global_zones = any(zone.store_id is None for zone in zones)
+            self._loaded_version = version
+            logger.info(f"Delivery zones v{version} loaded: {len(zones)} zones, {len(grid)} grid cells")
+
+    async def zones(self, store_id):
+        await self.ensure_loaded()
+        return [zone for zone in self._zones if zone.store_id in (None, store_id)]
+
+    def has_zones(self, store_id):
+        return self._global_zones or store_id in self._zoned_stores
+
+    # The smallest zone of the store containing the point, or None. Needs
+    # ensure_loaded(); safe to call from a worker thread for batch evaluation.
+    def lookup(self, store_id, lat, lon):
+        for _, zone, exact in self._grid.get((floor(lat / self.cell), floor(lon / self.cell)), ()):
+            if zone.store_id not in (None, store_id):
+                continue
+            if not exact or point_in_polygon(zone.polygon, lat, lon):
+                return zone
+        return None
+
+    # (fee, zone, deliverable) for delivering an order from store_id to location
+    async def quote(self, store_id, location):
+        await self.ensure_loaded()
+        if not self.has_zones(store_id):
+            distance_km = await stores_index.distance_km(store_id, location["latitude"], location["longitude"])
+            return (delivery_fee_for(distance_km) if distance_km is not None else 0.0), None, True
+        zone = self.lookup(store_id, location["latitude"], location["longitude"])
+        if zone is None:
+            return 0.0, None, False
+        return zone.fee, zone, True
+
+    # Orders and revenue per zone over every order with a location, for admins
+    async def order_report(self):
+        await self.ensure_loaded()
+        def _zone_report(c):
+            c.execute("""
+                SELECT o.store_id, o.latitude, o.longitude, COALESCE(SUM(i.quantity * i.unit_price), 0)
+                FROM orders o LEFT JOIN order_items i ON i.order_id = o.order_id
+                WHERE o.latitude IS NOT NULL AND o.longitude IS NOT NULL
+                GROUP BY o.order_id
+            """)
+            report = {}
+            for store_id, lat, lon, revenue in c:
+                zone = self.lookup(store_id, lat, lon) if self.has_zones(store_id) else None
+                key = zone.name if zone else ("Outside zones" if self.has_zones(store_id) else "Distance pricing")
+                stats = report.setdefault(key, [0, 0.0])
+                stats[0] += 1
+                stats[1] += revenue
+            return report
+        return await db.run(_zone_report)
+
+delivery_zones = DeliveryZoneIndex()
+
 # Helper function to log products to text files
 def log_product_to_file(product_data):
     store_id = product_data["store_id"]
@@ -327,82 +1195,247 @@ def log_product_to_file(product_data):
     except Exception as e:
         logger.error(f"Failed to write product to {file_name}: {e}")
 
-# Initialize database
-def init_db():
-    conn = sqlite3.connect("store_bot.db")
-    try:
-        c = conn.cursor()
-        # Drop and recreate coin_requests table
-        c.execute("DROP TABLE IF EXISTS coin_requests")
-        # Create tables
-        c.execute('''CREATE TABLE IF NOT EXISTS stores
-                     (id INTEGER PRIMARY KEY, name TEXT, latitude REAL, longitude REAL)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS products
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, description TEXT,
-                      image TEXT, price REAL, category TEXT, store_id INTEGER)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS users
-                     (user_id INTEGER PRIMARY KEY, name TEXT, phone TEXT, language TEXT, coins REAL DEFAULT 0)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS orders
-                     (order_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, store_id INTEGER,
-                      products TEXT, delivery_time TEXT, payment_type TEXT, status TEXT, promo_code TEXT,
-                      latitude REAL, longitude REAL, created_at TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS coin_requests
-                     (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, status TEXT,
-                      receipt_file_id TEXT, created_at TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS promo_codes
-                     (code TEXT PRIMARY KEY, discount REAL, usage_count INTEGER DEFAULT 0, max_uses INTEGER)''')
-        # Add missing columns if they don't exist
-        try:
-            c.execute("ALTER TABLE orders ADD COLUMN latitude REAL")
-        except sqlite3.OperationalError:
-            pass
-        try:
-            c.execute("ALTER TABLE orders ADD COLUMN longitude REAL")
-        except sqlite3.OperationalError:
-            pass
-        try:
-            c.execute("ALTER TABLE orders ADD COLUMN created_at TEXT")
-        except sqlite3.OperationalError:
-            pass
-        # Insert sample stores
-        c.execute("INSERT OR REPLACE INTO stores (id, name, latitude, longitude) VALUES (?, ?, ?, ?)",
-                  (1, "Tsum", 41.3111, 69.2797))
-        c.execute("INSERT OR REPLACE INTO stores (id, name, latitude, longitude) VALUES (?, ?, ?, ?)",
-                  (2, "Sergeli", 41.2275, 69.2514))
-        # Insert sample products
+# Schema migrations. Each migration runs once, in order, inside its own
+# transaction; the number of applied migrations is stored in PRAGMA user_version.
+# Migrations must stay idempotent because databases created before the runner
+# existed start at version 0 with most tables already present.
+def add_column_if_missing(c, table, column, definition):
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in [row[1] for row in c.fetchall()]:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def migrate_base_schema(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS stores
+                 (id INTEGER PRIMARY KEY, name TEXT, latitude REAL, longitude REAL)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS products
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, description TEXT,
+                  image TEXT, price REAL, category TEXT, store_id INTEGER)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS users
+                 (user_id INTEGER PRIMARY KEY, name TEXT, phone TEXT, language TEXT, coins REAL DEFAULT 0)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS orders
+                 (order_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, store_id INTEGER,
+                  products TEXT, delivery_time TEXT, payment_type TEXT, status TEXT, promo_code TEXT,
+                  latitude REAL, longitude REAL, created_at TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS coin_requests
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, amount REAL, status TEXT,
+                  receipt_file_id TEXT, created_at TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS promo_codes
+                 (code TEXT PRIMARY KEY, discount REAL, usage_count INTEGER DEFAULT 0, max_uses INTEGER)''')
+    add_column_if_missing(c, "orders", "latitude", "REAL")
+    add_column_if_missing(c, "orders", "longitude", "REAL")
+    add_column_if_missing(c, "orders", "created_at", "TEXT")
+    # Sample stores and products
+    c.executemany("INSERT OR REPLACE INTO stores (id, name, latitude, longitude) VALUES (?, ?, ?, ?)",
+                  [(1, "Tsum", 41.3111, 69.2797), (2, "Sergeli", 41.2275, 69.2514)])
+    c.execute("SELECT COUNT(*) FROM products")
+    if c.fetchone()[0] == 0:
         sample_products = [
             ("Cream A", "Moisturizing cream A", None, 15.0, "cream", 1),
             ("Cream B", "Moisturizing cream B", None, 18.0, "cream", 1),
             ("Cream C", "Moisturizing cream C", None, 20.0, "cream", 1),
         ]
-        c.executemany("INSERT OR IGNORE INTO products (name, description, image, price, category, store_id) VALUES (?, ?, ?, ?, ?, ?)",
+        c.executemany("INSERT INTO products (name, description, image, price, category, store_id) VALUES (?, ?, ?, ?, ?, ?)",
                       sample_products)
-        conn.commit()
+
+# Full-text search index over products, kept in sync by triggers; rowid is the product id
+def migrate_product_search(c):
+    c.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS products_fts
+                 USING fts5(name, description, category, tokenize='unicode61 remove_diacritics 2', prefix='2 3')''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products BEGIN
+                     INSERT INTO products_fts (rowid, name, description, category)
+                     VALUES (new.id, normalize_search_text(new.name), normalize_search_text(new.description),
+                             normalize_search_text(new.category));
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products BEGIN
+                     DELETE FROM products_fts WHERE rowid = old.id;
+                 END''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE ON products BEGIN
+                     DELETE FROM products_fts WHERE rowid = old.id;
+                     INSERT INTO products_fts (rowid, name, description, category)
+                     VALUES (new.id, normalize_search_text(new.name), normalize_search_text(new.description),
+                             normalize_search_text(new.category));
+                 END''')
+    c.execute("DELETE FROM products_fts")
+    c.execute('''INSERT INTO products_fts (rowid, name, description, category)
+                 SELECT id, normalize_search_text(name), normalize_search_text(description),
+                        normalize_search_text(category)
+                 FROM products''')
+
+# Composite indexes for the access paths the handlers and jobs use
+def migrate_hot_query_indexes(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders (user_id, order_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_products_store_category ON products (store_id, category, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_coin_requests_user_status ON coin_requests (user_id, status)")
+
+# Structured order lines; orders.products keeps the rendered text for old readers.
+# name is a snapshot so history survives product deletion.
+def migrate_order_items(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS order_items
+                 (order_id INTEGER NOT NULL, product_id INTEGER NOT NULL, name TEXT,
+                  quantity INTEGER NOT NULL, unit_price REAL NOT NULL,
+                  PRIMARY KEY (order_id, product_id))''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_order_items_product ON order_items (product_id, quantity, unit_price)")
+
+# Notifications written in the same transaction as the order or coin request
+# they announce, delivered afterwards by NotificationOutbox
+def migrate_notification_outbox(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS notification_outbox
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, text TEXT, photo TEXT,
+                  keyboard TEXT, status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,
+                  next_attempt_at REAL NOT NULL, last_error TEXT, created_at TEXT, sent_at TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_status_due ON notification_outbox (status, next_attempt_at)")
+
+# Per-user context.user_data snapshots written by SessionPersistence
+def migrate_sessions(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS sessions
+                 (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)''')
+
+# Cancellation notices share the outbox with admin alerts but are sent at bulk priority
+def migrate_outbox_priority(c):
+    add_column_if_missing(c, "notification_outbox", "priority", "INTEGER NOT NULL DEFAULT 1")
+
+# Opening hours for nearest-store selection; NULL keeps a store always open
+def migrate_store_hours(c):
+    add_column_if_missing(c, "stores", "open_time", "TEXT")
+    add_column_if_missing(c, "stores", "close_time", "TEXT")
+
+# Admin-defined delivery polygons; polygon is a JSON list of [lat, lon] points
+def migrate_delivery_zones(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS delivery_zones
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT, store_id INTEGER, name TEXT NOT NULL, fee REAL NOT NULL,
+                  min_order REAL NOT NULL DEFAULT 0, eta_minutes INTEGER NOT NULL, polygon TEXT NOT NULL)''')
+
+# Per-store, per-slot delivery reservations; slot is the local start time
+def migrate_delivery_slots(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS delivery_slots
+                 (store_id INTEGER NOT NULL, slot TEXT NOT NULL, reserved INTEGER NOT NULL DEFAULT 0,
+                  PRIMARY KEY (store_id, slot))''')
+    add_column_if_missing(c, "stores", "slot_capacity", "INTEGER")
+    add_column_if_missing(c, "orders", "delivery_slot", "TEXT")
+
+# Search index triggers without normalize_search_text(), which exists only on the
+# bot's connections: inserts are indexed by the bot (index_product_search) or at
+# startup (sync_search_index); an update drops the stale row to be re-indexed
+def migrate_search_triggers(c):
+    c.execute("DROP TRIGGER IF EXISTS products_fts_insert")
+    c.execute("DROP TRIGGER IF EXISTS products_fts_update")
+    c.execute('''CREATE TRIGGER products_fts_update AFTER UPDATE ON products BEGIN
+                     DELETE FROM products_fts WHERE rowid = old.id;
+                 END''')
+
+MIGRATIONS = [
+    migrate_base_schema,
+    migrate_product_search,
+    migrate_hot_query_indexes,
+    migrate_order_items,
+    migrate_notification_outbox,
+    migrate_sessions,
+    migrate_outbox_priority,
+    migrate_store_hours,
+    migrate_delivery_zones,
+    migrate_delivery_slots,
+    migrate_search_triggers,
+]
+
+# SQL run on the hot path. The handlers and jobs use these constants and
+# HOT_QUERIES checks the same strings, so the plan check can't drift from the code.
+SQL_MY_ORDERS = "SELECT order_id, products, delivery_time, status FROM orders WHERE user_id = ?"
+SQL_MY_ORDER_ITEMS = ("SELECT order_id, name, quantity, unit_price FROM order_items WHERE order_id IN "
+                      "(SELECT order_id FROM orders WHERE user_id = ?) ORDER BY order_id")
+SQL_CANCEL_OVERDUE_ORDERS = ("UPDATE orders SET status = 'cancelled' WHERE status = 'pending' AND created_at <= ? "
+                             "RETURNING order_id, user_id, store_id, delivery_slot")
+SQL_PENDING_ORDERS = "SELECT order_id, created_at FROM orders WHERE status = 'pending'"
+SQL_PENDING_COIN_REQUEST = "SELECT id FROM coin_requests WHERE user_id = ? AND status = 'pending'"
+SQL_PRODUCT_SALES = "SELECT COUNT(*), SUM(quantity), SUM(quantity * unit_price) FROM order_items WHERE product_id = ?"
+SQL_LOAD_SESSION = "SELECT data FROM sessions WHERE user_id = ?"
+SQL_OUTBOX_DUE = ("SELECT id, chat_id, text, photo, keyboard, attempts, priority FROM notification_outbox "
+                  "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY priority, next_attempt_at LIMIT ?")
+SQL_LOAD_CATALOG = "SELECT id, name, description, image, price, category, store_id FROM products ORDER BY id"
+
+# Queries on the hot path that must be answered through an index
+HOT_QUERIES = {
+    "my_orders": (SQL_MY_ORDERS, (0,)),
+    "order_items": (SQL_MY_ORDER_ITEMS, (0,)),
+    "order_timeout": (SQL_CANCEL_OVERDUE_ORDERS, ("",)),
+    "pending_orders": (SQL_PENDING_ORDERS, ()),
+    "pending_coin_request": (SQL_PENDING_COIN_REQUEST, (0,)),
+    "product_sales": (SQL_PRODUCT_SALES, (0,)),
+    "session": (SQL_LOAD_SESSION, (0,)),
+    "outbox_due": (SQL_OUTBOX_DUE, (0, 1)),
+}
+
+# Whole-table loads behind the in-memory indexes: they scan by design, but must
+# read in key order instead of sorting the table
+FULL_LOAD_QUERIES = {
+    "catalog": (SQL_LOAD_CATALOG, ()),
+}
+
+# Return {name: plan details} for every hot query that falls back to a full
+# table scan, and every full load that needs a sort
+def find_unindexed_queries(c):
+    unindexed = {}
+    for name, (sql, params) in HOT_QUERIES.items():
+        c.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        details = [row[3] for row in c.fetchall()]
+        if any(d.startswith("SCAN ") and " USING " not in d for d in details):
+            unindexed[name] = details
+    for name, (sql, params) in FULL_LOAD_QUERIES.items():
+        c.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        details = [row[3] for row in c.fetchall()]
+        if any(d.startswith("USE TEMP B-TREE") for d in details):
+            unindexed[name] = details
+    return unindexed
+
+def connect_for_migrations(path):
+    conn = sqlite3.connect(path)
+    conn.create_function("normalize_search_text", 1, normalize_search_text, deterministic=True)
+    return conn
+
+# Initialize database: apply pending migrations, then index products written
+# outside the bot since the last start
+def init_db(path=DB_PATH):
+    conn = connect_for_migrations(path)
+    try:
+        c = conn.cursor()
+        c.execute("PRAGMA user_version")
+        version = c.fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            c.execute("BEGIN")
+            try:
+                migration(c)
+                c.execute(f"PRAGMA user_version = {number}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            logger.info(f"Applied migration {number}: {migration.__name__}")
+        if version < len(MIGRATIONS):
+            for name, details in find_unindexed_queries(c).items():
+                logger.warning(f"Hot query {name} is not using an index: {details}")
+        with conn:
+            indexed = sync_search_index(c)
+        if indexed:
+            logger.info(f"Indexed {indexed} products for search")
     except Exception as e:
         logger.error(f"Database initialization error: {e}")
+        raise
     finally:
         conn.close()
 
-# Haversine formula for distance calculation
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1-a))
-    return R * c
-
-# Generate dynamic delivery time slot
-def get_next_delivery_slot():
-    now = datetime.now(UZBEKISTAN_TZ)
-    min_time = now + timedelta(minutes=MIN_DELIVERY_TIME)
-    minutes = (min_time.minute // 30 + 1) * 30
-    if minutes >= 60:
-        min_time = min_time.replace(hour=min_time.hour + 1, minute=0)
-    else:
-        min_time = min_time.replace(minute=minutes)
-    return min_time.strftime("Today %H:%M")
+# Render order lines as "Name xQty (line total UZS)", the format orders.products has always used
+def format_order_items(items):
+    return ", ".join(f"{name} x{quantity} ({'{:.3f}'.format(round(float(unit_price) * quantity, 3))} UZS)"
+                     for name, quantity, unit_price in items)
+
+def delivery_fee_for(distance_km):
+    return min(distance_km * DELIVERY_FEE_PER_KM, MAX_DELIVERY_FEE)
+
+# Delivery time as shown to customers and admins: "Today 13:30"
+def format_delivery_time(when):
+    days = (when.date() - datetime.now(UZBEKISTAN_TZ).date()).days
+    day = {0: "Today", 1: "Tomorrow"}.get(days, when.strftime("%d.%m"))
+    return f"{day} {when:%H:%M}"
 
 # Validate and parse custom delivery time
 def parse_delivery_time(text, lang):
@@ -437,55 +1470,223 @@ def parse_delivery_time(text, lang):
         delivery_datetime += timedelta(days=1)
     if delivery_datetime < min_time:
         return None, LANGUAGES[lang]["delivery_time_too_soon"]
-    date_str = "Today" if delivery_date == "today" else "Tomorrow"
-    return f"{date_str} {hour:02d}:{minute:02d}", None
+    return delivery_datetime, None
+
+# Delivery slots. A store takes at most its capacity (stores.slot_capacity, or
+# SLOT_CAPACITY) orders per SLOT_MINUTES slot. The delivery_slots table is the
+# source of truth: submit_order reserves with a conditional upsert inside the
+# order's transaction and the timeout sweep releases inside the cancelling one.
+# In-memory counters mirror the table for the delivery menu, and each store
+# keeps a cursor at its first slot with room, so the next free slot is found
+# without rescanning the full ones; a release before the cursor moves it back.
+class DeliverySlots:
+    def __init__(self, slot_minutes=SLOT_MINUTES, capacity=SLOT_CAPACITY):
+        self.slot_seconds = slot_minutes * 60
+        self.capacity = capacity
+        self._loaded = False
+        self._lock = asyncio.Lock()
+        self._capacities = {}
+        self._reserved = {}
+        self._cursors = {}
+
+    # Slots are numbered from the epoch; keys are their local start times
+    def slot_of(self, when):
+        return int(when.timestamp()) // self.slot_seconds
+
+    def start_of(self, slot):
+        return datetime.fromtimestamp(slot * self.slot_seconds, UZBEKISTAN_TZ)
+
+    def key(self, slot):
+        return self.start_of(slot).strftime("%Y-%m-%d %H:%M")
+
+    def slot_from_key(self, key):
+        return self.slot_of(UZBEKISTAN_TZ.localize(datetime.strptime(key, "%Y-%m-%d %H:%M")))
+
+    # The first slot starting at least MIN_DELIVERY_TIME from now
+    def earliest(self):
+        ready = datetime.now(UZBEKISTAN_TZ) + timedelta(minutes=MIN_DELIVERY_TIME)
+        return -(-int(ready.timestamp()) // self.slot_seconds)
+
+    def capacity_for(self, store_id):
+        return max(self._capacities.get(store_id) or self.capacity, 1)
+
+    async def ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._lock:
+            if self._loaded:
+                return
+            current = self.key(self.slot_of(datetime.now(UZBEKISTAN_TZ)))
+            def _load_slots(c):
+                c.execute("SELECT id, slot_capacity FROM stores")
+                capacities = c.fetchall()
+                c.execute("SELECT store_id, slot, reserved FROM delivery_slots WHERE slot >= ? AND reserved > 0", (current,))
+                return capacities, c.fetchall()
+            capacities, rows = await db.run(_load_slots)
+            self._capacities = {store_id: capacity for store_id, capacity in capacities if capacity}
+            for store_id, key, reserved in rows:
+                self._reserved.setdefault(store_id, {})[self.slot_from_key(key)] = reserved
+            self._loaded = True
+            logger.info(f"Delivery slots loaded: {len(rows)} booked slots")
+
+    async def next_free(self, store_id):
+        await self.ensure_loaded()
+        earliest = self.earliest()
+        reserved = self._reserved.setdefault(store_id, {})
+        slot = self._cursors.get(store_id, earliest)
+        if slot < earliest:
+            # Time moved past the cursor: drop the counters of slots gone by
+            for past in [past for past in reserved if past < earliest]:
+                del reserved[past]
+            slot = earliest
+        capacity = self.capacity_for(store_id)
+        while reserved.get(slot, 0) >= capacity:
+            slot += 1
+        self._cursors[store_id] = slot
+        return slot
+
+    async def has_room(self, store_id, slot):
+        await self.ensure_loaded()
+        return self._reserved.get(store_id, {}).get(slot, 0) < self.capacity_for(store_id)
+
+    # Inside the order's transaction: True if the slot had room and is now held
+    def reserve(self, c, store_id, slot):
+        c.execute("INSERT INTO delivery_slots (store_id, slot, reserved) VALUES (?, ?, 1) "
+                  "ON CONFLICT (store_id, slot) DO UPDATE SET reserved = reserved + 1 WHERE reserved < ?",
+                  (store_id, self.key(slot), self.capacity_for(store_id)))
+        return c.rowcount == 1
+
+    def release(self, c, store_id, key):
+        c.execute("UPDATE delivery_slots SET reserved = reserved - 1 WHERE store_id = ? AND slot = ? AND reserved > 0",
+                  (store_id, key))
+
+    # Mirror a committed reservation or release in the counters
+    def note_reserved(self, store_id, slot):
+        reserved = self._reserved.setdefault(store_id, {})
+        reserved[slot] = reserved.get(slot, 0) + 1
+
+    # The table refused a reservation the counters allowed: catch up with it
+    def note_full(self, store_id, slot):
+        self._reserved.setdefault(store_id, {})[slot] = self.capacity_for(store_id)
+
+    def note_released(self, store_id, slot):
+        reserved = self._reserved.get(store_id, {})
+        if reserved.get(slot, 0) > 0:
+            reserved[slot] -= 1
+        if slot < self._cursors.get(store_id, slot):
+            self._cursors[store_id] = slot
+
+    def stats(self):
+        return {"booked": sum(sum(slots.values()) for slots in self._reserved.values()),
+                "full": sum(count >= self.capacity_for(store_id)
+                            for store_id, slots in self._reserved.items() for count in slots.values())}
+
+delivery_slots = DeliverySlots()
 
 # Delete previous message if exists
 async def delete_previous_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int, force_delete: bool = False):
-    last_message_id = context.user_data.get("last_message_id")
-    message_type = context.user_data.get("message_type")
-    pending_alert = context.user_data.get("pending_alert", False)
+    last_message_id = context.user_data.last_message_id
+    message_type = context.user_data.message_type
+    pending_alert = context.user_data.pending_alert
     if last_message_id and (force_delete or (message_type == "button" and not pending_alert)):
+        gallery_message_ids = context.user_data.gallery_message_ids
         try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=last_message_id)
+            if gallery_message_ids:
+                await context.bot.delete_messages(chat_id=chat_id, message_ids=[*gallery_message_ids, last_message_id])
+            else:
+                await context.bot.delete_message(chat_id=chat_id, message_id=last_message_id)
         except TelegramError as e:
             logger.warning(f"Failed to delete message {last_message_id}: {e}")
-        context.user_data["last_message_id"] = None
-        context.user_data["message_type"] = None
+        context.user_data.last_message_id = None
+        context.user_data.message_type = None
+        context.user_data.gallery_message_ids = None
     if force_delete and pending_alert:
-        context.user_data["pending_alert"] = False
+        context.user_data.pending_alert = False
+
+# Screen rendering for button navigation. The screen on display is remembered
+# by message id, kind (text or photo) and digests of its media, text and
+# keyboard, so the next screen edits that message in place: only the keyboard
+# when that is all that changed, and no call at all when nothing did. The old
+# message is deleted and a new one sent only when it is not the screen any more
+# (an alert or a gallery came after it, or it could not be edited) or the kind
+# changes, since Telegram cannot turn a text message into a photo.
+def screen_digest(*parts):
+    return hashlib.blake2b("\x00".join(parts).encode(), digest_size=8).hexdigest()
+
+async def render_screen(message, context: ContextTypes.DEFAULT_TYPE, text: str, keyboard, photo=None, force_delete=False):
+    chat_id = message.chat_id
+    markup = InlineKeyboardMarkup(keyboard)
+    rendered = {"kind": "photo" if photo else "text", "media": screen_digest(photo or ""), "text": screen_digest(text),
+                "buttons": screen_digest(markup.to_json())}
+    screen = context.user_data.screen
+    if (screen and screen["id"] == context.user_data.last_message_id and screen["kind"] == rendered["kind"]
+            and context.user_data.message_type == "button" and not context.user_data.gallery_message_ids
+            and not context.user_data.pending_alert):
+        message_id = screen["id"]
+        try:
+            if screen["media"] != rendered["media"]:
+                outcome = "edit_media"
+                await context.bot.edit_message_media(
+                    InputMediaPhoto(media=photo, caption=text, parse_mode="Markdown"),
+                    chat_id=chat_id, message_id=message_id, reply_markup=markup)
+            elif screen["text"] != rendered["text"]:
+                outcome = "edit_text"
+                if photo:
+                    await context.bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=text,
+                                                           reply_markup=markup, parse_mode="Markdown")
+                else:
+                    await context.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id,
+                                                        reply_markup=markup, parse_mode="Markdown")
+            elif screen["buttons"] != rendered["buttons"]:
+                outcome = "edit_markup"
+                await context.bot.edit_message_reply_markup(chat_id=chat_id, message_id=message_id, reply_markup=markup)
+            else:
+                outcome = "unchanged"
+        except BadRequest as e:
+            if "not modified" not in str(e):
+                logger.warning(f"Failed to edit screen {message_id}, sending a new one: {e}")
+                outcome = None
+        if outcome:
+            screen_renders.inc(outcome)
+            context.user_data.screen = {"id": message_id, **rendered}
+            return
+    await delete_previous_message(context, chat_id, force_delete=force_delete)
+    if photo:
+        new_message = await message.reply_photo(photo=photo, caption=text, reply_markup=markup, parse_mode="Markdown")
+    else:
+        new_message = await message.reply_text(text, reply_markup=markup, parse_mode="Markdown")
+    screen_renders.inc("send")
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "button"
+    context.user_data.gallery_message_ids = None
+    context.user_data.screen = {"id": new_message.message_id, **rendered}
 
 # Error handler
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.error(f"Update {update} caused error {context.error}", exc_info=True)
     if update and update.effective_message:
         user_id = update.effective_user.id if update.effective_user else update.callback_query.from_user.id
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-            user = c.fetchone()
-            lang = user[0] if user else "en"
-        finally:
-            conn.close()
+        user = await user_cache.get(user_id)
+        lang = user["language"] if user else "en"
         await delete_previous_message(context, user_id, force_delete=True)
-        if context.user_data.get("cart"):
+        if context.user_data.cart:
             await show_cart(update.effective_message, context, lang)
         else:
             message = await update.effective_message.reply_text(
                 LANGUAGES[lang]["error"].format(support=SUPPORT_USERNAME),
                 parse_mode="Markdown"
             )
-            context.user_data["last_message_id"] = message.message_id
-            context.user_data["message_type"] = "alert"
-            context.user_data["state"] = ""
-            context.user_data["pending_alert"] = False
+            context.user_data.last_message_id = message.message_id
+            context.user_data.message_type = "alert"
+            conversation.leave(context.user_data)
+            context.user_data.pending_alert = False
             await show_main_menu(update.effective_message, context, lang)
     for admin in ADMIN_ID:
         try:
             await context.bot.send_message(
                 admin,
-                f"Error for user {user_id if 'user_id' in locals() else 'unknown'}: {context.error}"
+                f"Error for user {user_id if 'user_id' in locals() else 'unknown'}: {context.error}",
+                rate_limit_args=PRIORITY_ADMIN
             )
         except Exception as e:
             logger.error(f"Failed to notify admin {admin}: {e}")
@@ -493,17 +1694,11 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Start command
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    context.user_data.clear()
-    conn = sqlite3.connect("store_bot.db")
-    try:
-        c = conn.cursor()
-        c.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        user = c.fetchone()
-    finally:
-        conn.close()
+    context.user_data.reset()
+    user = await user_cache.get(user_id)
     await delete_previous_message(context, user_id)
     if user:
-        await show_main_menu(update.message, context, user[3])
+        await show_main_menu(update.message, context, user["language"])
     else:
         keyboard = [
             [InlineKeyboardButton("O'zbek", callback_data="lang_uz"),
@@ -515,8 +1710,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "button"
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "button"
 
 async def show_main_menu(message, context: ContextTypes.DEFAULT_TYPE, lang: str):
     keyboard = [
@@ -528,15 +1723,8 @@ async def show_main_menu(message, context: ContextTypes.DEFAULT_TYPE, lang: str)
     ]
     if message.chat_id in ADMIN_ID:
         keyboard.append([InlineKeyboardButton("🔧 Admin Panel", callback_data="admin_menu")])
-    await delete_previous_message(context, message.chat_id, force_delete=True)
-    new_message = await message.reply_text(
-        LANGUAGES[lang]["main_menu"],
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
-    )
-    context.user_data["last_message_id"] = new_message.message_id
-    context.user_data["message_type"] = "button"
-    context.user_data["pending_alert"] = False
+    await render_screen(message, context, LANGUAGES[lang]["main_menu"], keyboard, force_delete=True)
+    context.user_data.pending_alert = False
 
 # Show admin panel
 async def show_admin_panel(message, context: ContextTypes.DEFAULT_TYPE, lang: str):
@@ -544,787 +1732,1017 @@ async def show_admin_panel(message, context: ContextTypes.DEFAULT_TYPE, lang: st
         [InlineKeyboardButton("ЦУМ", callback_data="admin_store_1"),
          InlineKeyboardButton("Sergeli", callback_data="admin_store_2")]
     ]
-    await delete_previous_message(context, message.chat_id)
-    new_message = await message.reply_text(
-        LANGUAGES[lang]["admin_menu"],
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
-    )
-    context.user_data["last_message_id"] = new_message.message_id
-    context.user_data["message_type"] = "button"
+    await render_screen(message, context, LANGUAGES[lang]["admin_menu"], keyboard)
 
 # Show cart contents with corrected price handling
 async def show_cart(message, context: ContextTypes.DEFAULT_TYPE, lang: str):
-    user_id = message.chat_id
-    cart = context.user_data.get("cart", {})
-    location = context.user_data.get("location", {})
-    store_id = context.user_data.get("store_id", 1)
-    if not cart:
-        await delete_previous_message(context, user_id)
-        new_message = await message.reply_text(
-            LANGUAGES[lang]["cart_empty"],
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{store_id}")]]),
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "button"
+    cart = context.user_data.cart
+    location = (context.user_data.location or {})
+    store_id = context.user_data.store_id
+    lines = await cart.items()
+    if not lines:
+        await render_screen(message, context, LANGUAGES[lang]["cart_empty"],
+                            [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{store_id}")]])
         return
-    conn = sqlite3.connect("store_bot.db")
-    try:
-        c = conn.cursor()
-        product_ids = [str(pid) for pid in cart.keys()]
-        c.execute("SELECT id, name, price FROM products WHERE id IN ({})".format(",".join("?" * len(product_ids))), product_ids)
-        products = c.fetchall()
-        c.execute("SELECT id, name, latitude, longitude FROM stores")
-        stores = c.fetchall()
-    finally:
-        conn.close()
-    items = []
-    base_total = 0.0
-    for p in products:
-        product_id, name, price = p
-        quantity = cart[str(product_id)]
-        price = round(float(price), 3)
-        item_total = round(price * quantity, 3)
-        base_total += item_total
-        items.append(f"• {name} x{quantity} ({'{:.3f}'.format(item_total)} UZS)")
-    delivery_fee = 0.0
-    if location and stores:
-        user_lat, user_lon = location["latitude"], location["longitude"]
-        for store in stores:
-            store_id_from_db, _, lat, lon = store
-            if store_id_from_db == store_id:
-                distance = haversine(user_lat, user_lon, lat, lon)
-                distance_km = float(distance)
-                delivery_fee = min(distance_km * DELIVERY_FEE_PER_KM, MAX_DELIVERY_FEE)
-                break
-    total = base_total + delivery_fee
-    context.user_data["base_total"] = base_total
-    context.user_data["delivery_fee"] = delivery_fee
+    items = [f"• {line.name} x{line.quantity} ({format_money(line.quantity * line.unit_price)} UZS)" for line in lines]
+    delivery_fee = 0
+    zone_line = ""
+    if location:
+        fee, zone, deliverable = await delivery_zones.quote(store_id, location)
+        delivery_fee = to_minor(fee)
+        if not deliverable:
+            zone_line = "\n" + LANGUAGES[lang]["outside_delivery_zone"]
+        elif zone:
+            zone_line = "\n" + LANGUAGES[lang]["delivery_zone_info"].format(zone=zone.name, eta=zone.eta_minutes)
+    total = cart.subtotal + delivery_fee
+    context.user_data.delivery_fee = delivery_fee
     keyboard = []
-    for p in products:
-        product_id = str(p[0])
-        keyboard.append([InlineKeyboardButton(LANGUAGES[lang]["remove_from_cart"].format(product_name=p[1]), callback_data=f"remove_from_cart_{product_id}")])
+    for line in lines:
+        keyboard.append([InlineKeyboardButton(LANGUAGES[lang]["remove_from_cart"].format(product_name=line.name), callback_data=f"remove_from_cart_{line.product_id}")])
     keyboard.append([
         InlineKeyboardButton(LANGUAGES[lang]["add_more"], callback_data=f"store_{store_id}"),
         InlineKeyboardButton(LANGUAGES[lang]["finish_order"], callback_data="finish_order")
     ])
     keyboard.append([InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{store_id}")])
-    await delete_previous_message(context, user_id)
-    new_message = await message.reply_text(
-        LANGUAGES[lang]["cart_contents"].format(items="\n".join(items), total='{:.3f}'.format(total), delivery_fee='{:.3f}'.format(delivery_fee)),
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
+    await render_screen(
+        message, context,
+        LANGUAGES[lang]["cart_contents"].format(items="\n".join(items), total=format_money(total), delivery_fee=format_money(delivery_fee)) + zone_line,
+        keyboard
     )
-    context.user_data["last_message_id"] = new_message.message_id
-    context.user_data["message_type"] = "button"
-    context.user_data["store_id"] = store_id
+    context.user_data.store_id = store_id
+
+# Callback routing. Routes are registered by exact callback_data or by a
+# prefix ending in "_"; the rest of the data after a prefix is parsed into the
+# handler's argument (parse=int for ids). Exact routes are one dict lookup and
+# prefixes are matched longest first, one lookup per "_" in the data, so the
+# cost does not grow with the number of routes. Every dispatch is timed and
+# failures are counted per route before the error handler sees them.
+class CallbackRouter:
+    def __init__(self):
+        self._exact = {}
+        self._prefixes = {}
+        self.route_stats = {}
+        self.unmatched = 0
+
+    def route(self, key, parse=None):
+        def register(handler):
+            if key.endswith("_"):
+                self._prefixes[key] = (handler, parse)
+            else:
+                self._exact[key] = (handler, None)
+            self.route_stats[key] = [0, 0, 0.0, 0.0]  # calls, errors, total seconds, max seconds
+            return handler
+        return register
+
+    # Returns (route key, handler, args) or None
+    def resolve(self, data):
+        entry = self._exact.get(data)
+        if entry:
+            return data, entry[0], ()
+        end = data.rfind("_")
+        while end != -1:
+            key = data[:end + 1]
+            entry = self._prefixes.get(key)
+            if entry:
+                handler, parse = entry
+                arg = data[end + 1:]
+                return key, handler, (parse(arg) if parse else arg,)
+            end = data.rfind("_", 0, end)
+        return None
+
+    async def dispatch(self, query, context, lang):
+        try:
+            resolved = self.resolve(query.data or "")
+        except ValueError:
+            resolved = None
+        if resolved is None:
+            self.unmatched += 1
+            logger.warning(f"No callback route for {query.data!r} from user {query.from_user.id}")
+            return
+        key, handler, args = resolved
+        stats = self.route_stats[key]
+        started = time.perf_counter()
+        try:
+            await handler(query, context, lang, *args)
+        except Exception:
+            stats[1] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            callback_latency.observe(key, elapsed)
+            stats[0] += 1
+            stats[2] += elapsed
+            stats[3] = max(stats[3], elapsed)
+
+    def stats(self):
+        return {
+            key: {
+                "calls": calls,
+                "errors": errors,
+                "avg_ms": total / calls * 1000 if calls else 0.0,
+                "max_ms": longest * 1000,
+            }
+            for key, (calls, errors, total, longest) in self.route_stats.items()
+        }
+
+callback_router = CallbackRouter()
+
+# Conversation states. Each state that waits for user input is declared once:
+# the handler for a message of its kind (text or photo), the states it may move
+# to, an optional TTL in seconds and the user_data keys collected on the way
+# there. Dispatch is one dict lookup on the current state. A handler returns
+# the next state, "" to end the conversation or its own state to ask again;
+# any other state is refused and ends the conversation. States with a TTL are
+# queued by deadline and a periodic reap() clears every overdue conversation
+# in one pass, dropping its collected data; a message arriving after the
+# deadline but before the reap is treated as if no conversation were open.
+ConversationState = namedtuple("ConversationState", "name handler kind transitions ttl data")
+
+class ConversationFSM:
+    def __init__(self):
+        self.states = {}
+        self._deadlines = []
+        self.reaped = 0
+        self.expired = 0
+        self.refused = 0
+
+    def add(self, name, handler=None, kind="text", transitions=(), ttl=None, data=()):
+        self.states[name] = ConversationState(name, handler, kind, frozenset(transitions), ttl, tuple(data))
+
+    def state(self, name, kind="text", transitions=(), ttl=None, data=()):
+        def register(handler):
+            self.add(name, handler, kind, transitions, ttl, data)
+            return handler
+        return register
+
+    def enter(self, user_data, user_id, name):
+        state = self.states[name] if name else None
+        user_data.state = name
+        if state and state.ttl:
+            deadline = time.time() + state.ttl
+            user_data.state_expires = deadline
+            heapq.heappush(self._deadlines, (deadline, user_id))
+        else:
+            user_data.state_expires = None
+
+    # Queue the deadline of a session loaded from storage; enter() never saw it
+    def track(self, user_data, user_id):
+        if user_data.state and user_data.state_expires:
+            heapq.heappush(self._deadlines, (user_data.state_expires, user_id))
+
+    def leave(self, user_data):
+        user_data.state = ""
+        user_data.state_expires = None
+
+    def _clear(self, user_data):
+        state = self.states.get(user_data.state)
+        self.leave(user_data)
+        if state:
+            user_data.reset(*state.data)
+
+    async def dispatch(self, kind, update, context, lang, payload):
+        user_data = context.user_data
+        name = user_data.state or ""
+        expires = user_data.state_expires
+        if name and expires and expires <= time.time():
+            self._clear(user_data)
+            self.expired += 1
+            name = ""
+        if kind == "text":
+            message_states.inc(name or "none")
+        state = self.states.get(name)
+        if state is None or state.kind != kind or state.handler is None:
+            return
+        # The reaper must not clear a state whose handler is already running
+        user_data.state_expires = None
+        try:
+            next_state = await state.handler(update, context, lang, payload)
+        except Exception:
+            self.enter(user_data, update.effective_user.id, name)
+            raise
+        if next_state and next_state != name and next_state not in state.transitions:
+            self.refused += 1
+            logger.error(f"Conversation state {name!r} cannot move to {next_state!r}; ending it")
+            next_state = ""
+        self.enter(user_data, update.effective_user.id, next_state)
+
+    async def reap(self, application):
+        now = time.time()
+        reaped = []
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, user_id = heapq.heappop(self._deadlines)
+            user_data = application.user_data.get(user_id)
+            # Entries left behind by a later enter() no longer match the deadline
+            if user_data and user_data.state_expires == deadline:
+                self._clear(user_data)
+                reaped.append(user_id)
+        if reaped:
+            self.reaped += len(reaped)
+            application.mark_data_for_update_persistence(user_ids=reaped)
+            logger.info(f"Reaped {len(reaped)} abandoned conversations")
+        return len(reaped)
+
+    def stats(self):
+        return {"queued": len(self._deadlines), "reaped": self.reaped, "expired": self.expired, "refused": self.refused}
+
+conversation = ConversationFSM()
 
 # Handle button callbacks
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
+    user = await user_cache.get(query.from_user.id)
+    lang = user["language"] if user else context.user_data.language or "en"
+    await callback_router.dispatch(query, context, lang)
+
+@callback_router.route("lang_")
+async def on_lang(query, context, lang, new_lang):
     user_id = query.from_user.id
-    data = query.data
-    conn = sqlite3.connect("store_bot.db")
-    try:
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        user = c.fetchone()
-        lang = user[0] if user else context.user_data.get("language", "en")
-    finally:
-        conn.close()
-    if data.startswith("lang_"):
-        new_lang = data.split("_")[1]
-        context.user_data["language"] = new_lang
-        if user:
-            conn = sqlite3.connect("store_bot.db")
-            try:
-                c = conn.cursor()
-                c.execute("UPDATE users SET language = ? WHERE user_id = ?", (new_lang, user_id))
-                conn.commit()
-            finally:
-                conn.close()
-            await delete_previous_message(context, user_id)
-            message = await query.message.reply_text(
-                LANGUAGES[new_lang]["language_changed"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = message.message_id
-            context.user_data["message_type"] = "alert"
-            await show_main_menu(query.message, context, new_lang)
-        else:
-            await delete_previous_message(context, user_id)
-            message = await query.message.reply_text(
-                LANGUAGES[new_lang]["enter_name"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = message.message_id
-            context.user_data["message_type"] = "alert"
-            context.user_data["state"] = "awaiting_name"
-    elif data == "start_ordering":
-        keyboard = ReplyKeyboardMarkup(
-            [[KeyboardButton(LANGUAGES[lang]["send_location"], request_location=True)]],
-            one_time_keyboard=True,
-            resize_keyboard=True
-        )
-        await delete_previous_message(context, user_id)
-        message = await query.message.reply_text(
-            LANGUAGES[lang]["send_location"],
-            reply_markup=keyboard,
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "button"
-        context.user_data["state"] = "awaiting_location"
-    elif data == "my_coins":
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("SELECT coins FROM users WHERE user_id = ?", (user_id,))
-            coins = c.fetchone()[0]
-        finally:
-            conn.close()
-        keyboard = [
-            [InlineKeyboardButton(LANGUAGES[lang]["buy_coins"], callback_data="buy_coins"),
-             InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")]
-        ]
-        await delete_previous_message(context, user_id)
-        message = await query.message.reply_text(
-            f"💰 *Your coins*: {'{:.3f}'.format(coins)}",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "button"
-    elif data == "buy_coins":
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("SELECT id FROM coin_requests WHERE user_id = ? AND status = 'pending'", (user_id,))
-            pending_request = c.fetchone()
-            if pending_request:
-                await delete_previous_message(context, user_id)
-                message = await query.message.reply_text(
-                    LANGUAGES[lang]["pending_coin_request"],
-                    parse_mode="Markdown"
-                )
-                context.user_data["last_message_id"] = message.message_id
-                context.user_data["message_type"] = "alert"
-                return
-        finally:
-            conn.close()
-        await delete_previous_message(context, user_id)
-        message = await query.message.reply_text(
-            LANGUAGES[lang]["choose_coin_amount"],
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = "awaiting_coin_amount"
-    elif data == "help":
-        keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")]]
-        await delete_previous_message(context, user_id)
-        message = await query.message.reply_text(
-            LANGUAGES[lang]["help_info"],
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "button"
-    elif data == "my_orders":
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("SELECT order_id, products, delivery_time, status FROM orders WHERE user_id = ?", (user_id,))
-            orders = c.fetchall()
-        finally:
-            conn.close()
-        if orders:
-            message_text = "\n".join([f"📦 *Order {o[0]}*: {o[1]}\n⏰ {o[2]} ({o[3]})" for o in orders])
-        else:
-            message_text = LANGUAGES[lang]["cart_empty"]
-        keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")]]
+    context.user_data.language = new_lang
+    if await user_cache.get(user_id):
+        await db.execute("UPDATE users SET language = ? WHERE user_id = ?", (new_lang, user_id))
+        user_cache.invalidate(user_id)
         await delete_previous_message(context, user_id)
         message = await query.message.reply_text(
-            message_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            LANGUAGES[new_lang]["language_changed"],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "button"
-    elif data == "settings":
-        keyboard = [
-            [InlineKeyboardButton(LANGUAGES[lang]["change_name"], callback_data="change_name"),
-             InlineKeyboardButton(LANGUAGES[lang]["change_language"], callback_data="change_language")],
-            [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")]
-        ]
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "alert"
+        await show_main_menu(query.message, context, new_lang)
+    else:
         await delete_previous_message(context, user_id)
         message = await query.message.reply_text(
-            LANGUAGES[lang]["settings"],
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            LANGUAGES[new_lang]["enter_name"],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "button"
-    elif data == "change_name":
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "alert"
+        conversation.enter(context.user_data, query.from_user.id, "awaiting_name")
+
+@callback_router.route("start_ordering")
+async def on_start_ordering(query, context, lang):
+    user_id = query.from_user.id
+    keyboard = ReplyKeyboardMarkup(
+        [[KeyboardButton(LANGUAGES[lang]["send_location"], request_location=True)]],
+        one_time_keyboard=True,
+        resize_keyboard=True
+    )
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["send_location"],
+        reply_markup=keyboard,
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "button"
+    conversation.enter(context.user_data, query.from_user.id, "awaiting_location")
+
+@callback_router.route("my_coins")
+async def on_my_coins(query, context, lang):
+    user_id = query.from_user.id
+    coins = (await user_cache.get(user_id))["coins"]
+    keyboard = [
+        [InlineKeyboardButton(LANGUAGES[lang]["buy_coins"], callback_data="buy_coins"),
+         InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")]
+    ]
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        f"💰 *Your coins*: {'{:.3f}'.format(coins)}",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "button"
+
+@callback_router.route("buy_coins")
+async def on_buy_coins(query, context, lang):
+    user_id = query.from_user.id
+    pending_request = await db.fetchone(SQL_PENDING_COIN_REQUEST, (user_id,))
+    if pending_request:
         await delete_previous_message(context, user_id)
         message = await query.message.reply_text(
-            LANGUAGES[lang]["enter_name"],
+            LANGUAGES[lang]["pending_coin_request"],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = "awaiting_new_name"
-    elif data == "change_language":
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "alert"
+        return
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["choose_coin_amount"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "alert"
+    conversation.enter(context.user_data, query.from_user.id, "awaiting_coin_amount")
+
+@callback_router.route("help")
+async def on_help(query, context, lang):
+    user_id = query.from_user.id
+    keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")]]
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["help_info"],
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "button"
+
+@callback_router.route("my_orders")
+async def on_my_orders(query, context, lang):
+    user_id = query.from_user.id
+    def _load_orders(c):
+        c.execute(SQL_MY_ORDERS, (user_id,))
+        orders = c.fetchall()
+        c.execute(SQL_MY_ORDER_ITEMS, (user_id,))
+        items = {}
+        for order_id, name, quantity, unit_price in c.fetchall():
+            items.setdefault(order_id, []).append((name, quantity, unit_price))
+        return orders, items
+    orders, order_items = await db.run(_load_orders)
+    if orders:
+        # Orders placed before order_items existed only have the rendered text
+        message_text = "\n".join([
+            f"📦 *Order {o[0]}*: {format_order_items(order_items[o[0]]) if o[0] in order_items else o[1]}\n⏰ {o[2]} ({o[3]})"
+            for o in orders
+        ])
+    else:
+        message_text = LANGUAGES[lang]["cart_empty"]
+    keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")]]
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        message_text,
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "button"
+
+@callback_router.route("settings")
+async def on_settings(query, context, lang):
+    keyboard = [
+        [InlineKeyboardButton(LANGUAGES[lang]["change_name"], callback_data="change_name"),
+         InlineKeyboardButton(LANGUAGES[lang]["change_language"], callback_data="change_language")],
+        [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")]
+    ]
+    await render_screen(query.message, context, LANGUAGES[lang]["settings"], keyboard)
+
+@callback_router.route("change_name")
+async def on_change_name(query, context, lang):
+    user_id = query.from_user.id
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["enter_name"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "alert"
+    conversation.enter(context.user_data, query.from_user.id, "awaiting_new_name")
+
+@callback_router.route("change_language")
+async def on_change_language(query, context, lang):
+    user_id = query.from_user.id
+    user_cache.invalidate(user_id)
+    keyboard = [
+        [InlineKeyboardButton("O'zbek", callback_data="lang_uz"),
+         InlineKeyboardButton("English", callback_data="lang_en")],
+        [InlineKeyboardButton("Русский", callback_data="lang_ru")]
+    ]
+    await render_screen(query.message, context, LANGUAGES[lang]["choose_language"], keyboard)
+
+@callback_router.route("main_menu")
+async def on_main_menu(query, context, lang):
+    context.user_data.reset("cart", "delivery_fee", "quote")
+    await show_main_menu(query.message, context, lang)
+
+@callback_router.route("store_", parse=int)
+async def on_store(query, context, lang, store_id):
+    context.user_data.store_id = store_id
+    context.user_data.category_cursor = None
+    await show_categories(query.message, context, lang, store_id)
+
+@callback_router.route("category_")
+async def on_category(query, context, lang, category):
+    user_id = query.from_user.id
+    if category in RESTRICTED_CATEGORIES:
+        context.user_data.pending_category = category
         keyboard = [
-            [InlineKeyboardButton("O'zbek", callback_data="lang_uz"),
-             InlineKeyboardButton("English", callback_data="lang_en")],
-            [InlineKeyboardButton("Русский", callback_data="lang_ru")]
+            [InlineKeyboardButton(LANGUAGES[lang]["age_yes"], callback_data="age_confirm_yes"),
+             InlineKeyboardButton(LANGUAGES[lang]["age_no"], callback_data="age_confirm_no")]
         ]
         await delete_previous_message(context, user_id)
         message = await query.message.reply_text(
-            LANGUAGES[lang]["choose_language"],
+            LANGUAGES[lang]["age_confirmation"],
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "button"
-    elif data == "main_menu":
-        context.user_data["cart"] = {}
-        context.user_data["base_total"] = 0
-        context.user_data["delivery_fee"] = 0
-        await delete_previous_message(context, user_id, force_delete=True)
-        await show_main_menu(query.message, context, lang)
-    elif data.startswith("store_"):
-        store_id = int(data.split("_")[1])
-        context.user_data["store_id"] = store_id
-        context.user_data["category_offset"] = 0
-        await show_categories(query.message, context, lang, store_id)
-    elif data.startswith("category_"):
-        category = data.split("_", 1)[1]
-        if category in RESTRICTED_CATEGORIES:
-            context.user_data["pending_category"] = category
-            keyboard = [
-                [InlineKeyboardButton(LANGUAGES[lang]["age_yes"], callback_data="age_confirm_yes"),
-                 InlineKeyboardButton(LANGUAGES[lang]["age_no"], callback_data="age_confirm_no")]
-            ]
-            await delete_previous_message(context, user_id)
-            message = await query.message.reply_text(
-                LANGUAGES[lang]["age_confirmation"],
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = message.message_id
-            context.user_data["message_type"] = "button"
-        else:
-            context.user_data["category"] = category
-            context.user_data["product_offset"] = 0
-            await show_products(query.message, context, lang)
-            context.user_data["pending_alert"] = False
-    elif data == "age_confirm_yes":
-        context.user_data["age_confirmed"] = True
-        category = context.user_data.get("pending_category")
-        if category:
-            context.user_data["category"] = category
-            context.user_data["product_offset"] = 0
-            await show_products(query.message, context, lang)
-            context.user_data["pending_alert"] = False
-    elif data == "age_confirm_no":
-        context.user_data["age_confirmed"] = False
-        await delete_previous_message(context, user_id)
-        message = await query.message.reply_text(
-            LANGUAGES[lang]["age_denied"],
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
-        await show_categories(query.message, context, lang, context.user_data.get("store_id", 1))
-    elif data == "load_more_categories":
-        context.user_data["category_offset"] += ITEMS_PER_BATCH
-        await show_categories(query.message, context, lang, context.user_data.get("store_id", 1))
-    elif data == "load_more_products":
-        context.user_data["product_offset"] += ITEMS_PER_BATCH
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "button"
+    else:
+        context.user_data.category = category
+        context.user_data.product_cursor = None
         await show_products(query.message, context, lang)
-    elif data.startswith("add_to_cart_"):
-        product_id = str(data.split("_")[3])
-        if "cart" not in context.user_data:
-            context.user_data["cart"] = {}
-        context.user_data["cart"][product_id] = context.user_data["cart"].get(product_id, 0) + 1
-        store_id = context.user_data.get("store_id", 1)
-        keyboard = [
-            [InlineKeyboardButton(LANGUAGES[lang]["add_more"], callback_data=f"store_{store_id}"),
-             InlineKeyboardButton(LANGUAGES[lang]["see_cart"], callback_data="see_cart")],
-            [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"category_{context.user_data.get('category', '')}")]
-        ]
-        await delete_previous_message(context, user_id)
+        context.user_data.pending_alert = False
+
+@callback_router.route("age_confirm_yes")
+async def on_age_confirm_yes(query, context, lang):
+    context.user_data.age_confirmed = True
+    category = context.user_data.pending_category
+    if category:
+        context.user_data.category = category
+        context.user_data.product_cursor = None
+        await show_products(query.message, context, lang)
+        context.user_data.pending_alert = False
+
+@callback_router.route("age_confirm_no")
+async def on_age_confirm_no(query, context, lang):
+    user_id = query.from_user.id
+    context.user_data.age_confirmed = False
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["age_denied"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "alert"
+    await show_categories(query.message, context, lang, context.user_data.store_id)
+
+@callback_router.route("load_more_categories")
+async def on_load_more_categories(query, context, lang):
+    context.user_data.category_cursor = context.user_data.category_last
+    await show_categories(query.message, context, lang, context.user_data.store_id)
+
+@callback_router.route("load_more_products_", parse=int)
+async def on_load_more_products(query, context, lang, after_id):
+    context.user_data.product_cursor = after_id
+    await show_products(query.message, context, lang)
+
+@callback_router.route("add_to_cart_", parse=int)
+async def on_add_to_cart(query, context, lang, product_id):
+    if not await context.user_data.cart.add(product_id):
+        # Deleted since the page was shown; show the category as it is now
+        await delete_previous_message(context, query.from_user.id)
         message = await query.message.reply_text(
-            "✅ *Product added to cart!*",
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            LANGUAGES[lang]["product_unavailable"],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "button"
-    elif data == "see_cart":
-        await show_cart(query.message, context, lang)
-    elif data.startswith("remove_from_cart_"):
-        product_id = str(data.split("_")[3])
-        if "cart" in context.user_data and product_id in context.user_data["cart"]:
-            del context.user_data["cart"][product_id]
-            if not context.user_data["cart"]:
-                await delete_previous_message(context, user_id)
-                message = await query.message.reply_text(
-                    LANGUAGES[lang]["cart_empty"],
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{context.user_data.get('store_id', 1)}")]]),
-                    parse_mode="Markdown"
-                )
-                context.user_data["last_message_id"] = message.message_id
-                context.user_data["message_type"] = "button"
-            else:
-                await show_cart(query.message, context, lang)
-        else:
-            await delete_previous_message(context, user_id)
-            message = await query.message.reply_text(
-                LANGUAGES[lang]["cart_empty"],
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{context.user_data.get('store_id', 1)}")]]),
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = message.message_id
-            context.user_data["message_type"] = "button"
-    elif data == "finish_order":
-        if not context.user_data.get("cart"):
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "alert"
+        context.user_data.product_cursor = None
+        await show_products(query.message, context, lang)
+        return
+    store_id = context.user_data.store_id
+    keyboard = [
+        [InlineKeyboardButton(LANGUAGES[lang]["add_more"], callback_data=f"store_{store_id}"),
+         InlineKeyboardButton(LANGUAGES[lang]["see_cart"], callback_data="see_cart")],
+        [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"category_{context.user_data.category or ''}")]
+    ]
+    await render_screen(query.message, context, "✅ *Product added to cart!*", keyboard)
+
+@callback_router.route("see_cart")
+async def on_see_cart(query, context, lang):
+    await show_cart(query.message, context, lang)
+
+@callback_router.route("remove_from_cart_", parse=int)
+async def on_remove_from_cart(query, context, lang, product_id):
+    user_id = query.from_user.id
+    if context.user_data.cart.remove(product_id):
+        if not context.user_data.cart:
             await delete_previous_message(context, user_id)
             message = await query.message.reply_text(
                 LANGUAGES[lang]["cart_empty"],
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{context.user_data.store_id}")]]),
                 parse_mode="Markdown"
             )
-            context.user_data["last_message_id"] = message.message_id
-            context.user_data["message_type"] = "alert"
-            await show_main_menu(query.message, context, lang)
-            return
-        await delete_previous_message(context, user_id)
-        message = await query.message.reply_text(
-            LANGUAGES[lang]["enter_promo"],
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = "awaiting_promo_code"
-    elif data == "choose_delivery_admin":
-        context.user_data["delivery_time"] = f"Admin will choose (default {MIN_DELIVERY_TIME} min)"
-        await choose_payment(query.message, context, lang)
-    elif data == "choose_delivery_next":
-        context.user_data["delivery_time"] = get_next_delivery_slot()
-        await choose_payment(query.message, context, lang)
-    elif data == "choose_delivery_custom":
-        await delete_previous_message(context, user_id)
-        message = await query.message.reply_text(
-            LANGUAGES[lang]["enter_delivery_time"],
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = "awaiting_custom_delivery_time"
-    elif data == "payment_coins":
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("SELECT coins FROM users WHERE user_id = ?", (user_id,))
-            coins = c.fetchone()[0]
-            base_total = context.user_data.get("base_total", 0)
-            delivery_fee = context.user_data.get("delivery_fee", 0)
-            total_price = base_total + delivery_fee
-            promo_code = context.user_data.get("promo_code")
-            if promo_code and promo_code.lower() != "skip":
-                c.execute("SELECT discount, usage_count, max_uses FROM promo_codes WHERE code = ?", (promo_code.upper(),))
-                promo = c.fetchone()
-                if promo and promo[1] < promo[2]:
-                    discount = float(promo[0]) / 100.0
-                    discounted_base_total = base_total * (1 - discount)
-                    total_price = discounted_base_total + delivery_fee
-        finally:
-            conn.close()
-        if coins >= total_price:
-            context.user_data["payment_type"] = "coins"
-            context.user_data["total_price"] = total_price
-            await submit_order(query, context, lang)
+            context.user_data.last_message_id = message.message_id
+            context.user_data.message_type = "button"
         else:
-            await delete_previous_message(context, user_id)
-            message = await query.message.reply_text(
-                LANGUAGES[lang]["insufficient_coins"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = message.message_id
-            context.user_data["message_type"] = "alert"
             await show_cart(query.message, context, lang)
-    elif data.startswith("admin_store_"):
-        store_id = int(data.split("_")[2])
-        context.user_data["admin_store_id"] = store_id
-        keyboard = [
-            [InlineKeyboardButton(LANGUAGES[lang]["add_product"], callback_data="admin_add_product"),
-             InlineKeyboardButton(LANGUAGES[lang]["view_products"], callback_data="admin_view_products")],
-            [InlineKeyboardButton(LANGUAGES[lang]["manage_promos"], callback_data="admin_manage_promos"),
-             InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="admin_menu")]
-        ]
+    else:
         await delete_previous_message(context, user_id)
         message = await query.message.reply_text(
-            LANGUAGES[lang]["admin_menu"],
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            LANGUAGES[lang]["cart_empty"],
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{context.user_data.store_id}")]]),
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "button"
-    elif data == "admin_menu":
-        await show_admin_panel(query.message, context, lang)
-    elif data == "admin_add_product":
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "button"
+
+@callback_router.route("finish_order")
+async def on_finish_order(query, context, lang):
+    user_id = query.from_user.id
+    cart = context.user_data.cart
+    await cart.refresh()
+    if not cart:
         await delete_previous_message(context, user_id)
         message = await query.message.reply_text(
-            LANGUAGES[lang]["enter_product_name"],
+            LANGUAGES[lang]["cart_empty"],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = "admin_awaiting_product_name"
-    elif data == "admin_view_products":
-        store_id = context.user_data.get("admin_store_id", 1)
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("SELECT id, name FROM products WHERE store_id = ?", (store_id,))
-            products = c.fetchall()
-        finally:
-            conn.close()
-        if products:
-            keyboard = [[InlineKeyboardButton(f"{p[1]}", callback_data=f"admin_product_{p[0]}")] for p in products]
-            keyboard.append([InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"admin_store_{store_id}")])
-            await delete_previous_message(context, user_id)
-            message = await query.message.reply_text(
-                LANGUAGES[lang]["choose_product"],
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = message.message_id
-            context.user_data["message_type"] = "button"
-        else:
-            keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"admin_store_{store_id}")]]
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "alert"
+        await show_main_menu(query.message, context, lang)
+        return
+    location = context.user_data.location
+    if location:
+        _, zone, deliverable = await delivery_zones.quote(context.user_data.store_id, location)
+        if not deliverable or (zone and cart.subtotal < to_minor(zone.min_order)):
             await delete_previous_message(context, user_id)
             message = await query.message.reply_text(
-                LANGUAGES[lang]["no_products"],
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                LANGUAGES[lang]["outside_delivery_zone"] if not deliverable else
+                LANGUAGES[lang]["below_min_order"].format(zone=zone.name, min_order='{:.3f}'.format(zone.min_order)),
                 parse_mode="Markdown"
             )
-            context.user_data["last_message_id"] = message.message_id
-            context.user_data["message_type"] = "alert"
-    elif data == "admin_manage_promos":
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("SELECT code FROM promo_codes")
-            promos = c.fetchall()
-        finally:
-            conn.close()
-        keyboard = [[InlineKeyboardButton(p[0], callback_data=f"admin_promo_{p[0]}")] for p in promos]
-        keyboard.append([
-            InlineKeyboardButton(LANGUAGES[lang]["add_product"], callback_data="admin_add_promo"),
-            InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"admin_store_{context.user_data.get('admin_store_id', 1)}")
-        ])
-        await delete_previous_message(context, user_id)
-        message = await query.message.reply_text(
-            LANGUAGES[lang]["choose_promo"],
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "button"
-    elif data == "admin_add_promo":
+            context.user_data.last_message_id = message.message_id
+            context.user_data.message_type = "alert"
+            await show_cart(query.message, context, lang)
+            return
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["enter_promo"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "alert"
+    conversation.enter(context.user_data, query.from_user.id, "awaiting_promo_code")
+
+@callback_router.route("choose_delivery_admin")
+async def on_choose_delivery_admin(query, context, lang):
+    context.user_data.delivery_time = f"Admin will choose (default {MIN_DELIVERY_TIME} min)"
+    context.user_data.delivery_slot = None
+    await choose_payment(query.message, context, lang)
+
+@callback_router.route("choose_delivery_next")
+async def on_choose_delivery_next(query, context, lang):
+    slot = await delivery_slots.next_free(context.user_data.store_id)
+    context.user_data.delivery_time = format_delivery_time(delivery_slots.start_of(slot))
+    context.user_data.delivery_slot = delivery_slots.key(slot)
+    await choose_payment(query.message, context, lang)
+
+@callback_router.route("choose_delivery_custom")
+async def on_choose_delivery_custom(query, context, lang):
+    user_id = query.from_user.id
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["enter_delivery_time"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "alert"
+    conversation.enter(context.user_data, query.from_user.id, "awaiting_custom_delivery_time")
+
+@callback_router.route("payment_coins")
+async def on_payment_coins(query, context, lang):
+    user_id = query.from_user.id
+    coins = (await user_cache.get(user_id))["coins"]
+    quote = await checkout_quotes.current(context.user_data)
+    if quote is None or to_minor(coins) >= quote.total:
+        # submit_order reports an empty cart or a promo that ran out
+        context.user_data.payment_type = "coins"
+        await submit_order(query, context, lang)
+    else:
         await delete_previous_message(context, user_id)
         message = await query.message.reply_text(
-            LANGUAGES[lang]["enter_promo_code"],
+            LANGUAGES[lang]["insufficient_coins"],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = "admin_awaiting_promo_code"
-    elif data.startswith("admin_product_"):
-        product_id = int(data.split("_")[2])
-        keyboard = [
-            [InlineKeyboardButton(LANGUAGES[lang]["edit_product"], callback_data=f"admin_edit_product_{product_id}"),
-             InlineKeyboardButton(LANGUAGES[lang]["delete_product"], callback_data=f"admin_delete_product_{product_id}")],
-            [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="admin_view_products")]
-        ]
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "alert"
+        await show_cart(query.message, context, lang)
+
+@callback_router.route("admin_store_", parse=int)
+async def on_admin_store(query, context, lang, store_id):
+    user_id = query.from_user.id
+    context.user_data.admin_store_id = store_id
+    keyboard = [
+        [InlineKeyboardButton(LANGUAGES[lang]["add_product"], callback_data="admin_add_product"),
+         InlineKeyboardButton(LANGUAGES[lang]["view_products"], callback_data="admin_view_products")],
+        [InlineKeyboardButton(LANGUAGES[lang]["manage_promos"], callback_data="admin_manage_promos"),
+         InlineKeyboardButton("🗺 Delivery zones", callback_data="admin_zones")],
+        [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="admin_menu")]
+    ]
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["admin_menu"],
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "button"
+
+@callback_router.route("admin_menu")
+async def on_admin_menu(query, context, lang):
+    await show_admin_panel(query.message, context, lang)
+
+@callback_router.route("admin_add_product")
+async def on_admin_add_product(query, context, lang):
+    user_id = query.from_user.id
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["enter_product_name"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "alert"
+    conversation.enter(context.user_data, query.from_user.id, "admin_awaiting_product_name")
+
+@callback_router.route("admin_view_products")
+async def on_admin_view_products(query, context, lang):
+    user_id = query.from_user.id
+    store_id = context.user_data.admin_store_id
+    products = await catalog.products(store_id)
+    if products:
+        keyboard = [[InlineKeyboardButton(f"{p.name}", callback_data=f"admin_product_{p.id}")] for p in products]
+        keyboard.append([InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"admin_store_{store_id}")])
         await delete_previous_message(context, user_id)
         message = await query.message.reply_text(
             LANGUAGES[lang]["choose_product"],
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "button"
-    elif data.startswith("admin_delete_product_"):
-        product_id = int(data.split("_")[3])
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("DELETE FROM products WHERE id = ?", (product_id,))
-            conn.commit()
-        finally:
-            conn.close()
-        await delete_previous_message(context, user_id)
-        message = await query.message.reply_text(
-            LANGUAGES[lang]["delete_product"],
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
-        await show_admin_panel(query.message, context, lang)
-    elif data.startswith("admin_promo_"):
-        promo_code = data.split("_", 2)[2]
-        keyboard = [
-            [InlineKeyboardButton(LANGUAGES[lang]["delete_promo"], callback_data=f"admin_delete_promo_{promo_code}")],
-            [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="admin_manage_promos")]
-        ]
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "button"
+    else:
+        keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"admin_store_{store_id}")]]
         await delete_previous_message(context, user_id)
         message = await query.message.reply_text(
-            f"🎁 *Promo code*: {promo_code}",
+            LANGUAGES[lang]["no_products"],
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "button"
-    elif data.startswith("admin_delete_promo_"):
-        promo_code = data.split("_", 3)[3]
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("DELETE FROM promo_codes WHERE code = ?", (promo_code,))
-            conn.commit()
-        finally:
-            conn.close()
-        await delete_previous_message(context, user_id)
-        message = await query.message.reply_text(
-            LANGUAGES[lang]["delete_promo"],
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
-        await show_admin_panel(query.message, context, lang)
-    elif data.startswith("confirm_order_"):
-        order_id = int(data.split("_")[2])
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("SELECT user_id, delivery_time FROM orders WHERE order_id = ?", (order_id,))
-            order = c.fetchone()
-            if order:
-                c.execute("UPDATE orders SET status = 'confirmed' WHERE order_id = ?", (order_id,))
-                conn.commit()
-                await context.bot.send_message(
-                    order[0],
-                    LANGUAGES[lang]["order_confirmed"].format(time=order[1]),
-                    parse_mode="Markdown"
-                )
-                await context.bot.send_message(
-                    order[0],
-                    LANGUAGES[lang]["feedback_prompt"],
-                    parse_mode="Markdown"
-                )
-                context.user_data["state"] = "awaiting_feedback"
-                context.user_data["pending_alert"] = False
-        finally:
-            conn.close()
-        await show_admin_panel(query.message, context, lang)
-    elif data == "search_products":
-        await delete_previous_message(context, user_id)
-        message = await query.message.reply_text(
-            "🔍 Enter your search query (e.g., product name or description):",
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = "awaiting_search_query"
-    elif data.startswith("approve_coin_"):
-        coin_request_id = int(data.split("_")[2])
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("SELECT user_id, amount FROM coin_requests WHERE id = ? AND status = 'pending'", (coin_request_id,))
-            request = c.fetchone()
-            if request:
-                user_id, amount = request
-                c.execute("UPDATE users SET coins = coins + ? WHERE user_id = ?", (amount, user_id))
-                c.execute("UPDATE coin_requests SET status = 'approved' WHERE id = ?", (coin_request_id,))
-                conn.commit()
-                await context.bot.send_message(
-                    user_id,
-                    LANGUAGES[lang]["coin_request_approved"].format(amount=amount),
-                    parse_mode="Markdown"
-                )
-                await query.message.reply_text(
-                    f"✅ Coin request {coin_request_id} approved for user {user_id}.",
-                    parse_mode="Markdown"
-                )
-            else:
-                await query.message.reply_text(
-                    "❌ Coin request not found or already processed.",
-                    parse_mode="Markdown"
-                )
-        finally:
-            conn.close()
-        await show_admin_panel(query.message, context, lang)
-    elif data.startswith("reject_coin_"):
-        coin_request_id = int(data.split("_")[2])
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("SELECT user_id FROM coin_requests WHERE id = ? AND status = 'pending'", (coin_request_id,))
-            request = c.fetchone()
-            if request:
-                user_id = request[0]
-                c.execute("UPDATE coin_requests SET status = 'rejected' WHERE id = ?", (coin_request_id,))
-                conn.commit()
-                await context.bot.send_message(
-                    user_id,
-                    LANGUAGES[lang]["coin_request_rejected"],
-                    parse_mode="Markdown"
-                )
-                await query.message.reply_text(
-                    f"❌ Coin request {coin_request_id} rejected for user {user_id}.",
-                    parse_mode="Markdown"
-                )
-            else:
-                await query.message.reply_text(
-                    "❌ Coin request not found or already processed.",
-                    parse_mode="Markdown"
-                )
-        finally:
-            conn.close()
-        await show_admin_panel(query.message, context, lang)
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "alert"
+
+@callback_router.route("admin_manage_promos")
+async def on_admin_manage_promos(query, context, lang):
+    user_id = query.from_user.id
+    promos = await db.fetchall("SELECT code FROM promo_codes")
+    keyboard = [[InlineKeyboardButton(p[0], callback_data=f"admin_promo_{p[0]}")] for p in promos]
+    keyboard.append([
+        InlineKeyboardButton(LANGUAGES[lang]["add_product"], callback_data="admin_add_promo"),
+        InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"admin_store_{context.user_data.admin_store_id}")
+    ])
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["choose_promo"],
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "button"
+
+@callback_router.route("admin_add_promo")
+async def on_admin_add_promo(query, context, lang):
+    user_id = query.from_user.id
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["enter_promo_code"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "alert"
+    conversation.enter(context.user_data, query.from_user.id, "admin_awaiting_promo_code")
+
+@callback_router.route("admin_product_", parse=int)
+async def on_admin_product(query, context, lang, product_id):
+    user_id = query.from_user.id
+    keyboard = [
+        [InlineKeyboardButton(LANGUAGES[lang]["edit_product"], callback_data=f"admin_edit_product_{product_id}"),
+         InlineKeyboardButton(LANGUAGES[lang]["delete_product"], callback_data=f"admin_delete_product_{product_id}")],
+        [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="admin_view_products")]
+    ]
+    orders_count, sold, revenue = await db.fetchone(SQL_PRODUCT_SALES, (product_id,))
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["choose_product"] + f"\n📊 Sold: {sold or 0} in {orders_count} orders ({'{:.3f}'.format(revenue or 0)} UZS)",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "button"
+
+@callback_router.route("admin_delete_product_", parse=int)
+async def on_admin_delete_product(query, context, lang, product_id):
+    user_id = query.from_user.id
+    await db.execute("DELETE FROM products WHERE id = ?", (product_id,))
+    catalog.invalidate()
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["delete_product"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "alert"
+    await show_admin_panel(query.message, context, lang)
+
+@callback_router.route("admin_promo_")
+async def on_admin_promo(query, context, lang, promo_code):
+    user_id = query.from_user.id
+    keyboard = [
+        [InlineKeyboardButton(LANGUAGES[lang]["delete_promo"], callback_data=f"admin_delete_promo_{promo_code}")],
+        [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="admin_manage_promos")]
+    ]
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        f"🎁 *Promo code*: {promo_code}",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "button"
+
+@callback_router.route("admin_delete_promo_")
+async def on_admin_delete_promo(query, context, lang, promo_code):
+    user_id = query.from_user.id
+    await db.execute("DELETE FROM promo_codes WHERE code = ?", (promo_code,))
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["delete_promo"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "alert"
+    await show_admin_panel(query.message, context, lang)
+
+@callback_router.route("admin_zones")
+async def on_admin_zones(query, context, lang):
+    user_id = query.from_user.id
+    store_id = context.user_data.admin_store_id
+    zones = await delivery_zones.zones(store_id)
+    keyboard = [[InlineKeyboardButton(f"{z.name} ({'{:.3f}'.format(z.fee)} UZS, {z.eta_minutes} min)", callback_data=f"admin_zone_{z.id}")]
+                for z in zones]
+    keyboard.append([InlineKeyboardButton("➕ Add zone", callback_data="admin_add_zone"),
+                     InlineKeyboardButton("📊 Orders by zone", callback_data="admin_zone_report")])
+    keyboard.append([InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"admin_store_{store_id}")])
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        "🗺 *Delivery zones*" if zones else "🗺 No delivery zones: delivery is priced by distance.",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "button"
+
+@callback_router.route("admin_add_zone")
+async def on_admin_add_zone(query, context, lang):
+    user_id = query.from_user.id
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        "🗺 Send the zone as:\n`Name | fee | minimum order | ETA minutes | lat,lon; lat,lon; lat,lon; ...`\n"
+        "Start the line with `*` to make the zone apply to every store.",
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "alert"
+    conversation.enter(context.user_data, query.from_user.id, "admin_awaiting_zone")
+
+@callback_router.route("admin_zone_", parse=int)
+async def on_admin_zone(query, context, lang, zone_id):
+    user_id = query.from_user.id
+    keyboard = [
+        [InlineKeyboardButton("🗑 Delete zone", callback_data=f"admin_delete_zone_{zone_id}")],
+        [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="admin_zones")]
+    ]
+    zone = await db.fetchone("SELECT name, fee, min_order, eta_minutes, polygon FROM delivery_zones WHERE id = ?", (zone_id,))
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        f"🗺 *{zone[0]}*: fee {'{:.3f}'.format(zone[1])} UZS, minimum {'{:.3f}'.format(zone[2])} UZS, "
+        f"ETA {zone[3]} min, {len(json.loads(zone[4]))} points" if zone else "❌ Zone not found.",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "button"
+
+@callback_router.route("admin_delete_zone_", parse=int)
+async def on_admin_delete_zone(query, context, lang, zone_id):
+    await db.execute("DELETE FROM delivery_zones WHERE id = ?", (zone_id,))
+    delivery_zones.invalidate()
+    await on_admin_zones(query, context, lang)
+
+@callback_router.route("admin_zone_report")
+async def on_admin_zone_report(query, context, lang):
+    user_id = query.from_user.id
+    report = await delivery_zones.order_report()
+    lines = [f"• {name}: {count} orders, {'{:.3f}'.format(revenue)} UZS"
+             for name, (count, revenue) in sorted(report.items(), key=lambda item: -item[1][0])]
+    keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="admin_zones")]]
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        "📊 *Orders by zone*\n" + ("\n".join(lines) if lines else "No orders with a location yet."),
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "button"
+
+@callback_router.route("confirm_order_", parse=int)
+async def on_confirm_order(query, context, lang, order_id):
+    def _confirm_order(c):
+        # Only a pending order can be confirmed; no row means the timeout sweep
+        # (or another admin) got to it first, and a cancelled order stays cancelled
+        c.execute("UPDATE orders SET status = 'confirmed' WHERE order_id = ? AND status = 'pending' "
+                  "RETURNING user_id, delivery_time", (order_id,))
+        rows = c.fetchall()
+        return rows[0] if rows else None
+    order = await db.run(_confirm_order)
+    order_timeouts.cancel(order_id)
+    if order:
+        await context.bot.send_message(
+            order[0],
+            LANGUAGES[lang]["order_confirmed"].format(time=order[1]),
+            parse_mode="Markdown",
+            rate_limit_args=PRIORITY_ADMIN
+        )
+        await context.bot.send_message(
+            order[0],
+            LANGUAGES[lang]["feedback_prompt"],
+            parse_mode="Markdown",
+            rate_limit_args=PRIORITY_ADMIN
+        )
+        # The rating comes from the customer, so the prompt opens their conversation
+        customer_data = context.application.user_data[order[0]]
+        if context.application.persistence:
+            await context.application.persistence.refresh_user_data(order[0], customer_data)
+        conversation.enter(customer_data, order[0], "awaiting_feedback")
+        context.application.mark_data_for_update_persistence(user_ids=[order[0]])
+        context.user_data.pending_alert = False
+    await show_admin_panel(query.message, context, lang)
+
+@callback_router.route("search_products")
+async def on_search_products(query, context, lang):
+    user_id = query.from_user.id
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        "🔍 Enter your search query (e.g., product name or description):",
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "alert"
+    conversation.enter(context.user_data, query.from_user.id, "awaiting_search_query")
+
+# Move a pending coin request to status. The conditional UPDATE is the claim:
+# when two admins answer the same request at once only one gets (user_id,
+# amount) back, the other gets None
+def claim_coin_request(c, coin_request_id, status):
+    c.execute("UPDATE coin_requests SET status = ? WHERE id = ? AND status = 'pending' RETURNING user_id, amount",
+              (status, coin_request_id))
+    rows = c.fetchall()
+    return rows[0] if rows else None
+
+def approve_coin_request(c, coin_request_id):
+    request = claim_coin_request(c, coin_request_id, "approved")
+    if request:
+        c.execute("UPDATE users SET coins = coins + ? WHERE user_id = ?", (request[1], request[0]))
+    return request
+
+def reject_coin_request(c, coin_request_id):
+    return claim_coin_request(c, coin_request_id, "rejected")
+
+@callback_router.route("approve_coin_", parse=int)
+async def on_approve_coin(query, context, lang, coin_request_id):
+    request = await db.run(approve_coin_request, coin_request_id)
+    if request:
+        user_id, amount = request
+        user_cache.invalidate(user_id)
+        await context.bot.send_message(
+            user_id,
+            LANGUAGES[lang]["coin_request_approved"].format(amount=amount),
+            parse_mode="Markdown",
+            rate_limit_args=PRIORITY_ADMIN
+        )
+        await query.message.reply_text(
+            f"✅ Coin request {coin_request_id} approved for user {user_id}.",
+            parse_mode="Markdown"
+        )
+    else:
+        await query.message.reply_text(
+            "❌ Coin request not found or already processed.",
+            parse_mode="Markdown"
+        )
+    await show_admin_panel(query.message, context, lang)
+
+@callback_router.route("reject_coin_", parse=int)
+async def on_reject_coin(query, context, lang, coin_request_id):
+    request = await db.run(reject_coin_request, coin_request_id)
+    if request:
+        user_id = request[0]
+        await context.bot.send_message(
+            user_id,
+            LANGUAGES[lang]["coin_request_rejected"],
+            parse_mode="Markdown",
+            rate_limit_args=PRIORITY_ADMIN
+        )
+        await query.message.reply_text(
+            f"❌ Coin request {coin_request_id} rejected for user {user_id}.",
+            parse_mode="Markdown"
+        )
+    else:
+        await query.message.reply_text(
+            "❌ Coin request not found or already processed.",
+            parse_mode="Markdown"
+        )
+    await show_admin_panel(query.message, context, lang)
+
+
+async def show_delivery_options(message, context: ContextTypes.DEFAULT_TYPE, lang: str):
+    next_slot = delivery_slots.start_of(await delivery_slots.next_free(context.user_data.store_id))
+    keyboard = [
+        [InlineKeyboardButton(LANGUAGES[lang]["next_slot"].format(time=format_delivery_time(next_slot)), callback_data="choose_delivery_next")],
+        [InlineKeyboardButton(LANGUAGES[lang]["admin_choose"], callback_data="choose_delivery_admin")],
+        [InlineKeyboardButton(LANGUAGES[lang]["set_time_myself"], callback_data="choose_delivery_custom")]
+    ]
+    new_message = await message.reply_text(
+        LANGUAGES[lang]["choose_delivery_time"],
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "button"
 
 async def choose_payment(message, context: ContextTypes.DEFAULT_TYPE, lang: str):
-    base_total = context.user_data.get("base_total", 0)
-    delivery_fee = context.user_data.get("delivery_fee", 0)
-    total = base_total + delivery_fee
-    promo_code = context.user_data.get("promo_code")
-    if promo_code and promo_code.lower() != "skip":
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("SELECT discount, usage_count, max_uses FROM promo_codes WHERE code = ?", (promo_code.upper(),))
-            promo = c.fetchone()
-            if promo and promo[1] < promo[2]:
-                discount = float(promo[0]) / 100.0
-                discounted_base_total = base_total * (1 - discount)
-                total = discounted_base_total + delivery_fee
-        except sqlite3.OperationalError as e:
-            logger.error(f"Promo code table error: {e}")
-            promo = None
-        finally:
-            conn.close()
-        if not promo or promo[1] >= promo[2]:
-            await delete_previous_message(context, message.chat_id)
-            new_message = await message.reply_text(
-                LANGUAGES[lang]["invalid_promo"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "alert"
-            await show_cart(message, context, lang)
-            return
-    context.user_data["total_price"] = total
+    quote = await checkout_quotes.current(context.user_data)
+    if quote is None:
+        await delete_previous_message(context, message.chat_id)
+        new_message = await message.reply_text(
+            LANGUAGES[lang]["invalid_promo"],
+            parse_mode="Markdown"
+        )
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "alert"
+        await show_cart(message, context, lang)
+        return
     keyboard = [
         [InlineKeyboardButton(LANGUAGES[lang]["coins"], callback_data="payment_coins")],
         [InlineKeyboardButton(LANGUAGES[lang]["cancel"], callback_data="main_menu")]
     ]
     await delete_previous_message(context, message.chat_id)
     new_message = await message.reply_text(
-        LANGUAGES[lang]["choose_payment"] + f"\n💵 Total: {'{:.3f}'.format(total)} UZS (Delivery: {'{:.3f}'.format(delivery_fee)} UZS)",
+        LANGUAGES[lang]["choose_payment"] + f"\n💵 Total: {format_money(quote.total)} UZS (Delivery: {format_money(quote.delivery_fee)} UZS)",
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode="Markdown"
     )
-    context.user_data["last_message_id"] = new_message.message_id
-    context.user_data["message_type"] = "button"
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "button"
 
 async def submit_order(query, context: ContextTypes.DEFAULT_TYPE, lang: str):
     user_id = query.from_user.id
-    store_id = context.user_data.get("store_id", 1)
-    cart = context.user_data.get("cart", {})
-    delivery_time = context.user_data.get("delivery_time")
-    payment_type = context.user_data.get("payment_type")
-    promo_code = context.user_data.get("promo_code")
-    location = context.user_data.get("location", {})
-    base_total = context.user_data.get("base_total", 0)
-    delivery_fee = context.user_data.get("delivery_fee", 0)
-    total_price = context.user_data.get("total_price", base_total + delivery_fee)
+    store_id = context.user_data.store_id
+    cart = context.user_data.cart
+    delivery_time = context.user_data.delivery_time
+    slot_key = context.user_data.delivery_slot
+    slot = delivery_slots.slot_from_key(slot_key) if slot_key else None
+    payment_type = context.user_data.payment_type
+    location = (context.user_data.location or {})
+    await cart.refresh()
     if not cart:
         await delete_previous_message(context, user_id)
         message = await query.message.reply_text(
             LANGUAGES[lang]["cart_empty"],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "alert"
         await show_main_menu(query.message, context, lang)
         return
-    conn = sqlite3.connect("store_bot.db")
-    try:
-        c = conn.cursor()
-        product_ids = [str(pid) for pid in cart.keys()]
-        c.execute("SELECT id, name, price FROM products WHERE id IN ({})".format(",".join("?" * len(product_ids))), product_ids)
-        product_details = c.fetchall()
+    quote = await checkout_quotes.current(context.user_data)
+    # reserve() reads store capacities inside the transaction
+    await delivery_slots.ensure_loaded()
+    def _place_order(c):
         c.execute("SELECT name, phone FROM users WHERE user_id = ?", (user_id,))
         user_info = c.fetchone()
         c.execute("SELECT name FROM stores WHERE id = ?", (store_id,))
         store_result = c.fetchone()
         store_name = store_result[0] if store_result else "Unknown Store"
-        base_total = 0.0
-        for p in product_details:
-            product_id, _, price = p
-            quantity = cart[str(product_id)]
-            price = round(float(price), 3)
-            base_total += round(price * quantity, 3)
-        total_price = base_total + delivery_fee
-        if promo_code and promo_code.lower() != "skip":
-            c.execute("SELECT discount, usage_count, max_uses FROM promo_codes WHERE code = ?", (promo_code.upper(),))
-            promo = c.fetchone()
-            if promo and promo[1] < promo[2]:
-                discount = float(promo[0]) / 100.0
-                discounted_base_total = base_total * (1 - discount)
-                total_price = discounted_base_total + delivery_fee
-                c.execute("UPDATE promo_codes SET usage_count = usage_count + 1 WHERE code = ?", (promo_code.upper(),))
-            else:
-                await delete_previous_message(context, user_id)
-                message = await query.message.reply_text(
-                    LANGUAGES[lang]["invalid_promo"],
-                    parse_mode="Markdown"
-                )
-                context.user_data["last_message_id"] = message.message_id
-                context.user_data["message_type"] = "alert"
-                await show_cart(query.message, context, lang)
-                return
         if payment_type == "coins":
             c.execute("SELECT coins FROM users WHERE user_id = ?", (user_id,))
             coins = c.fetchone()[0]
-            if coins < total_price:
-                await delete_previous_message(context, user_id)
-                message = await query.message.reply_text(
-                    LANGUAGES[lang]["insufficient_coins"],
-                    parse_mode="Markdown"
-                )
-                context.user_data["last_message_id"] = message.message_id
-                context.user_data["message_type"] = "alert"
-                await show_cart(query.message, context, lang)
-                return
-            c.execute("UPDATE users SET coins = coins - ? WHERE user_id = ?", (total_price, user_id))
-        product_list = ", ".join([f"{p[1]} x{cart[str(p[0])]} ({'{:.3f}'.format(round(float(p[2]) * cart[str(p[0])], 3))} UZS)" for p in product_details])
-        c.execute("INSERT INTO orders (user_id, store_id, products, delivery_time, payment_type, status, promo_code, latitude, longitude, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                  (user_id, store_id, product_list, delivery_time, payment_type, "pending", promo_code,
-                   location.get("latitude"), location.get("longitude"), datetime.now(UZBEKISTAN_TZ).strftime("%Y-%m-%d %H:%M:%S")))
+            if to_minor(coins) < quote.total:
+                return "insufficient_coins", None
+        if slot is not None and not delivery_slots.reserve(c, store_id, slot):
+            c.connection.rollback()
+            return "slot_full", None
+        if quote.promo_code:
+            # Take one use of the promo, only while it has one left at the quoted discount
+            c.execute("UPDATE promo_codes SET usage_count = usage_count + 1 WHERE code = ? AND discount = ? AND usage_count < max_uses",
+                      (quote.promo_code, quote.discount))
+            if c.rowcount == 0:
+                # Undo the slot reservation along with the order
+                c.connection.rollback()
+                return "invalid_promo", None
+        if payment_type == "coins":
+            c.execute("UPDATE users SET coins = coins - ? WHERE user_id = ?", (quote.total / MONEY_SCALE, user_id))
+        items = [(line.product_id, line.name, line.quantity, line.unit_price / MONEY_SCALE) for line in quote.items]
+        product_list = format_order_items([item[1:] for item in items])
+        c.execute("INSERT INTO orders (user_id, store_id, products, delivery_time, payment_type, status, promo_code, latitude, longitude, created_at, delivery_slot) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                  (user_id, store_id, product_list, delivery_time, payment_type, "pending", quote.promo_code,
+                   location.get("latitude"), location.get("longitude"), datetime.now(UZBEKISTAN_TZ).strftime("%Y-%m-%d %H:%M:%S"),
+                   slot_key))
         order_id = c.lastrowid
-        conn.commit()
-        context.user_data["cart"] = {}
-        context.user_data["base_total"] = 0
-        context.user_data["delivery_fee"] = 0
-        context.user_data["total_price"] = 0
+        c.executemany("INSERT INTO order_items (order_id, product_id, name, quantity, unit_price) VALUES (?, ?, ?, ?, ?)",
+                      [(order_id, *item) for item in items])
         order_details = LANGUAGES[lang]["order_details"].format(
             order_id=order_id,
             user_name=user_info[0],
@@ -1333,28 +2751,15 @@ async def submit_order(query, context: ContextTypes.DEFAULT_TYPE, lang: str):
             products=product_list,
             payment=payment_type,
             delivery=delivery_time,
-            total='{:.3f}'.format(total_price),
-            delivery_fee='{:.3f}'.format(delivery_fee)
-        )
-        await delete_previous_message(context, user_id)
-        message = await query.message.reply_text(
-                        LANGUAGES[lang]["order_submitted"],
-            parse_mode="Markdown"
+            total=format_money(quote.total),
+            delivery_fee=format_money(quote.delivery_fee)
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
+        keyboard = [[(LANGUAGES[lang]["confirm_order"], f"confirm_order_{order_id}")]]
         for admin in ADMIN_ID:
-            keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["confirm_order"], callback_data=f"confirm_order_{order_id}")]]
-            try:
-                await context.bot.send_message(
-                    admin,
-                    order_details,
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode="Markdown"
-                )
-            except TelegramError as e:
-                logger.error(f"Failed to notify admin {admin}: {e}")
-        await show_main_menu(query.message, context, lang)
+            enqueue_notification(c, admin, order_details, keyboard=keyboard)
+        return None, order_id
+    try:
+        error, order_id = await db.run(_place_order) if quote else ("invalid_promo", None)
     except sqlite3.OperationalError as e:
         logger.error(f"Database error during order submission: {e}")
         await delete_previous_message(context, user_id)
@@ -1362,83 +2767,98 @@ async def submit_order(query, context: ContextTypes.DEFAULT_TYPE, lang: str):
             LANGUAGES[lang]["error"].format(support=SUPPORT_USERNAME),
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = message.message_id
-        context.user_data["message_type"] = "alert"
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "alert"
         await show_main_menu(query.message, context, lang)
-    finally:
-        conn.close()
-
-async def show_categories(message, context: ContextTypes.DEFAULT_TYPE, lang: str, store_id: int):
-    conn = sqlite3.connect("store_bot.db")
-    try:
-        c = conn.cursor()
-        c.execute("SELECT DISTINCT category FROM products WHERE store_id = ?", (store_id,))
-        categories = [row[0] for row in c.fetchall()]
-    finally:
-        conn.close()
-    if not categories:
-        keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")]]
-        await delete_previous_message(context, message.chat_id)
-        new_message = await message.reply_text(
-            LANGUAGES[lang]["no_products"],
-            reply_markup=InlineKeyboardMarkup(keyboard),
+        return
+    if error:
+        context.user_data.quote = None
+        await delete_previous_message(context, user_id)
+        message = await query.message.reply_text(
+            LANGUAGES[lang][error],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "button"
+        context.user_data.last_message_id = message.message_id
+        context.user_data.message_type = "alert"
+        if error == "slot_full":
+            # Someone took the last place first; offer the next free slot
+            delivery_slots.note_full(store_id, slot)
+            context.user_data.delivery_slot = None
+            await show_delivery_options(query.message, context, lang)
+        else:
+            await show_cart(query.message, context, lang)
         return
-    offset = context.user_data.get("category_offset", 0)
-    categories_batch = categories[offset:offset + ITEMS_PER_BATCH]
-    keyboard = [[InlineKeyboardButton(cat, callback_data=f"category_{cat}")] for cat in categories_batch]
-    if len(categories) > offset + ITEMS_PER_BATCH:
-        keyboard.append([InlineKeyboardButton(LANGUAGES[lang]["load_more"], callback_data="load_more_categories")])
-    keyboard.append([InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")])
-    await delete_previous_message(context, message.chat_id)
-    new_message = await message.reply_text(
-        LANGUAGES[lang]["choose_category"],
-        reply_markup=InlineKeyboardMarkup(keyboard),
+    outbox.wake()
+    order_timeouts.schedule_new(order_id)
+    if slot is not None:
+        delivery_slots.note_reserved(store_id, slot)
+    if payment_type == "coins":
+        user_cache.invalidate(user_id)
+    context.user_data.reset("cart", "delivery_fee", "quote")
+    await delete_previous_message(context, user_id)
+    message = await query.message.reply_text(
+        LANGUAGES[lang]["order_submitted"],
         parse_mode="Markdown"
     )
-    context.user_data["last_message_id"] = new_message.message_id
-    context.user_data["message_type"] = "button"
+    context.user_data.last_message_id = message.message_id
+    context.user_data.message_type = "alert"
+    await show_main_menu(query.message, context, lang)
 
-async def show_products(message, context: ContextTypes.DEFAULT_TYPE, lang: str):
-    store_id = context.user_data.get("store_id", 1)
-    category = context.user_data.get("category")
-    conn = sqlite3.connect("store_bot.db")
-    try:
-        c = conn.cursor()
-        c.execute("SELECT id, name, description, image, price FROM products WHERE store_id = ? AND category = ?",
-                  (store_id, category))
-        products = c.fetchall()
-    finally:
-        conn.close()
-    if not products:
-        keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{store_id}")]]
-        await delete_previous_message(context, message.chat_id)
-        new_message = await message.reply_text(
-            LANGUAGES[lang]["no_products"],
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "button"
-        return
-    offset = context.user_data.get("product_offset", 0)
-    products_batch = products[offset:offset + ITEMS_PER_BATCH]
-    for product in products_batch:
-        product_id, name, description, image, price = product
-        price = round(float(price), 3)
-        text = f"*{name}*\n{description}\n💵 {'{:.3f}'.format(price)} UZS"
-        keyboard = [
-            [InlineKeyboardButton(LANGUAGES[lang]["add_to_cart"], callback_data=f"add_to_cart_{product_id}")],
-            [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"category_{category}")]
-        ]
-        await delete_previous_message(context, message.chat_id)
+def format_product_caption(product):
+    return f"*{product.name}*\n{product.description}\n💵 {'{:.3f}'.format(round(float(product.price), 3))} UZS"
+
+# Send one page of products. gallery and list modes cost one or two Bot API
+# calls per page; cards mode sends a message per product. nav_rows are the
+# keyboard rows (load more, go back) placed under the page.
+async def send_product_page(message, context: ContextTypes.DEFAULT_TYPE, lang: str, products, nav_rows, replace_cards=True):
+    started = time.perf_counter()
+    mode = PRODUCT_LIST_MODE
+    if mode == "gallery" and sum(1 for p in products if p.image) < 2:
+        mode = "list"
+    if mode == "cards":
+        await send_product_cards(message, context, lang, products, nav_rows, replace_cards)
+    else:
+        keyboard = [[InlineKeyboardButton(f"➕ {i}. {p.name}", callback_data=f"add_to_cart_{p.id}")]
+                    for i, p in enumerate(products, start=1)]
+        keyboard.extend(nav_rows)
+        if mode == "gallery":
+            await delete_previous_message(context, message.chat_id)
+            gallery_message_ids = None
+            media = [InputMediaPhoto(media=p.image, caption=f"{i}. {format_product_caption(p)}", parse_mode="Markdown")
+                     for i, p in enumerate(products, start=1) if p.image]
+            try:
+                gallery = await message.reply_media_group(media=media)
+                gallery_message_ids = [m.message_id for m in gallery]
+            except TelegramError as e:
+                logger.error(f"Failed to send product gallery: {e}")
+            text = LANGUAGES[lang]["choose_product"] + "\n" + "\n".join(
+                f"{i}. {p.name} — {'{:.3f}'.format(round(float(p.price), 3))} UZS" for i, p in enumerate(products, start=1))
+            new_message = await message.reply_text(
+                text,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode="Markdown"
+            )
+            context.user_data.last_message_id = new_message.message_id
+            context.user_data.message_type = "button"
+            context.user_data.gallery_message_ids = gallery_message_ids
+        else:
+            text = LANGUAGES[lang]["choose_product"] + "\n\n" + "\n\n".join(
+                f"{i}. {format_product_caption(p)}" for i, p in enumerate(products, start=1))
+            await render_screen(message, context, text, keyboard)
+    logger.debug(f"Product page of {len(products)} rendered in {mode} mode in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+# One message per product, each with its own add-to-cart button
+async def send_product_cards(message, context: ContextTypes.DEFAULT_TYPE, lang: str, products, nav_rows, replace_cards):
+    back_rows = [row for row in nav_rows if not row[0].callback_data.startswith("load_more")]
+    for product in products:
+        text = format_product_caption(product)
+        keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["add_to_cart"], callback_data=f"add_to_cart_{product.id}")], *back_rows]
+        if replace_cards:
+            await delete_previous_message(context, message.chat_id)
         try:
-            if image:
+            if product.image:
                 new_message = await message.reply_photo(
-                    photo=image,
+                    photo=product.image,
                     caption=text,
                     reply_markup=InlineKeyboardMarkup(keyboard),
                     parse_mode="Markdown"
@@ -1449,501 +2869,1353 @@ async def show_products(message, context: ContextTypes.DEFAULT_TYPE, lang: str):
                     reply_markup=InlineKeyboardMarkup(keyboard),
                     parse_mode="Markdown"
                 )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "button"
         except TelegramError as e:
-            logger.error(f"Failed to send product {product_id}: {e}")
+            logger.error(f"Failed to send product {product.id}: {e}")
             new_message = await message.reply_text(
                 text,
                 reply_markup=InlineKeyboardMarkup(keyboard),
                 parse_mode="Markdown"
             )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "button"
-    if len(products) > offset + ITEMS_PER_BATCH:
-        keyboard = [
-            [InlineKeyboardButton(LANGUAGES[lang]["load_more"], callback_data="load_more_products")],
-            [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"category_{category}")]
-        ]
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "button"
+    if len(nav_rows) > len(back_rows):
         new_message = await message.reply_text(
             LANGUAGES[lang]["choose_product"],
+            reply_markup=InlineKeyboardMarkup(nav_rows),
+            parse_mode="Markdown"
+        )
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "button"
+
+async def show_categories(message, context: ContextTypes.DEFAULT_TYPE, lang: str, store_id: int):
+    categories = await catalog.categories_page(store_id, context.user_data.category_cursor)
+    if not categories:
+        keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")]]
+        await render_screen(message, context, LANGUAGES[lang]["no_products"], keyboard)
+        return
+    categories_batch = categories[:ITEMS_PER_BATCH]
+    context.user_data.category_last = categories_batch[-1]
+    keyboard = [[InlineKeyboardButton(cat, callback_data=f"category_{cat}")] for cat in categories_batch]
+    if len(categories) > ITEMS_PER_BATCH:
+        keyboard.append([InlineKeyboardButton(LANGUAGES[lang]["load_more"], callback_data="load_more_categories")])
+    keyboard.append([InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")])
+    await render_screen(message, context, LANGUAGES[lang]["choose_category"], keyboard)
+
+async def show_products(message, context: ContextTypes.DEFAULT_TYPE, lang: str):
+    store_id = context.user_data.store_id
+    category = context.user_data.category
+    products = await catalog.products_page(store_id, category, context.user_data.product_cursor)
+    if not products:
+        keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{store_id}")]]
+        await delete_previous_message(context, message.chat_id)
+        new_message = await message.reply_text(
+            LANGUAGES[lang]["no_products"],
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "button"
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "button"
+        return
+    products_batch = products[:ITEMS_PER_BATCH]
+    nav_rows = []
+    if len(products) > ITEMS_PER_BATCH:
+        nav_rows.append([InlineKeyboardButton(LANGUAGES[lang]["load_more"], callback_data=f"load_more_products_{products_batch[-1].id}")])
+    nav_rows.append([InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"category_{category}")])
+    await send_product_page(message, context, lang, products_batch, nav_rows)
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     text = update.message.text.strip() if update.message.text else ""
-    conn = sqlite3.connect("store_bot.db")
-    try:
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        user = c.fetchone()
-        lang = user[0] if user else context.user_data.get("language", "en")
-    finally:
-        conn.close()
-    state = context.user_data.get("state", "")
+    user = await user_cache.get(user_id)
+    lang = user["language"] if user else context.user_data.language or "en"
     await delete_previous_message(context, user_id)
-    if state == "awaiting_name":
-        context.user_data["name"] = text
+    await conversation.dispatch("text", update, context, lang, text)
+
+@conversation.state("awaiting_name", transitions=("awaiting_phone",))
+async def on_name_entered(update, context, lang, text):
+    context.user_data.name = text
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["enter_phone"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    return "awaiting_phone"
+
+@conversation.state("awaiting_phone")
+async def on_phone_entered(update, context, lang, text):
+    if re.match(r"^\+998\d{9}$", text):
+        await db.execute("INSERT INTO users (user_id, name, phone, language) VALUES (?, ?, ?, ?)",
+                         (update.effective_user.id, context.user_data.name, text, context.user_data.language))
+        user_cache.invalidate(update.effective_user.id)
+        await show_main_menu(update.message, context, context.user_data.language)
+        return ""
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["invalid_phone"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    return "awaiting_phone"
+
+@conversation.state("awaiting_new_name", ttl=STATE_TTL)
+async def on_new_name_entered(update, context, lang, text):
+    user_id = update.effective_user.id
+    await db.execute("UPDATE users SET name = ? WHERE user_id = ?", (text, user_id))
+    user_cache.invalidate(user_id)
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["change_name"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    await show_main_menu(update.message, context, lang)
+    return ""
+
+@conversation.state("awaiting_coin_amount", transitions=("awaiting_coin_receipt",), ttl=STATE_TTL)
+async def on_coin_amount_entered(update, context, lang, text):
+    try:
+        amount = float(text.replace(",", "."))
+        if amount <= 0:
+            raise ValueError("Amount must be positive")
+    except ValueError:
         new_message = await update.message.reply_text(
-            LANGUAGES[lang]["enter_phone"],
+            LANGUAGES[lang]["invalid_coin_amount"],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = "awaiting_phone"
-    elif state == "awaiting_phone":
-        if re.match(r"^\+998\d{9}$", text):
-            conn = sqlite3.connect("store_bot.db")
-            try:
-                c = conn.cursor()
-                c.execute("INSERT INTO users (user_id, name, phone, language) VALUES (?, ?, ?, ?)",
-                          (user_id, context.user_data["name"], text, context.user_data["language"]))
-                conn.commit()
-            finally:
-                conn.close()
-            context.user_data["state"] = ""
-            await show_main_menu(update.message, context, context.user_data["language"])
-        else:
-            new_message = await update.message.reply_text(
-                LANGUAGES[lang]["invalid_phone"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "alert"
-            context.user_data["state"] = "awaiting_phone"
-    elif state == "awaiting_new_name":
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("UPDATE users SET name = ? WHERE user_id = ?", (text, user_id))
-            conn.commit()
-        finally:
-            conn.close()
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "alert"
+        return "awaiting_coin_amount"
+    context.user_data.coin_amount = amount
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["send_coin_check"].format(amount='{:.3f}'.format(amount * EXCHANGE_RATE)),
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    return "awaiting_coin_receipt"
+
+@conversation.state("awaiting_promo_code", ttl=STATE_TTL)
+async def on_promo_code_entered(update, context, lang, text):
+    context.user_data.promo_code = text
+    context.user_data.quote = await checkout_quotes.build(context.user_data)
+    if context.user_data.quote is None:
         new_message = await update.message.reply_text(
-            LANGUAGES[lang]["change_name"],
+            LANGUAGES[lang]["invalid_promo"],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = ""
-        await show_main_menu(update.message, context, lang)
-    elif state == "awaiting_coin_amount":
-        try:
-            amount = float(text.replace(",", "."))
-            if amount <= 0:
-                raise ValueError("Amount must be positive")
-            context.user_data["coin_amount"] = amount
-            new_message = await update.message.reply_text(
-                LANGUAGES[lang]["send_coin_check"].format(amount='{:.3f}'.format(amount * EXCHANGE_RATE)),
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "alert"
-            context.user_data["state"] = "awaiting_coin_receipt"
-        except ValueError:
-            new_message = await update.message.reply_text(
-                LANGUAGES[lang]["invalid_coin_amount"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "alert"
-            context.user_data["state"] = "awaiting_coin_amount"
-    elif state == "awaiting_promo_code":
-        context.user_data["promo_code"] = text
-        keyboard = [
-            [InlineKeyboardButton(LANGUAGES[lang]["next_slot"].format(time=get_next_delivery_slot()), callback_data="choose_delivery_next")],
-            [InlineKeyboardButton(LANGUAGES[lang]["admin_choose"], callback_data="choose_delivery_admin")],
-            [InlineKeyboardButton(LANGUAGES[lang]["set_time_myself"], callback_data="choose_delivery_custom")]
-        ]
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "alert"
+        await show_cart(update.message, context, lang)
+        return ""
+    await show_delivery_options(update.message, context, lang)
+    return ""
+
+@conversation.state("awaiting_custom_delivery_time", ttl=STATE_TTL)
+async def on_delivery_time_entered(update, context, lang, text):
+    delivery_at, error = parse_delivery_time(text, lang)
+    if not error:
+        store_id = context.user_data.store_id
+        slot = delivery_slots.slot_of(delivery_at)
+        if not await delivery_slots.has_room(store_id, slot):
+            next_slot = delivery_slots.start_of(await delivery_slots.next_free(store_id))
+            error = LANGUAGES[lang]["slot_taken"].format(time=format_delivery_time(next_slot))
+    if error:
         new_message = await update.message.reply_text(
-            LANGUAGES[lang]["choose_delivery_time"],
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            error,
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "button"
-        context.user_data["state"] = ""
-    elif state == "awaiting_custom_delivery_time":
-        delivery_time, error = parse_delivery_time(text, lang)
-        if error:
-            new_message = await update.message.reply_text(
-                error,
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "alert"
-            context.user_data["state"] = "awaiting_custom_delivery_time"
-        else:
-            context.user_data["delivery_time"] = delivery_time
-            await choose_payment(update.message, context, lang)
-            context.user_data["state"] = ""
-    elif state == "awaiting_feedback":
-        try:
-            rating = int(text)
-            if 1 <= rating <= 5:
-                new_message = await update.message.reply_text(
-                    "🌟 Thank you for your feedback!",
-                    parse_mode="Markdown"
-                )
-                context.user_data["last_message_id"] = new_message.message_id
-                context.user_data["message_type"] = "alert"
-                context.user_data["state"] = ""
-                await show_main_menu(update.message, context, lang)
-            else:
-                new_message = await update.message.reply_text(
-                    LANGUAGES[lang]["invalid_feedback"],
-                    parse_mode="Markdown"
-                )
-                context.user_data["last_message_id"] = new_message.message_id
-                context.user_data["message_type"] = "alert"
-        except ValueError:
-            new_message = await update.message.reply_text(
-                LANGUAGES[lang]["invalid_feedback"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "alert"
-    elif state == "admin_awaiting_product_name":
-        context.user_data["product_name"] = text
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "alert"
+        return "awaiting_custom_delivery_time"
+    context.user_data.delivery_time = format_delivery_time(delivery_at)
+    context.user_data.delivery_slot = delivery_slots.key(slot)
+    await choose_payment(update.message, context, lang)
+    return ""
+
+@conversation.state("awaiting_feedback", ttl=FEEDBACK_TTL)
+async def on_feedback_entered(update, context, lang, text):
+    try:
+        rating = int(text)
+    except ValueError:
+        rating = 0
+    if 1 <= rating <= 5:
         new_message = await update.message.reply_text(
-            LANGUAGES[lang]["enter_product_desc"],
+            "🌟 Thank you for your feedback!",
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = "admin_awaiting_product_description"
-    elif state == "admin_awaiting_product_description":
-        context.user_data["product_description"] = text
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "alert"
+        await show_main_menu(update.message, context, lang)
+        return ""
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["invalid_feedback"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    return "awaiting_feedback"
+
+# Admin product entry: name, description, price and category, then the photo
+@conversation.state("admin_awaiting_product_name", transitions=("admin_awaiting_product_description",), ttl=STATE_TTL)
+async def on_product_name_entered(update, context, lang, text):
+    context.user_data.product_name = text
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["enter_product_desc"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    return "admin_awaiting_product_description"
+
+@conversation.state("admin_awaiting_product_description", transitions=("admin_awaiting_product_price",),
+                    ttl=STATE_TTL, data=("product_name",))
+async def on_product_description_entered(update, context, lang, text):
+    context.user_data.product_description = text
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["enter_product_price"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    return "admin_awaiting_product_price"
+
+@conversation.state("admin_awaiting_product_price", transitions=("admin_awaiting_product_category",),
+                    ttl=STATE_TTL, data=("product_name", "product_description"))
+async def on_product_price_entered(update, context, lang, text):
+    try:
+        price = float(text.replace(",", "."))
+        if price <= 0:
+            raise ValueError("Price must be positive")
+    except ValueError:
         new_message = await update.message.reply_text(
-            LANGUAGES[lang]["enter_product_price"],
+            LANGUAGES[lang]["invalid_coin_amount"],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = "admin_awaiting_product_price"
-    elif state == "admin_awaiting_product_price":
-        try:
-            price = float(text.replace(",", "."))
-            if price <= 0:
-                raise ValueError("Price must be positive")
-            context.user_data["product_price"] = price
-            new_message = await update.message.reply_text(
-                LANGUAGES[lang]["enter_product_category"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "alert"
-            context.user_data["state"] = "admin_awaiting_product_category"
-        except ValueError:
-            new_message = await update.message.reply_text(
-                LANGUAGES[lang]["invalid_coin_amount"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "alert"
-            context.user_data["state"] = "admin_awaiting_product_price"
-    elif state == "admin_awaiting_product_category":
-        context.user_data["product_category"] = text
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "alert"
+        return "admin_awaiting_product_price"
+    context.user_data.product_price = price
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["enter_product_category"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    return "admin_awaiting_product_category"
+
+@conversation.state("admin_awaiting_product_category", transitions=("admin_awaiting_product_image",),
+                    ttl=STATE_TTL, data=("product_name", "product_description", "product_price"))
+async def on_product_category_entered(update, context, lang, text):
+    context.user_data.product_category = text
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["upload_product_image"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    return "admin_awaiting_product_image"
+
+# Admin promo entry: code, discount percentage, then the usage limit
+@conversation.state("admin_awaiting_promo_code", transitions=("admin_awaiting_promo_discount",), ttl=STATE_TTL)
+async def on_admin_promo_code_entered(update, context, lang, text):
+    context.user_data.promo_code = text.upper()
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["enter_promo_discount"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    return "admin_awaiting_promo_discount"
+
+@conversation.state("admin_awaiting_promo_discount", transitions=("admin_awaiting_promo_max_uses",),
+                    ttl=STATE_TTL, data=("promo_code",))
+async def on_admin_promo_discount_entered(update, context, lang, text):
+    try:
+        discount = float(text)
+        if not (1 <= discount <= 100):
+            raise ValueError("Discount must be between 1 and 100")
+    except ValueError:
         new_message = await update.message.reply_text(
-            LANGUAGES[lang]["upload_product_image"],
+            LANGUAGES[lang]["invalid_coin_amount"],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = "admin_awaiting_product_image"
-    elif state == "admin_awaiting_promo_code":
-        context.user_data["promo_code"] = text.upper()
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "alert"
+        return "admin_awaiting_promo_discount"
+    context.user_data.promo_discount = discount
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["enter_promo_max_uses"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    return "admin_awaiting_promo_max_uses"
+
+@conversation.state("admin_awaiting_promo_max_uses", ttl=STATE_TTL, data=("promo_code", "promo_discount"))
+async def on_admin_promo_max_uses_entered(update, context, lang, text):
+    try:
+        max_uses = int(text)
+        if max_uses <= 0:
+            raise ValueError("Max uses must be positive")
+    except ValueError:
         new_message = await update.message.reply_text(
-            LANGUAGES[lang]["enter_promo_discount"],
+            LANGUAGES[lang]["invalid_coin_amount"],
             parse_mode="Markdown"
         )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = "admin_awaiting_promo_discount"
-    elif state == "admin_awaiting_promo_discount":
-        try:
-            discount = float(text)
-            if not (1 <= discount <= 100):
-                raise ValueError("Discount must be between 1 and 100")
-            context.user_data["promo_discount"] = discount
-            new_message = await update.message.reply_text(
-                LANGUAGES[lang]["enter_promo_max_uses"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "alert"
-            context.user_data["state"] = "admin_awaiting_promo_max_uses"
-        except ValueError:
-            new_message = await update.message.reply_text(
-                LANGUAGES[lang]["invalid_coin_amount"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "alert"
-            context.user_data["state"] = "admin_awaiting_promo_discount"
-    elif state == "admin_awaiting_promo_max_uses":
-        try:
-            max_uses = int(text)
-            if max_uses <= 0:
-                raise ValueError("Max uses must be positive")
-            conn = sqlite3.connect("store_bot.db")
-            try:
-                c = conn.cursor()
-                c.execute("INSERT INTO promo_codes (code, discount, max_uses) VALUES (?, ?, ?)",
-                          (context.user_data["promo_code"], context.user_data["promo_discount"], max_uses))
-                conn.commit()
-            finally:
-                conn.close()
-            new_message = await update.message.reply_text(
-                LANGUAGES[lang]["promo_added"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "alert"
-            context.user_data["state"] = ""
-            await show_admin_panel(update.message, context, lang)
-        except ValueError:
-            new_message = await update.message.reply_text(
-                LANGUAGES[lang]["invalid_coin_amount"],
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "alert"
-            context.user_data["state"] = "admin_awaiting_promo_max_uses"
-    elif state == "awaiting_search_query":
-        search_query = text.lower()
-        store_id = context.user_data.get("store_id", 1)
-        conn = sqlite3.connect("store_bot.db")
-        try:
-            c = conn.cursor()
-            c.execute("""
-                SELECT id, name, description, image, price
-                FROM products
-                WHERE store_id = ? AND (LOWER(name) LIKE ? OR LOWER(description) LIKE ?)
-                LIMIT ?
-            """, (store_id, f"%{search_query}%", f"%{search_query}%", ITEMS_PER_BATCH))
-            products = c.fetchall()
-        finally:
-            conn.close()
-        if not products:
-            keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{store_id}")]]
-            new_message = await update.message.reply_text(
-                LANGUAGES[lang]["no_products"],
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode="Markdown"
-            )
-            context.user_data["last_message_id"] = new_message.message_id
-            context.user_data["message_type"] = "button"
-            context.user_data["state"] = ""
-            return
-        for product in products:
-            product_id, name, description, image, price = product
-            price = round(float(price), 3)
-            text = f"*{name}*\n{description}\n💵 {'{:.3f}'.format(price)} UZS"
-            keyboard = [
-                [InlineKeyboardButton(LANGUAGES[lang]["add_to_cart"], callback_data=f"add_to_cart_{product_id}")],
-                [InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{store_id}")]
-            ]
-            try:
-                if image:
-                    new_message = await update.message.reply_photo(
-                        photo=image,
-                        caption=text,
-                        reply_markup=InlineKeyboardMarkup(keyboard),
-                        parse_mode="Markdown"
-                    )
-                else:
-                    new_message = await update.message.reply_text(
-                        text,
-                        reply_markup=InlineKeyboardMarkup(keyboard),
-                        parse_mode="Markdown"
-                    )
-                context.user_data["last_message_id"] = new_message.message_id
-                context.user_data["message_type"] = "button"
-            except TelegramError as e:
-                logger.error(f"Failed to send product {product_id}: {e}")
-                new_message = await update.message.reply_text(
-                    text,
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode="Markdown"
-                )
-                context.user_data["last_message_id"] = new_message.message_id
-                context.user_data["message_type"] = "button"
-        context.user_data["state"] = ""
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "alert"
+        return "admin_awaiting_promo_max_uses"
+    await db.execute("INSERT INTO promo_codes (code, discount, max_uses) VALUES (?, ?, ?)",
+                     (context.user_data.promo_code, context.user_data.promo_discount, max_uses))
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["promo_added"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    await show_admin_panel(update.message, context, lang)
+    return ""
+
+@conversation.state("admin_awaiting_zone", ttl=STATE_TTL)
+async def on_admin_zone_entered(update, context, lang, text):
+    try:
+        all_stores = text.startswith("*")
+        name, fee, min_order, eta_minutes, points = (part.strip() for part in text.lstrip("*").split("|"))
+        polygon = parse_zone_polygon(points)
+        if not name or float(fee) < 0 or float(min_order) < 0 or int(eta_minutes) <= 0:
+            raise ValueError("Invalid zone values")
+    except ValueError:
+        new_message = await update.message.reply_text(
+            "❌ Could not read the zone. Use `Name | fee | minimum order | ETA minutes | lat,lon; lat,lon; lat,lon`.",
+            parse_mode="Markdown"
+        )
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "alert"
+        return "admin_awaiting_zone"
+    await db.execute(
+        "INSERT INTO delivery_zones (store_id, name, fee, min_order, eta_minutes, polygon) VALUES (?, ?, ?, ?, ?, ?)",
+        (None if all_stores else context.user_data.admin_store_id, name, float(fee), float(min_order),
+         int(eta_minutes), json.dumps(polygon)))
+    delivery_zones.invalidate()
+    new_message = await update.message.reply_text(
+        f"✅ Zone {name} added.",
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    await show_admin_panel(update.message, context, lang)
+    return ""
+
+@conversation.state("awaiting_search_query", ttl=STATE_TTL)
+async def on_search_query_entered(update, context, lang, text):
+    search_query = build_search_query(text)
+    store_id = context.user_data.store_id
+    products = []
+    if search_query:
+        rows = await db.fetchall("""
+            SELECT p.id, p.name, p.description, p.image, p.price, p.category, p.store_id
+            FROM products_fts
+            JOIN products p ON p.id = products_fts.rowid
+            WHERE products_fts MATCH ? AND p.store_id = ?
+            ORDER BY bm25(products_fts, 10.0, 2.0, 5.0)
+            LIMIT ?
+        """, (search_query, store_id, ITEMS_PER_BATCH))
+        products = [Product(*row) for row in rows]
+    if not products:
+        keyboard = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{store_id}")]]
+        new_message = await update.message.reply_text(
+            LANGUAGES[lang]["no_products"],
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode="Markdown"
+        )
+        context.user_data.last_message_id = new_message.message_id
+        context.user_data.message_type = "button"
+        return ""
+    nav_rows = [[InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data=f"store_{store_id}")]]
+    await send_product_page(update.message, context, lang, products, nav_rows, replace_cards=False)
+    return ""
+
+# Shared locations are handled in any state; the state only times out the prompt
+conversation.add("awaiting_location", kind="location", ttl=STATE_TTL)
 
 async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     location = update.message.location
-    conn = sqlite3.connect("store_bot.db")
-    try:
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        user = c.fetchone()
-        lang = user[0] if user else context.user_data.get("language", "en")
-    finally:
-        conn.close()
-    context.user_data["location"] = {"latitude": location.latitude, "longitude": location.longitude}
-    keyboard = [
-        [InlineKeyboardButton("ЦУМ", callback_data="store_1"),
-         InlineKeyboardButton("Sergeli", callback_data="store_2")]
-    ]
+    user = await user_cache.get(user_id)
+    lang = user["language"] if user else context.user_data.language or "en"
+    context.user_data.location = {"latitude": location.latitude, "longitude": location.longitude}
+    nearest = await stores_index.nearest(location.latitude, location.longitude)
+    keyboard = []
+    # Price each store the way the cart will, and leave out stores whose zones don't cover the location
+    for store_id, name, distance in nearest:
+        fee, _, deliverable = await delivery_zones.quote(store_id, context.user_data.location)
+        if deliverable:
+            keyboard.append([InlineKeyboardButton(
+                LANGUAGES[lang]["store_option"].format(name=name, distance=f"{distance:.1f}", fee='{:.3f}'.format(fee)),
+                callback_data=f"store_{store_id}"
+            )])
+    if keyboard:
+        text = LANGUAGES[lang]["choose_store"]
+    else:
+        text = LANGUAGES[lang]["outside_delivery_zone"] if nearest else LANGUAGES[lang]["no_open_stores"]
+    keyboard.append([InlineKeyboardButton(LANGUAGES[lang]["go_back"], callback_data="main_menu")])
+    # The store list goes below the shared location, so it is always a new screen
     await delete_previous_message(context, user_id)
+    await render_screen(update.message, context, text, keyboard)
+    conversation.leave(context.user_data)
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    user = await user_cache.get(user_id)
+    lang = user["language"] if user else context.user_data.language or "en"
+    await conversation.dispatch("photo", update, context, lang, update.message.photo[-1].file_id)
+
+@conversation.state("admin_awaiting_product_image", kind="photo", ttl=STATE_TTL,
+                    data=("product_name", "product_description", "product_price", "product_category"))
+async def on_product_image_received(update, context, lang, file_id):
+    store_id = context.user_data.admin_store_id
+    product_data = {
+        "name": context.user_data.product_name,
+        "description": context.user_data.product_description,
+        "price": context.user_data.product_price,
+        "category": context.user_data.product_category,
+        "image": file_id,
+        "store_id": store_id
+    }
+    def _add_product(c):
+        c.execute("""
+            INSERT INTO products (name, description, image, price, category, store_id)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (
+            product_data["name"],
+            product_data["description"],
+            product_data["image"],
+            product_data["price"],
+            product_data["category"],
+            store_id
+        ))
+        product_id = c.lastrowid
+        index_product_search(c, product_id, product_data["name"], product_data["description"], product_data["category"])
+        return product_id
+    product_id = await db.run(_add_product)
+    product_data["id"] = product_id
+    catalog.invalidate()
+    log_product_to_file(product_data)
     new_message = await update.message.reply_text(
-        LANGUAGES[lang]["choose_store"],
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        LANGUAGES[lang]["product_added"],
         parse_mode="Markdown"
     )
-    context.user_data["last_message_id"] = new_message.message_id
-    context.user_data["message_type"] = "button"
-    context.user_data["state"] = ""
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    await show_admin_panel(update.message, context, lang)
+    return ""
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@conversation.state("awaiting_coin_receipt", kind="photo", ttl=STATE_TTL, data=("coin_amount",))
+async def on_coin_receipt_received(update, context, lang, file_id):
     user_id = update.effective_user.id
-    conn = sqlite3.connect("store_bot.db")
-    try:
-        c = conn.cursor()
-        c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-        user = c.fetchone()
-        lang = user[0] if user else context.user_data.get("language", "en")
-    finally:
-        conn.close()
-    state = context.user_data.get("state", "")
-    if state == "admin_awaiting_product_image":
-        photo = update.message.photo[-1]
-        file_id = photo.file_id
-        store_id = context.user_data.get("admin_store_id", 1)
-        product_data = {
-            "name": context.user_data["product_name"],
-            "description": context.user_data["product_description"],
-            "price": context.user_data["product_price"],
-            "category": context.user_data["product_category"],
-            "image": file_id,
-            "store_id": store_id
-        }
-        conn = sqlite3.connect("store_bot.db")
+    amount = context.user_data.coin_amount
+    def _create_coin_request(c):
+        c.execute("""
+            INSERT INTO coin_requests (user_id, amount, status, receipt_file_id, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, (
+            user_id,
+            amount,
+            "pending",
+            file_id,
+            datetime.now(UZBEKISTAN_TZ).strftime("%Y-%m-%d %H:%M:%S")
+        ))
+        coin_request_id = c.lastrowid
+        keyboard = [[("✅ Approve", f"approve_coin_{coin_request_id}"), ("❌ Reject", f"reject_coin_{coin_request_id}")]]
+        for admin in ADMIN_ID:
+            enqueue_notification(c, admin, f"Coin request from user {user_id}: {'{:.3f}'.format(amount)} coins",
+                                 keyboard=keyboard, photo=file_id)
+    await db.run(_create_coin_request)
+    outbox.wake()
+
+    new_message = await update.message.reply_text(
+        LANGUAGES[lang]["coin_request_sent"],
+        parse_mode="Markdown"
+    )
+    context.user_data.last_message_id = new_message.message_id
+    context.user_data.message_type = "alert"
+    await show_main_menu(update.message, context, lang)
+    return ""
+
+# Order timeouts. Every pending order has an event-loop timer for its deadline
+# (created_at + ADMIN_RESPONSE_TIMEOUT); submit_order schedules it after the
+# commit and reschedule() restores timers for survivors at startup. A firing
+# timer runs one set-based UPDATE ... RETURNING that cancels every overdue
+# order, so timers that fire together or a backlog after downtime cost a single
+# statement. Customer notices go through the outbox at bulk priority, written in
+# the same transaction as the cancellation.
+class OrderTimeouts:
+    def __init__(self, timeout_minutes=ADMIN_RESPONSE_TIMEOUT):
+        self.timeout = timedelta(minutes=timeout_minutes)
+        self._timers = {}
+        self._sweep_task = None
+        self._sweep_again = False
+        self.cancelled = 0
+
+    def schedule(self, order_id, deadline):
+        self.cancel(order_id)
+        loop = asyncio.get_running_loop()
+        # One second of slack: created_at only has second resolution
+        delay = max((deadline - datetime.now(UZBEKISTAN_TZ)).total_seconds(), 0.0) + 1.0
+        self._timers[order_id] = loop.call_later(delay, self._expire, order_id)
+
+    def schedule_new(self, order_id):
+        self.schedule(order_id, datetime.now(UZBEKISTAN_TZ) + self.timeout)
+
+    def cancel(self, order_id):
+        timer = self._timers.pop(order_id, None)
+        if timer:
+            timer.cancel()
+
+    async def reschedule(self):
+        orders = await db.fetchall(SQL_PENDING_ORDERS)
+        for order_id, created_at in orders:
+            created = UZBEKISTAN_TZ.localize(datetime.strptime(created_at, "%Y-%m-%d %H:%M:%S"))
+            self.schedule(order_id, created + self.timeout)
+        logger.info(f"Rescheduled timeouts for {len(orders)} pending orders")
+
+    def _expire(self, order_id):
+        self._timers.pop(order_id, None)
+        if self._sweep_task and not self._sweep_task.done():
+            self._sweep_again = True
+            return
+        self._sweep_task = asyncio.create_task(self._sweep_until_idle())
+
+    async def _sweep_until_idle(self):
+        self._sweep_again = True
+        while self._sweep_again:
+            self._sweep_again = False
+            try:
+                await self.sweep()
+            except sqlite3.Error as e:
+                logger.error(f"Order timeout sweep failed: {e}")
+
+    async def sweep(self):
+        cutoff = (datetime.now(UZBEKISTAN_TZ) - self.timeout).strftime("%Y-%m-%d %H:%M:%S")
+        minutes = int(self.timeout.total_seconds() // 60)
+        def _cancel_expired_orders(c):
+            c.execute(SQL_CANCEL_OVERDUE_ORDERS, (cutoff,))
+            orders = c.fetchall()
+            for order_id, user_id, store_id, slot_key in orders:
+                if slot_key:
+                    delivery_slots.release(c, store_id, slot_key)
+                enqueue_notification(c, user_id,
+                                     f"❌ Order {order_id} was cancelled due to no admin response within {minutes} minutes.",
+                                     priority=PRIORITY_BULK)
+            return orders
+        orders = await db.run(_cancel_expired_orders)
+        for order_id, _, store_id, slot_key in orders:
+            self.cancel(order_id)
+            if slot_key:
+                delivery_slots.note_released(store_id, delivery_slots.slot_from_key(slot_key))
+        if orders:
+            self.cancelled += len(orders)
+            logger.info(f"Cancelled {len(orders)} orders with no admin response")
+            outbox.wake()
+        return len(orders)
+
+    def stats(self):
+        return {"timers": len(self._timers), "cancelled": self.cancelled}
+
+order_timeouts = OrderTimeouts()
+
+# Concurrent update processing: up to max_concurrent_updates handlers run at
+# once, but updates from the same user are serialized because context.user_data
+# (cart, state, last_message_id) is shared between them. The concurrency limit is
+# BaseUpdateProcessor's own semaphore (process_update() is final in PTB); the
+# per-user ordering happens inside it, in do_process_update(). An update waiting
+# for its user's turn therefore holds a slot, which only matters for a user with
+# a burst of clicks and is bounded by that burst.
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._user_locks = {}
+        self.pending = 0
+        self.running = 0
+        self.lock_waits = 0
+        self.lock_wait_total = 0.0
+        self.lock_wait_max = 0.0
+
+    @staticmethod
+    def _user_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._user_key(update)
+        if key is None:
+            await self._run(update, coroutine)
+            return
+        entry = self._user_locks.get(key)
+        if entry is None:
+            entry = self._user_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self.pending += 1
+        queued_at = time.perf_counter()
+        started = False
         try:
-            c = conn.cursor()
-            c.execute("""
-                INSERT INTO products (name, description, image, price, category, store_id)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                product_data["name"],
-                product_data["description"],
-                product_data["image"],
-                product_data["price"],
-                product_data["category"],
-                store_id
-            ))
-            product_id = c.lastrowid
-            product_data["id"] = product_id
-            conn.commit()
-            log_product_to_file(product_data)
+            async with entry[0]:
+                waited = time.perf_counter() - queued_at
+                self.lock_waits += 1
+                self.lock_wait_total += waited
+                self.lock_wait_max = max(self.lock_wait_max, waited)
+                self.pending -= 1
+                started = True
+                await self._run(update, coroutine)
         finally:
-            conn.close()
-        new_message = await update.message.reply_text(
-            LANGUAGES[lang]["product_added"],
-            parse_mode="Markdown"
+            if not started:
+                self.pending -= 1
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[key]
+
+    async def _run(self, update, coroutine):
+        self.running += 1
+        started = time.perf_counter()
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+            update_latency.observe(update_type(update), time.perf_counter() - started)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "running": self.running,
+            "locked_users": len(self._user_locks),
+            "lock_wait_avg_ms": self.lock_wait_total / self.lock_waits * 1000 if self.lock_waits else 0.0,
+            "lock_wait_max_ms": self.lock_wait_max * 1000,
+        }
+
+# Transactional outbox. Handlers call enqueue_notification() inside the
+# transaction that creates the order or coin request, then outbox.wake();
+# NotificationOutbox delivers due rows concurrently in the background, retrying
+# failures with exponential backoff and recording the delivery status.
+# keyboard is a list of rows of (text, callback_data) pairs; priority is the
+# rate limiter priority used for delivery (admin by default).
+def enqueue_notification(c, chat_id, text, keyboard=None, photo=None, priority=None):
+    c.execute("INSERT INTO notification_outbox (chat_id, text, photo, keyboard, priority, next_attempt_at, created_at) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?)",
+              (chat_id, text, photo, json.dumps(keyboard) if keyboard else None,
+               PRIORITY_ADMIN if priority is None else priority, time.time(),
+               datetime.now(UZBEKISTAN_TZ).strftime("%Y-%m-%d %H:%M:%S")))
+
+class NotificationOutbox:
+    def __init__(self, max_attempts=OUTBOX_MAX_ATTEMPTS, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL):
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.delivered = 0
+        self.retried = 0
+        self.failed = 0
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self, bot):
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, bot):
+        while True:
+            self._wakeup.clear()
+            try:
+                dispatched = await self.dispatch_due(bot)
+            except Exception as e:
+                logger.error(f"Outbox dispatch failed: {e}")
+                dispatched = 0
+            if dispatched:
+                continue
+            next_due = (await db.fetchone("SELECT MIN(next_attempt_at) FROM notification_outbox WHERE status = 'pending'"))[0]
+            timeout = self.poll_interval if next_due is None else min(max(next_due - time.time(), 0.0), self.poll_interval)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _deliver(self, bot, row):
+        notification_id, chat_id, text, photo, keyboard, attempts, priority = row
+        reply_markup = None
+        if keyboard:
+            reply_markup = InlineKeyboardMarkup([
+                [InlineKeyboardButton(label, callback_data=data) for label, data in buttons]
+                for buttons in json.loads(keyboard)
+            ])
+        try:
+            if photo:
+                await bot.send_photo(chat_id=chat_id, photo=photo, caption=text, reply_markup=reply_markup,
+                                     parse_mode="Markdown", rate_limit_args=priority)
+            else:
+                await bot.send_message(chat_id, text, reply_markup=reply_markup,
+                                       parse_mode="Markdown", rate_limit_args=priority)
+            return notification_id, attempts, None
+        except TelegramError as e:
+            logger.error(f"Failed to deliver notification {notification_id} to {chat_id}: {e}")
+            return notification_id, attempts, str(e)
+
+    # Deliver one batch of due notifications concurrently; returns the batch size
+    async def dispatch_due(self, bot):
+        rows = await db.fetchall(SQL_OUTBOX_DUE, (time.time(), self.batch_size))
+        if not rows:
+            return 0
+        results = await asyncio.gather(*(self._deliver(bot, row) for row in rows))
+        now = time.time()
+        sent_at = datetime.now(UZBEKISTAN_TZ).strftime("%Y-%m-%d %H:%M:%S")
+        sent, retry, failed = [], [], []
+        for notification_id, attempts, error in results:
+            if error is None:
+                sent.append((sent_at, attempts + 1, notification_id))
+            elif attempts + 1 >= self.max_attempts:
+                failed.append((attempts + 1, error, notification_id))
+            else:
+                retry.append((attempts + 1, now + 2 ** attempts, error, notification_id))
+
+        def _record_results(c):
+            c.executemany("UPDATE notification_outbox SET status = 'sent', sent_at = ?, attempts = ? WHERE id = ?", sent)
+            c.executemany("UPDATE notification_outbox SET attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?", retry)
+            c.executemany("UPDATE notification_outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?", failed)
+        await db.run(_record_results)
+        self.delivered += len(sent)
+        self.retried += len(retry)
+        self.failed += len(failed)
+        return len(rows)
+
+    async def stats(self):
+        pending = (await db.fetchone("SELECT COUNT(*) FROM notification_outbox WHERE status = 'pending'"))[0]
+        return {"pending": pending, "delivered": self.delivered, "retried": self.retried, "failed": self.failed}
+
+outbox = NotificationOutbox()
+
+# Per-user session, used as context.user_data. Slots give every resident
+# session the same fixed set of fields instead of a dict that keeps growing,
+# and a misspelt field fails instead of quietly creating a new key.
+# SESSION_FIELDS holds the defaults; a type as the default (dict) means a fresh
+# empty value per session. Only fields that differ from their default are
+# stored. Quotes refer to in-process catalog and cart versions and are never
+# stored.
+SESSION_TRANSIENT = ("quote",)
+SESSION_FIELDS = {
+    # Profile and conversation
+    "language": None, "name": None, "state": "", "state_expires": None,
+    # The message on display (see render_screen)
+    "last_message_id": None, "message_type": None, "pending_alert": False, "gallery_message_ids": None,
+    "screen": None,
+    # Browsing and cart
+    "cart": Cart, "location": None, "store_id": 1, "category": None, "category_cursor": None, "category_last": None,
+    "product_cursor": None, "pending_category": None, "age_confirmed": False,
+    # Checkout
+    "delivery_fee": 0, "quote": None, "promo_code": None, "delivery_time": None,
+    "delivery_slot": None, "payment_type": None, "coin_amount": None,
+    # Admin drafts
+    "admin_store_id": 1, "product_name": None, "product_description": None, "product_price": None,
+    "product_category": None, "promo_discount": None,
+}
+
+def session_default(field):
+    default = SESSION_FIELDS[field]
+    return default() if isinstance(default, type) else default
+
+# Rough deep size of a session value; None, booleans and small ints are shared
+def deep_sizeof(value):
+    if value is None or isinstance(value, bool):
+        return 0
+    if isinstance(value, Cart):
+        return sys.getsizeof(value) + deep_sizeof(value.lines)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(deep_sizeof(k) + deep_sizeof(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(deep_sizeof(item) for item in value)
+    return sys.getsizeof(value)
+
+class Session:
+    __slots__ = (*SESSION_FIELDS, "last_active")
+
+    def __init__(self):
+        self.reset()
+        self.last_active = time.time()
+
+    # Back to defaults: the given fields, or all of them
+    def reset(self, *fields):
+        for field in fields or SESSION_FIELDS:
+            setattr(self, field, session_default(field))
+
+    def to_dict(self):
+        data = {}
+        for field in SESSION_FIELDS:
+            value = getattr(self, field)
+            if field not in SESSION_TRANSIENT and value != session_default(field):
+                data[field] = value.to_dict() if isinstance(value, Cart) else value
+        return data
+
+    # Stored fields fill in what this session has not set; fields that no
+    # longer exist are dropped
+    def restore(self, data):
+        for field, value in data.items():
+            if field in SESSION_FIELDS and field not in SESSION_TRANSIENT and getattr(self, field) == session_default(field):
+                setattr(self, field, Cart(value) if field == "cart" else value)
+
+    def memory(self):
+        return sys.getsizeof(self) + sum(deep_sizeof(getattr(self, field)) for field in SESSION_FIELDS)
+
+async def touch_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.user_data is not None:
+        context.user_data.last_active = time.time()
+
+# Session persistence for context.user_data, so a redeploy keeps half-built
+# carts and conversation state. Only user_data is stored. Writes are
+# write-behind: the Application hands over changed sessions every
+# SESSION_FLUSH_INTERVAL seconds and they are saved in one transaction, so a
+# click never waits on a session write. Sessions are restored lazily from
+# refresh_user_data() on a user's first update after startup.
+class SessionPersistence(BasePersistence):
+    def __init__(self, update_interval=SESSION_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
         )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = ""
-        await show_admin_panel(update.message, context, lang)
-    elif state == "awaiting_coin_receipt":
-        photo = update.message.photo[-1]
-        file_id = photo.file_id
-        amount = context.user_data.get("coin_amount")
-        conn = sqlite3.connect("store_bot.db")
+        self._restored = set()
+        self._spilled = set()
+        self._dirty = {}
+        self._flush_task = None
+        self.restores = 0
+        self.flushes = 0
+        self.flushed_sessions = 0
+
+    async def get_user_data(self):
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._restored:
+            return
+        self._restored.add(user_id)
+        row = await db.fetchone(SQL_LOAD_SESSION, (user_id,))
+        if row:
+            user_data.restore(json.loads(row[0]))
+            conversation.track(user_data, user_id)
+            self.restores += 1
+
+    # The Application calls this for every changed session in one burst;
+    # the first call schedules a single flush for the whole batch
+    async def update_user_data(self, user_id, data):
+        self._restored.add(user_id)
+        self._dirty[user_id] = json.dumps(data.to_dict())
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._write_dirty())
+
+    async def drop_user_data(self, user_id):
+        if user_id in self._spilled:
+            # Evicted from memory by the reaper: the stored copy stays
+            self._spilled.discard(user_id)
+            return
+        self._dirty.pop(user_id, None)
+        self._restored.discard(user_id)
+        await db.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+
+    async def _write_dirty(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        now = time.time()
         try:
-            c = conn.cursor()
-            c.execute("""
-                INSERT INTO coin_requests (user_id, amount, status, receipt_file_id, created_at)
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                user_id,
-                amount,
-                "pending",
-                file_id,
-                datetime.now(UZBEKISTAN_TZ).strftime("%Y-%m-%d %H:%M:%S")
-            ))
-            coin_request_id = c.lastrowid
-            conn.commit()
+            await db.run(lambda c: c.executemany(
+                "INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                [(user_id, data, now) for user_id, data in batch.items()]), label="save_sessions")
+        except sqlite3.Error as e:
+            logger.error(f"Failed to save {len(batch)} sessions: {e}")
+            for user_id, data in batch.items():
+                self._dirty.setdefault(user_id, data)
+            return
+        self.flushes += 1
+        self.flushed_sessions += len(batch)
+
+    async def flush(self):
+        if self._flush_task:
+            await self._flush_task
+        await self._write_dirty()
+
+    # Save sessions about to be evicted and return the ids that were saved;
+    # their next refresh_user_data() reads them back from the table
+    async def spill(self, sessions):
+        for user_id, session in sessions.items():
+            self._dirty[user_id] = json.dumps(session.to_dict())
+        await self.flush()
+        saved = {user_id for user_id in sessions if user_id not in self._dirty}
+        self._spilled.update(saved)
+        self._restored.difference_update(saved)
+        return saved
+
+    def stats(self):
+        return {
+            "restored": self.restores,
+            "flushes": self.flushes,
+            "flushed_sessions": self.flushed_sessions,
+            "dirty": len(self._dirty),
+        }
+
+    # Chat data, bot data, callback data and conversations are not persisted
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
 
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+# Idle session eviction. Once a minute the reaper measures the resident
+# sessions and evicts those idle for SESSION_IDLE_TTL. With SESSION_SPILL an
+# evicted session is saved first and comes back on the user's next update;
+# without it the session is dropped from the sessions table as well. A session
+# touched while its copy was being saved stays resident.
+class IdleSessionReaper:
+    def __init__(self, idle_ttl=SESSION_IDLE_TTL, spill=SESSION_SPILL):
+        self.idle_ttl = idle_ttl
+        self.spill = spill
+        self.evicted = 0
+        self.resident = 0
+        self.avg_bytes = 0.0
+        self.max_bytes = 0
+
+    async def run(self, application):
+        cutoff = time.time() - self.idle_ttl
+        idle = [user_id for user_id, session in application.user_data.items() if session.last_active < cutoff]
+        if idle:
+            persistence = application.persistence
+            if self.spill and isinstance(persistence, SessionPersistence):
+                idle = await persistence.spill({user_id: application.user_data[user_id] for user_id in idle})
+            evicted = 0
+            for user_id in idle:
+                session = application.user_data.get(user_id)
+                if session is not None and session.last_active < cutoff:
+                    application.drop_user_data(user_id)
+                    evicted += 1
+            self.evicted += evicted
+            logger.info(f"Evicted {evicted} idle sessions")
+        sizes = [session.memory() for session in application.user_data.values()]
+        self.resident = len(sizes)
+        self.avg_bytes = sum(sizes) / len(sizes) if sizes else 0.0
+        self.max_bytes = max(sizes, default=0)
+
+    def stats(self):
+        return {"resident": self.resident, "evicted": self.evicted, "avg_bytes": self.avg_bytes, "max_bytes": self.max_bytes}
+
+session_reaper = IdleSessionReaper()
+
+# Outbound flood control. Every Bot API request passes through a global token
+# bucket (GLOBAL_SEND_RATE/s) and, for requests that post into a chat, a per-chat
+# bucket (CHAT_SEND_RATE/s). Requests waiting for the global bucket are released
+# in priority order: interactive replies, then admin notifications, then bulk
+# jobs. Callers pick the class with rate_limit_args; the default is interactive.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_ADMIN = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_ADMIN: "admin", PRIORITY_BULK: "bulk"}
+UNLIMITED_ENDPOINTS = {"getUpdates", "getMe", "setWebhook", "deleteWebhook", "getWebhookInfo", "answerCallbackQuery"}
+CHAT_LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Take a token, going into debt if none is left; returns how long the caller
+    # must wait before using it. Reservations are served in call order.
+    def reserve(self):
+        self._refill()
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    # Block the bucket for the given number of seconds (Telegram's retry_after)
+    def penalize(self, seconds):
+        self._refill()
+        self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+class PriorityRateLimiter(BaseRateLimiter):
+    def __init__(self, global_rate=GLOBAL_SEND_RATE, chat_rate=CHAT_SEND_RATE, chat_burst=CHAT_SEND_BURST,
+                 max_retries=SEND_MAX_RETRIES):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._chats = {}
+        self._max_retries = max_retries
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._dispatcher = None
+        self.waits = {priority: [0, 0.0, 0.0] for priority in PRIORITY_NAMES}
+        self.throttled = 0
+        self.retry_after_events = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    # Release waiting requests one global token at a time, highest priority first
+    async def _dispatch(self):
+        try:
+            while self._waiters:
+                _, _, future = heapq.heappop(self._waiters)
+                if future.done():
+                    continue
+                delay = self._global.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not future.done():
+                    future.set_result(None)
         finally:
-            conn.close()
+            self._dispatcher = None
 
-        new_message = await update.message.reply_text(
-            LANGUAGES[lang]["coin_request_sent"],
-            parse_mode="Markdown"
-        )
-        context.user_data["last_message_id"] = new_message.message_id
-        context.user_data["message_type"] = "alert"
-        context.user_data["state"] = ""
+    async def _acquire_global(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
 
-        for admin in ADMIN_ID:
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return await self._timed_call(endpoint, callback, args, kwargs)
+        priority = rate_limit_args if rate_limit_args in PRIORITY_NAMES else PRIORITY_INTERACTIVE
+        chat_id = data.get("chat_id") if endpoint.startswith(CHAT_LIMITED_PREFIXES) else None
+        for attempt in range(self._max_retries + 1):
+            queued_at = time.perf_counter()
+            if chat_id is not None:
+                delay = self._chat_bucket(chat_id).reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await self._acquire_global(priority)
+            waited = time.perf_counter() - queued_at
+            stats = self.waits[priority]
+            stats[0] += 1
+            stats[1] += waited
+            stats[2] = max(stats[2], waited)
+            if waited > 0.001:
+                self.throttled += 1
             try:
-                keyboard = [
-                    [
-                        InlineKeyboardButton("✅ Approve", callback_data=f"approve_coin_{coin_request_id}"),
-                        InlineKeyboardButton("❌ Reject", callback_data=f"reject_coin_{coin_request_id}")
-                    ]
-                ]
-                await context.bot.send_photo(
-                    chat_id=admin,
-                    photo=file_id,
-                    caption=f"Coin request from user {user_id}: {'{:.3f}'.format(amount)} coins",
-                    reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode="Markdown"
-                )
-            except TelegramError as e:
-                logger.error(f"Failed to notify admin {admin}: {e}")
+                return await self._timed_call(endpoint, callback, args, kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                self.retry_after_events += 1
+                logger.warning(f"Flood control on {endpoint} for chat {chat_id}: retry after {retry_after}s")
+                if attempt == self._max_retries:
+                    raise
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).penalize(retry_after)
+                else:
+                    self._global.penalize(retry_after)
 
-        await show_main_menu(update.message, context, lang)
+    @staticmethod
+    async def _timed_call(endpoint, callback, args, kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except Exception:
+            api_errors.inc(endpoint)
+            raise
+        finally:
+            api_latency.observe(endpoint, time.perf_counter() - started)
 
-# Timeout job for admin response
-async def setup_timeout(context: ContextTypes.DEFAULT_TYPE):
-    conn = sqlite3.connect("store_bot.db")
+    def stats(self):
+        return {
+            "queued": len(self._waiters),
+            "throttled": self.throttled,
+            "retry_after": self.retry_after_events,
+            "wait": {
+                PRIORITY_NAMES[priority]: {
+                    "count": count,
+                    "avg_ms": total / count * 1000 if count else 0.0,
+                    "max_ms": longest * 1000,
+                }
+                for priority, (count, total, longest) in self.waits.items()
+            },
+        }
+
+# Periodic log line used to size CONCURRENT_UPDATES, USER_CACHE_SIZE and the send limits under load
+async def log_runtime_stats(application):
+    processor = application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        stats = processor.stats()
+        logger.info(
+            f"Updates: queued={application.update_queue.qsize()} pending={stats['pending']} "
+            f"running={stats['running']}/{processor.max_concurrent_updates} locked_users={stats['locked_users']} "
+            f"lock_wait_avg={stats['lock_wait_avg_ms']:.1f}ms lock_wait_max={stats['lock_wait_max_ms']:.1f}ms"
+        )
+        processor.lock_wait_max = 0.0
+    cache = user_cache.stats()
+    logger.info(
+        f"User cache: size={cache['size']} hits={cache['hits']} misses={cache['misses']} "
+        f"hit_rate={cache['hit_rate']:.1%}"
+    )
+    limiter = application.bot.rate_limiter
+    if isinstance(limiter, PriorityRateLimiter):
+        sends = limiter.stats()
+        waits = " ".join(f"{name}={w['count']}/{w['avg_ms']:.0f}ms/{w['max_ms']:.0f}ms" for name, w in sends["wait"].items())
+        logger.info(
+            f"Outbound: queued={sends['queued']} throttled={sends['throttled']} "
+            f"retry_after={sends['retry_after']} wait(count/avg/max) {waits}"
+        )
+        for stats in limiter.waits.values():
+            stats[2] = 0.0
+    routes = sorted(callback_router.stats().items(), key=lambda item: item[1]["calls"] * item[1]["avg_ms"], reverse=True)
+    busiest = " ".join(f"{key}={r['calls']}/{r['avg_ms']:.0f}ms/{r['max_ms']:.0f}ms/{r['errors']}err"
+                       for key, r in routes[:5] if r["calls"])
+    logger.info(f"Callbacks: unmatched={callback_router.unmatched} busiest(calls/avg/max/errors) {busiest}")
+    for stats in callback_router.route_stats.values():
+        stats[3] = 0.0
+    persistence = application.persistence
+    if isinstance(persistence, SessionPersistence):
+        sessions = persistence.stats()
+        logger.info(
+            f"Sessions: restored={sessions['restored']} flushes={sessions['flushes']} "
+            f"saved={sessions['flushed_sessions']} dirty={sessions['dirty']}"
+        )
+    quotes = checkout_quotes.stats()
+    logger.info(f"Checkout quotes: built={quotes['built']} reused={quotes['reused']} rejected={quotes['rejected']}")
+    resident = session_reaper.stats()
+    logger.info(
+        f"Resident sessions: count={resident['resident']} evicted={resident['evicted']} "
+        f"avg={resident['avg_bytes']:.0f}B max={resident['max_bytes']}B"
+    )
+    conversations = conversation.stats()
+    logger.info(
+        f"Conversations: deadlines={conversations['queued']} reaped={conversations['reaped']} "
+        f"expired_on_arrival={conversations['expired']} refused={conversations['refused']}"
+    )
+    timeouts = order_timeouts.stats()
+    logger.info(f"Order timeouts: timers={timeouts['timers']} cancelled={timeouts['cancelled']}")
+    slots = delivery_slots.stats()
+    logger.info(f"Delivery slots: booked={slots['booked']} full={slots['full']}")
+    notifications = await outbox.stats()
+    logger.info(
+        f"Outbox: pending={notifications['pending']} delivered={notifications['delivered']} "
+        f"retried={notifications['retried']} failed={notifications['failed']}"
+    )
+
+# Webhook mode. Telegram POSTs each update to WEBHOOK_PATH with the secret token
+# header; the request is answered as soon as the update is queued and the
+# application's update processor handles it in the background. GET /health
+# reports liveness and queue depth, and only answers loopback clients.
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+LOOPBACK_ADDRESSES = ("127.0.0.1", "::1")
+
+class WebhookServer:
+    def __init__(self, application, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET):
+        self.application = application
+        self.path = path
+        self.secret = secret
+        self.started_at = time.monotonic()
+        self.received = 0
+        self.rejected = 0
+        self._runner = None
+        self.app = web.Application()
+        self.app.router.add_post(path, self.handle_update)
+        self.app.router.add_get("/health", self.handle_health)
+
+    async def handle_update(self, request):
+        if self.secret and not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ""), self.secret):
+            self.rejected += 1
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), self.application.bot)
+        except ValueError:
+            self.rejected += 1
+            return web.Response(status=400)
+        self.received += 1
+        self.application.update_queue.put_nowait(update)
+        return web.Response()
+
+    async def handle_health(self, request):
+        if request.remote not in LOOPBACK_ADDRESSES:
+            return web.Response(status=404)
+        return web.json_response({
+            "status": "ok" if self.application.running else "starting",
+            "uptime_s": round(time.monotonic() - self.started_at, 1),
+            "updates_received": self.received,
+            "updates_rejected": self.rejected,
+            "update_queue": self.application.update_queue.qsize(),
+        })
+
+    async def start(self, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, listen, port).start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+# Mirrors Application.run_polling(): initialize, register the webhook, serve
+# until SIGINT/SIGTERM, then shut everything down in reverse order
+async def run_webhook(application):
+    server = WebhookServer(application)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+    await application.initialize()
+    await post_init(application)
     try:
-        c = conn.cursor()
-        c.execute("SELECT order_id, user_id FROM orders WHERE status = 'pending') AND created_at <= ?", 
-                  ((datetime.now(UZBEKISTAN_TZ) - timedelta(minutes=ADMIN_RESPONSE_TIMEOUT)).strftime("%Y-%m-%d %H:%M:%S"),))
-        orders = c.fetchall()
-        for order_id, user_id in orders:
-            c.execute("UPDATE orders SET status = 'cancelled' WHERE order_id = ?", (order_id,))
-            try:
-                c.execute("SELECT language FROM users WHERE user_id = ?", (user_id,))
-                lang = c.fetchone()[0] if c.fetchone() else "en"
-                await context.bot.send_message(
-                    user_id,
-                    f"❌ Order {order_id} was cancelled due to no admin response within {ADMIN_RESPONSE_TIMEOUT} minutes.",
-                    parse_mode="Markdown"
-                )
-            except TelegramError as e:
-                logger.error(f"Failed to notify user {user_id} for order {order_id}: {e}")
-        conn.commit()
+        await application.start()
+        await server.start()
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        logger.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        await stop_event.wait()
     finally:
-        conn.close()
-def main():
-    init_db()
-    application = Application.builder().token(API_TOKEN).build()
+        await server.stop()
+        if application.running:
+            await application.stop()
+        await post_shutdown(application)
+        await application.shutdown()
+
+metrics.gauge("bot_active_sessions", "Sessions resident in memory.",
+              lambda application: len(application.user_data))
+metrics.gauge("bot_session_bytes", "Average estimated memory per resident session, as of the last reaper run.",
+              lambda application: session_reaper.avg_bytes)
+metrics.gauge("bot_pending_orders", "Orders waiting for admin confirmation.",
+              lambda application: pending_orders_count())
+metrics.gauge("bot_outbox_pending", "Admin notifications waiting for delivery.",
+              lambda application: outbox_pending_count())
+metrics.gauge("bot_order_timers", "Pending orders with a deadline timer.",
+              lambda application: order_timeouts.stats()["timers"])
+metrics.gauge("bot_update_queue", "Updates received but not yet dispatched.",
+              lambda application: application.update_queue.qsize())
+
+async def pending_orders_count():
+    return (await db.fetchone("SELECT COUNT(*) FROM orders WHERE status = 'pending'"))[0]
+
+async def outbox_pending_count():
+    return (await db.fetchone("SELECT COUNT(*) FROM notification_outbox WHERE status = 'pending'"))[0]
+
+scheduler = AsyncIOScheduler(timezone=UZBEKISTAN_TZ)
 
-    
-    scheduler = AsyncIOScheduler(timezone=UZBEKISTAN_TZ)
-    scheduler.add_job(setup_timeout, 'interval', minutes=30, args=[application])
+async def post_init(application):
     scheduler.start()
+    outbox.start(application.bot)
+    await order_timeouts.reschedule()
+    if METRICS_PORT:
+        await metrics.start(application)
 
+async def post_shutdown(application):
+    await metrics.stop()
+    await outbox.stop()
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+
+# The production Application: handlers, scheduler jobs, persistence and limits.
+# base_url points the bot at another Bot API server (bench.py's stand-in).
+def build_application(token=API_TOKEN, base_url=None):
+    builder = (Application.builder().token(token).rate_limiter(PriorityRateLimiter())
+               .persistence(SessionPersistence()).context_types(ContextTypes(user_data=Session)))
+    if base_url:
+        builder = builder.base_url(base_url)
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)
+    else:
+        builder = builder.post_init(post_init).post_shutdown(post_shutdown)
+    builder = builder.concurrent_updates(PerUserUpdateProcessor(max(CONCURRENT_UPDATES, 1)))
+    application = builder.build()
+
+    scheduler.add_job(log_runtime_stats, 'interval', minutes=1, args=[application])
+    scheduler.add_job(conversation.reap, 'interval', minutes=1, args=[application])
+    scheduler.add_job(session_reaper.run, 'interval', minutes=1, args=[application])
+
+    application.add_handler(TypeHandler(Update, touch_session), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(MessageHandler(filters.LOCATION, handle_location))
     application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
     application.add_error_handler(error_handler)
+    return application
 
-    application.run_polling()
-
+def main():
+    init_db()
+    application = build_application()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling()
+    db.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
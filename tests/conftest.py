@@ -0,0 +1,17 @@
+import os
+import sys
+import tempfile
+
+# bot.py reads its configuration at import time; give it harmless values and
+# keep its default database out of the working tree
+for name, value in {
+    "API_TOKEN": "123456:TEST",
+    "ADMIN_ID": "1",
+    "PHONE_NUMBER": "+998000000000",
+    "CARD_NUMBER": "0000 0000 0000 0000",
+    "SUPPORT_USERNAME": "support",
+    "DB_PATH": os.path.join(tempfile.mkdtemp(prefix="bot-tests-"), "store_bot.db"),
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
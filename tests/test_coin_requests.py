@@ -0,0 +1,55 @@
+import asyncio
+import sqlite3
+
+import bot
+
+REQUESTS = 20
+
+
+def setup_db(path):
+    bot.init_db(path)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("INSERT INTO users (user_id, name, phone, language, coins) VALUES (1, 'Test', '+998', 'en', 0)")
+        conn.executemany("INSERT INTO coin_requests (user_id, amount, status) VALUES (1, 100, 'pending')",
+                         [()] * REQUESTS)
+    conn.close()
+
+
+def coins(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT coins FROM users WHERE user_id = 1").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def answer_twice(path, first, second):
+    async def run():
+        database = bot.Database(path, 2)
+        try:
+            results = []
+            for request_id in range(1, REQUESTS + 1):
+                results.append(await asyncio.gather(database.run(first, request_id),
+                                                    database.run(second, request_id)))
+            return results
+        finally:
+            database.close()
+    return asyncio.run(run())
+
+
+def test_concurrent_approvals_credit_once(tmp_path):
+    path = str(tmp_path / "store_bot.db")
+    setup_db(path)
+    results = answer_twice(path, bot.approve_coin_request, bot.approve_coin_request)
+    assert all(sum(result is not None for result in pair) == 1 for pair in results)
+    assert coins(path) == 100 * REQUESTS
+
+
+def test_approval_and_rejection_race_has_one_winner(tmp_path):
+    path = str(tmp_path / "store_bot.db")
+    setup_db(path)
+    results = answer_twice(path, bot.approve_coin_request, bot.reject_coin_request)
+    approved = sum(pair[0] is not None for pair in results)
+    assert all(sum(result is not None for result in pair) == 1 for pair in results)
+    assert coins(path) == 100 * approved
@@ -0,0 +1,56 @@
+import sqlite3
+
+import bot
+
+
+def schema(path):
+    conn = sqlite3.connect(path)
+    try:
+        user_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        objects = conn.execute("SELECT type, name, sql FROM sqlite_master ORDER BY type, name").fetchall()
+        return user_version, objects
+    finally:
+        conn.close()
+
+
+def test_hot_queries_use_indexes(tmp_path):
+    path = str(tmp_path / "store_bot.db")
+    bot.init_db(path)
+    conn = bot.connect_for_migrations(path)
+    try:
+        assert bot.find_unindexed_queries(conn.cursor()) == {}
+    finally:
+        conn.close()
+
+
+def test_migrations_are_idempotent(tmp_path):
+    path = str(tmp_path / "store_bot.db")
+    bot.init_db(path)
+    first = schema(path)
+    assert first[0] == len(bot.MIGRATIONS)
+    bot.init_db(path)
+    assert schema(path) == first
+
+
+def search(path, text):
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute("SELECT rowid FROM products_fts WHERE products_fts MATCH ?",
+                                               (bot.build_search_query(text),))]
+    finally:
+        conn.close()
+
+
+def test_products_writable_without_bot_functions(tmp_path):
+    path = str(tmp_path / "store_bot.db")
+    bot.init_db(path)
+    # A plain connection, like the sqlite3 CLI or a backup tool, has no normalize_search_text()
+    conn = sqlite3.connect(path)
+    with conn:
+        product_id = conn.execute("INSERT INTO products (name, description, image, price, category, store_id) "
+                                  "VALUES ('Ўрик', 'Quritilgan', NULL, 10, 'Mevalar', 1)").lastrowid
+        conn.execute("UPDATE products SET price = 12 WHERE id = ?", (product_id,))
+    conn.close()
+    assert search(path, "o'rik") == []
+    bot.init_db(path)
+    assert search(path, "o'rik") == [product_id]
@@ -0,0 +1,76 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import aiohttp
+
+import bot
+
+SECRET = "test-secret"
+
+
+def recorded_update(update_id):
+    user = {"id": 1000 + update_id, "is_bot": False, "first_name": "Test"}
+    chat = {"id": user["id"], "type": "private"}
+    return {"update_id": update_id,
+            "message": {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": "Cola"}}
+
+
+# Serve a WebhookServer on an ephemeral loopback port, run check(server, url), stop it
+def with_server(check):
+    async def run():
+        application = bot.Application.builder().token(bot.API_TOKEN).updater(None).build()
+        server = bot.WebhookServer(application, path="/telegram", secret=SECRET)
+        await server.start(listen="127.0.0.1", port=0)
+        host, port = server._runner.addresses[0][:2]
+        try:
+            async with aiohttp.ClientSession() as session:
+                await check(server, session, f"http://{host}:{port}")
+        finally:
+            await server.stop()
+    asyncio.run(run())
+
+
+def test_update_with_secret_is_queued():
+    async def check(server, session, url):
+        async with session.post(url + "/telegram", json=recorded_update(1),
+                                headers={bot.SECRET_TOKEN_HEADER: SECRET}) as response:
+            assert response.status == 200
+        update = server.application.update_queue.get_nowait()
+        assert update.update_id == 1
+        assert update.message.text == "Cola"
+        assert server.received == 1
+    with_server(check)
+
+
+def test_wrong_or_missing_secret_is_rejected():
+    async def check(server, session, url):
+        async with session.post(url + "/telegram", json=recorded_update(2),
+                                headers={bot.SECRET_TOKEN_HEADER: "wrong"}) as response:
+            assert response.status == 403
+        async with session.post(url + "/telegram", json=recorded_update(3)) as response:
+            assert response.status == 403
+        assert server.application.update_queue.empty()
+        assert server.rejected == 2
+    with_server(check)
+
+
+def test_malformed_json_is_rejected():
+    async def check(server, session, url):
+        async with session.post(url + "/telegram", data=b"{not json",
+                                headers={bot.SECRET_TOKEN_HEADER: SECRET,
+                                         "Content-Type": "application/json"}) as response:
+            assert response.status == 400
+        assert server.application.update_queue.empty()
+    with_server(check)
+
+
+def test_health_answers_loopback_only():
+    async def check(server, session, url):
+        async with session.get(url + "/health") as response:
+            assert response.status == 200
+            assert json.loads(await response.text())["updates_received"] == 0
+        remote = await server.handle_health(SimpleNamespace(remote="203.0.113.7"))
+        assert remote.status == 404
+    with_server(check)